@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+# Local stand-in for gpsd. Every client that connects gets a stream of TPV
+# (and SKY) reports at the given rate, either of a synthetic track (a
+# vehicle driving circles) or replayed from a recording of gpsd reports
+# (e.g., the output of "gpspipe -w"). The time of the reports is the
+# current time, so the logging interval of the logger works as with a
+# real receiver.
+
+import argparse
+import json
+import logging
+import math
+import socket
+import threading
+import time
+
+
+# Returns the current time in the time format of gpsd.
+def gpsd_time(timestamp):
+    return (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp))
+            + ".%03dZ" % int((timestamp % 1.0) * 1000))
+
+
+# Yields the TPV reports of a vehicle driving circles with the given speed
+# (in m/s). Every client starts at a different position.
+def synthetic_reports(rate, speed, index):
+    lat = 52.0 + index * 0.01
+    lon = 13.0
+    radius = 500.0
+    step = speed / rate / radius
+    angle = 0.0
+    while True:
+        angle += step
+        yield {"class": "TPV",
+               "device": "/dev/ttyFAKE%d" % index,
+               "mode": 3,
+               "lat": lat + math.degrees(radius * math.sin(angle) / 6371008.8),
+               "lon": lon + math.degrees(radius * math.cos(angle) / 6371008.8
+                                         / math.cos(math.radians(lat))),
+               "alt": 30.0 + 5.0 * math.sin(angle * 3.0),
+               "speed": speed,
+               "track": math.degrees(angle) % 360.0}
+
+
+# Yields the TPV reports of a recording (one json report per line),
+# repeating the recording at its end.
+def replay_reports(file_location):
+    while True:
+        num_reports = 0
+        with open(file_location, "r") as fp:
+            for line in fp:
+                try:
+                    report = json.loads(line)
+                except ValueError:
+                    continue
+                if type(report) == dict and report.get("class") == "TPV":
+                    num_reports += 1
+                    yield report
+        if num_reports == 0:
+            raise ValueError("Recording contains no TPV reports.")
+
+
+class FakeGpsd(object):
+
+    def __init__(self, host, port, rate, speed=15.0, replay=None,
+                 sky=True):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.speed = speed
+        self.replay = replay
+        self.sky = sky
+
+        self.lock = threading.Lock()
+        self.num_clients = 0
+        self.num_reports = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+    # Sends the reports to a client until it disconnects. The reports are
+    # sent in the rhythm of the rate (without drifting).
+    def _serve(self, conn, index):
+        if self.replay is not None:
+            reports = replay_reports(self.replay)
+        else:
+            reports = synthetic_reports(self.rate, self.speed, index)
+
+        sky = json.dumps({"class": "SKY", "satellites": []}) + "\n"
+        try:
+            # Wait for the watch command of the client.
+            conn.recv(1024)
+            conn.sendall(b'{"class":"VERSION","release":"fake"}\n')
+
+            next_time = time.monotonic()
+            for report in reports:
+                report["time"] = gpsd_time(time.time())
+                data = json.dumps(report) + "\n"
+                if self.sky:
+                    data = sky + data
+                conn.sendall(data.encode("utf-8"))
+                with self.lock:
+                    self.num_reports += 1
+
+                next_time += 1.0 / self.rate
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with self.lock:
+                index = self.num_clients
+                self.num_clients += 1
+            thread = threading.Thread(target=self._serve,
+                                      args=(conn, index),
+                                      daemon=True)
+            thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for gpsd.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2947)
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="TPV reports per second (default: 1).")
+    parser.add_argument("--speed", type=float, default=15.0,
+                        help="Speed of the synthetic track in m/s.")
+    parser.add_argument("--replay", default=None, metavar="FILE",
+                        help="Replay the TPV reports of a recording "
+                        + "(one json report per line).")
+    parser.add_argument("--no-sky", action="store_true",
+                        help="Do not send SKY reports.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.INFO)
+
+    gpsd = FakeGpsd(args.host, args.port, args.rate, args.speed,
+                    args.replay, not args.no_sky)
+    logging.info("Listening on %s:%d with %.1f Hz."
+                 % (args.host, gpsd.port, args.rate))
+    try:
+        gpsd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info("clients=%d reports=%d"
+                 % (gpsd.num_clients, gpsd.num_reports))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+# Local stand-in for the submit.php of the ChasR server. Accepts the legacy
+# and the compact encoding of the gps data, optionally compressed with gzip
+# or deflate, and reports the received bytes per gps position. With
+# --legacy-only it behaves like a server that only knows the legacy format.
+# Latency, error responses (ErrorCodes) and outages (connections are closed
+# without a response) can be injected for benchmarks.
+
+import argparse
+import binascii
+import hmac
+import http.server
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+from Crypto.Cipher import AES
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.crypto import derive_key, get_auth_tag
+from lib.encoding import decompress_body, decode_gps_data
+from lib.submitter import ErrorCodes
+
+
+# Counters of the received requests.
+class ServerStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_points = 0
+        self.num_bytes = 0
+        self.num_rejected = 0
+        self.num_injected = 0
+        self.num_dropped = 0
+        self.encodings = dict()
+
+    def record(self, num_bytes, num_points, encoding):
+        with self.lock:
+            self.num_requests += 1
+            self.num_bytes += num_bytes
+            self.num_points += num_points
+            self.encodings[encoding] = self.encodings.get(encoding, 0) + 1
+
+    def reject(self, num_bytes):
+        with self.lock:
+            self.num_requests += 1
+            self.num_bytes += num_bytes
+            self.num_rejected += 1
+
+    def inject(self, num_bytes):
+        with self.lock:
+            self.num_requests += 1
+            self.num_bytes += num_bytes
+            self.num_injected += 1
+
+    def drop(self):
+        with self.lock:
+            self.num_dropped += 1
+
+    def __str__(self):
+        with self.lock:
+            bytes_per_point = 0.0
+            if self.num_points > 0:
+                bytes_per_point = float(self.num_bytes) / self.num_points
+            return ("requests=%d rejected=%d injected=%d dropped=%d "
+                    % (self.num_requests, self.num_rejected,
+                       self.num_injected, self.num_dropped)
+                    + "points=%d bytes=%d "
+                    % (self.num_points, self.num_bytes)
+                    + "bytes_per_point=%.1f encodings=%s"
+                    % (bytes_per_point, json.dumps(self.encodings)))
+
+
+# Decrypts a hex encoded gps value.
+def decrypt_value(key, iv, value):
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    data = cipher.decrypt(binascii.unhexlify(value))
+    return data[:-data[-1]]
+
+
+# Checks a received data point. Verifies the auth tag if the
+# key is known.
+def check_data_point(data_point, key):
+    for field in ["iv", "lat", "lon", "alt", "speed"]:
+        if len(data_point[field]) != 32:
+            return False
+    if len(data_point["authtag"]) != 64:
+        return False
+    if type(data_point["utctime"]) != int:
+        return False
+    if key is None:
+        return True
+
+    iv = binascii.unhexlify(data_point["iv"])
+    values = [decrypt_value(key, iv, data_point[field])
+              for field in ["lat", "lon", "alt", "speed"]]
+    auth_tag = get_auth_tag(key, data_point["device_name"],
+                            data_point["utctime"], *values)
+    return hmac.compare_digest(auth_tag, data_point["authtag"])
+
+
+# Parses an outage given as START:DURATION (in seconds since the start
+# of the server).
+def parse_outage(value):
+    start, duration = value.split(":")
+    return (float(start), float(start) + float(duration))
+
+
+class SubmitHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self, status, result=None):
+        data = b""
+        if result is not None:
+            data = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 415:
+            self.send_header("Accept-Encoding", "identity")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        # The server is down, close the connection without a response.
+        uptime = time.monotonic() - server.start_time
+        for start, end in server.outages:
+            if start <= uptime < end:
+                server.stats.drop()
+                self.close_connection = True
+                return
+
+        if server.latency > 0 or server.jitter > 0:
+            time.sleep(max(0.0, random.gauss(server.latency,
+                                             server.jitter)) / 1000.0)
+
+        # A legacy server (php) does not decode compressed request bodies
+        # and does not find any POST field in it.
+        compression = self.headers.get("Content-Encoding", "identity")
+        try:
+            if compression != "identity":
+                if server.legacy_only:
+                    raise ValueError("Compression not supported.")
+                body = decompress_body(body, compression)
+            fields = urllib.parse.parse_qs(body.decode("ascii"))
+        except Exception:
+            server.stats.reject(length)
+            self._respond(200, {"code": ErrorCodes.AUTH_ERROR,
+                                "msg": "Authentication failed."})
+            return
+
+        if ("user" not in fields
+           or "password" not in fields
+           or fields["user"][0] != server.username
+           or fields["password"][0] != server.password):
+            server.stats.reject(length)
+            self._respond(200, {"code": ErrorCodes.AUTH_ERROR,
+                                "msg": "Authentication failed."})
+            return
+
+        encoding = fields.get("encoding", ["legacy"])[0]
+        try:
+            if encoding == "compact" and server.legacy_only:
+                raise ValueError("Compact encoding not supported.")
+            data_points = decode_gps_data(fields["gps_data"][0],
+                                          encoding == "compact")
+            for data_point in data_points:
+                if not check_data_point(data_point, server.key):
+                    raise ValueError("Illegal data point.")
+        except Exception as e:
+            server.stats.reject(length)
+            self._respond(200, {"code": ErrorCodes.ILLEGAL_MSG_ERROR,
+                                "msg": str(e)})
+            return
+
+        if server.error_rate > 0 and random.random() < server.error_rate:
+            server.stats.inject(length)
+            self._respond(200, {"code": server.error_code,
+                                "msg": "Injected error."})
+            return
+
+        server.stats.record(length, len(data_points),
+                            encoding + "/" + compression)
+        self._respond(200, {"code": ErrorCodes.NO_ERROR})
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+
+# Creates the server (served by the caller).
+def create_server(host="127.0.0.1", port=8080, username="user",
+                  password="password", secret=None, legacy_only=False,
+                  latency=0.0, jitter=0.0, error_rate=0.0,
+                  error_code=ErrorCodes.DATABASE_ERROR, outages=()):
+    server = http.server.ThreadingHTTPServer((host, port), SubmitHandler)
+    server.daemon_threads = True
+    server.username = username
+    server.password = password
+    server.legacy_only = legacy_only
+    server.key = None
+    if secret is not None:
+        server.key = derive_key(secret)
+    server.stats = ServerStats()
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.error_code = error_code
+    server.outages = list(outages)
+    server.start_time = time.monotonic()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                        description="Stand-in for the ChasR submit.php.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--user", default="user")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--secret", default=None,
+                        help="Secret of the device. If given, the received "
+                        + "gps data is decrypted and its auth tag checked.")
+    parser.add_argument("--legacy-only", action="store_true",
+                        help="Accept only uncompressed requests in the "
+                        + "legacy encoding.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Mean time in ms before the server responds.")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Standard deviation of the latency in ms.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of the valid requests answered with "
+                        + "the error code.")
+    parser.add_argument("--error-code", type=int,
+                        default=ErrorCodes.DATABASE_ERROR,
+                        help="Injected error code (default: %d)."
+                        % ErrorCodes.DATABASE_ERROR)
+    parser.add_argument("--outage", type=parse_outage, action="append",
+                        default=[], metavar="START:DURATION",
+                        help="Close all connections without a response "
+                        + "from START for DURATION seconds (can be given "
+                        + "several times).")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.INFO)
+
+    server = create_server(args.host, args.port, args.user, args.password,
+                           args.secret, args.legacy_only, args.latency,
+                           args.jitter, args.error_rate, args.error_code,
+                           args.outage)
+
+    # Log the statistics when terminated as well.
+    def sigterm_handler(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    logging.info("Listening on http://%s:%d/"
+                 % (args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info(str(server.stats))
+
+
+if __name__ == '__main__':
+    main()
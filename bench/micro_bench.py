@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+# Micro-benchmarks of the hot functions of the logger at realistic backlog
+# sizes. Every benchmark is run for every size (best of --repeat runs) and
+# reported as time per gps position. The results can be saved as json and
+# compared against a saved baseline: a benchmark fails if its time per
+# position grew by more than the threshold. Independent of the baseline, a
+# benchmark fails if its time per position at the largest size is more than
+# --max-growth times the time at the smallest size (e.g., quadratic
+# removal of acknowledged positions).
+#
+# No baseline is shipped, since the times depend on the machine. Record
+# the baseline on the machine the comparison runs on, with the code before
+# the change (e.g., after "git stash" or on a checkout of the base commit):
+#
+#   python3 bench/micro_bench.py --output /tmp/baseline.json
+#
+# and compare the changed code against it:
+#
+#   python3 bench/micro_bench.py --baseline /tmp/baseline.json
+#
+# Use the same --sizes and --crypto-processes for both runs and keep the
+# machine otherwise idle. A baseline of another python version or machine
+# type is still compared, but a warning is printed.
+
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import chasr
+from lib import GlobalData
+from lib import DataSubmitter
+from lib import GpsBacklog
+from lib import journal_class
+
+
+# Maximal number of calls measured by the benchmarks of functions whose
+# cost does not depend on the size of the backlog.
+MAX_CALLS = 100000
+
+
+# Returns size gps positions of a track (as stored by the collector).
+def create_positions(size):
+    positions = list()
+    for i in range(size):
+        positions.append({"lat": str(52.0 + i * 0.00001)[:14],
+                          "lon": str(13.0 + i * 0.00002)[:14],
+                          "alt": str(30.0 + (i % 100) * 0.1)[:14],
+                          "speed": str(10.0 + (i % 50) * 0.5)[:14],
+                          "utctime": 1517515278 + i,
+                          "seq": i})
+    return positions
+
+
+# Shared state of the benchmarks: the positions of the current size, a
+# submitter (not started) and a directory for temporary files.
+class BenchContext(object):
+
+    def __init__(self, crypto_processes):
+        self.work_dir = tempfile.mkdtemp(prefix="chasr-micro-")
+        self.positions = list()
+
+        self.global_data = GlobalData()
+        self.global_data.server = "http://127.0.0.1:1/"
+        self.global_data.username = "user"
+        self.global_data.password = "password"
+        self.global_data.secret = "bench"
+        self.global_data.device_name = "bench"
+        self.global_data.submission_interval = 30
+        self.global_data.crypto_processes = crypto_processes
+        self.submitter = DataSubmitter(self.global_data)
+
+    # Returns a new empty directory for temporary files.
+    def make_dir(self, name):
+        location = os.path.join(self.work_dir, name)
+        shutil.rmtree(location, ignore_errors=True)
+        os.makedirs(location)
+        return location
+
+    def close(self):
+        self.submitter.crypto.close()
+        self.submitter.executor.shutdown(wait=False)
+        self.submitter.session.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+# Every benchmark prepares its input (not measured) and returns the
+# function that is measured and the number of gps positions it processes.
+
+# Streaming the positions of an old tempfile.
+def bench_parse_gps(ctx):
+    location = os.path.join(ctx.make_dir("parse_gps"), "gps.json")
+    with open(location, "w") as fp:
+        json.dump([{k: v for k, v in x.items() if k != "seq"}
+                   for x in ctx.positions], fp)
+
+    def run():
+        with open(location, "r") as fp:
+            for _ in chasr.parse_gps(fp):
+                pass
+    return run, len(ctx.positions)
+
+
+# Encryption of the four values of every position (one call per value).
+def bench_encrypt_data(ctx):
+    iv = os.urandom(16)
+    encrypt_data = ctx.submitter.encrypt_data
+    positions = ctx.positions[:MAX_CALLS]
+
+    def run():
+        for position in positions:
+            encrypt_data(iv, position["lat"])
+            encrypt_data(iv, position["lon"])
+            encrypt_data(iv, position["alt"])
+            encrypt_data(iv, position["speed"])
+    return run, len(positions)
+
+
+# Auth tag of every position.
+def bench_get_auth_tag(ctx):
+    get_auth_tag = ctx.submitter.get_auth_tag
+    positions = ctx.positions[:MAX_CALLS]
+
+    def run():
+        for position in positions:
+            get_auth_tag("bench", position["utctime"], position["lat"],
+                         position["lon"], position["alt"], position["speed"])
+    return run, len(positions)
+
+
+# Encryption and payload encoding of the chunks of the whole backlog
+# (in batches like the chunk builder).
+def bench_build_chunks(ctx):
+    batch_size = max(ctx.global_data.gps_chunk, ctx.global_data.crypto_batch)
+
+    def run():
+        for pos in range(0, len(ctx.positions), batch_size):
+            ctx.submitter.build_chunks(ctx.positions[pos:pos+batch_size])
+    return run, len(ctx.positions)
+
+
+# Creates a backlog holding all positions (older positions are spilled to
+# disk like in the logger).
+def create_backlog(ctx):
+    backlog = GpsBacklog(ctx.global_data.max_memory_points,
+                         ctx.make_dir("spill"))
+    backlog.extend(ctx.positions)
+    return backlog
+
+
+# Removal of the acknowledged chunks from the backlog (in order).
+def bench_ack(ctx):
+    backlog = create_backlog(ctx)
+    chunk = ctx.global_data.gps_chunk
+
+    def run():
+        for first_seq in range(0, len(ctx.positions), chunk):
+            backlog.ack_range(first_seq, first_seq + chunk - 1)
+    return run, len(ctx.positions)
+
+
+# Removal of the acknowledged chunks from the backlog when every second
+# chunk is acknowledged before its predecessor (several chunks in flight).
+def bench_ack_unordered(ctx):
+    backlog = create_backlog(ctx)
+    chunk = ctx.global_data.gps_chunk
+
+    def run():
+        for first_seq in range(0, len(ctx.positions), 2 * chunk):
+            backlog.ack_range(first_seq + chunk, first_seq + 2 * chunk - 1)
+            backlog.ack_range(first_seq, first_seq + chunk - 1)
+    return run, len(ctx.positions)
+
+
+# Appending the positions to the journal (in group commits).
+def bench_journal_append(ctx, storage_format):
+    location = os.path.join(ctx.make_dir("journal"), "gps.journal")
+    journal = journal_class(storage_format)(location)
+    journal.open()
+    batch_size = ctx.global_data.commit_batch_size
+
+    def run():
+        for pos in range(0, len(ctx.positions), batch_size):
+            journal.write_records(ctx.positions[pos:pos+batch_size])
+        journal.close()
+    return run, len(ctx.positions)
+
+
+# Replaying a journal with all positions (half of them acknowledged).
+def bench_journal_replay(ctx, storage_format):
+    location = os.path.join(ctx.make_dir("journal"), "gps.journal")
+    journal = journal_class(storage_format)(location)
+    journal.open()
+    half = len(ctx.positions) // 2
+    journal.write_records(ctx.positions)
+    journal.write_records([{"ack": [0, half - 1]}])
+    journal.close()
+
+    def run():
+        replay_journal = journal_class(storage_format)(location)
+        for _ in replay_journal.replay(chasr.check_gps):
+            pass
+        replay_journal.close()
+    return run, len(ctx.positions)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("parse_gps", bench_parse_gps),
+    ("encrypt_data", bench_encrypt_data),
+    ("get_auth_tag", bench_get_auth_tag),
+    ("build_chunks", bench_build_chunks),
+    ("ack", bench_ack),
+    ("ack_unordered", bench_ack_unordered),
+    ("journal_append_json",
+     lambda ctx: bench_journal_append(ctx, "json")),
+    ("journal_append_binary",
+     lambda ctx: bench_journal_append(ctx, "binary")),
+    ("journal_replay_json",
+     lambda ctx: bench_journal_replay(ctx, "json")),
+    ("journal_replay_binary",
+     lambda ctx: bench_journal_replay(ctx, "binary")),
+])
+
+
+# Runs the given benchmark and returns the best duration and the number
+# of processed gps positions.
+def measure(ctx, benchmark, repeat):
+    best = None
+    for _ in range(repeat):
+        run, num_points = benchmark(ctx)
+        start = time.perf_counter()
+        run()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best, num_points
+
+
+# Compares the results with the baseline and checks the growth of the time
+# per position over the sizes. Returns the list of failures.
+def check_results(results, baseline, threshold, max_growth):
+    failures = list()
+    for name, sizes in results.items():
+
+        if baseline is not None and name in baseline:
+            for size, result in sizes.items():
+                if size not in baseline[name]:
+                    continue
+                old = baseline[name][size]["usec_per_point"]
+                new = result["usec_per_point"]
+                if old > 0 and new > old * (1.0 + threshold):
+                    failures.append("%s (%s points): %.3f us/point, "
+                                    % (name, size, new)
+                                    + "baseline %.3f us/point (+%.0f%%)"
+                                    % (old, (new / old - 1.0) * 100.0))
+
+        ordered = sorted(sizes.items(), key=lambda x: int(x[0]))
+        if len(ordered) >= 2:
+            smallest = ordered[0][1]["usec_per_point"]
+            largest = ordered[-1][1]["usec_per_point"]
+            if smallest > 0 and largest > smallest * max_growth:
+                failures.append("%s: %.3f us/point at %s points, "
+                                % (name, largest, ordered[-1][0])
+                                + "%.3f us/point at %s points (x%.1f)"
+                                % (smallest, ordered[0][0],
+                                   largest / smallest))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    description="Micro-benchmarks of the hot functions.")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="Comma separated backlog sizes "
+                        + "(default: 1000,10000,100000,1000000).")
+    parser.add_argument("--only", action="append", default=None,
+                        choices=list(BENCHMARKS.keys()), metavar="NAME",
+                        help="Run only the given benchmark (can be given "
+                        + "several times).")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per benchmark and size, the best run "
+                        + "counts (default: 3).")
+    parser.add_argument("--crypto-processes", type=int, default=1,
+                        help="Processes used by build_chunks (default: 1, "
+                        + "0 = one per core).")
+    parser.add_argument("--output", default=None, metavar="FILE",
+                        help="Save the results as json.")
+    parser.add_argument("--baseline", default=None, metavar="FILE",
+                        help="Compare the results with the results saved "
+                        + "by --output on this machine.")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Allowed growth of the time per position "
+                        + "compared to the baseline (default: 0.25).")
+    parser.add_argument("--max-growth", type=float, default=4.0,
+                        help="Allowed factor between the time per position "
+                        + "at the largest and the smallest size "
+                        + "(default: 4).")
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(",")]
+    names = args.only or list(BENCHMARKS.keys())
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fp:
+            saved = json.load(fp)
+        baseline = saved["results"]
+        if (saved.get("python") != platform.python_version()
+           or saved.get("machine") != platform.machine()):
+            print("WARNING: baseline was recorded with python %s on %s "
+                  % (saved.get("python"), saved.get("machine"))
+                  + "(now python %s on %s), the times are not comparable."
+                  % (platform.python_version(), platform.machine()))
+
+    ctx = BenchContext(args.crypto_processes)
+    results = collections.OrderedDict((name, collections.OrderedDict())
+                                      for name in names)
+    try:
+        for size in sizes:
+            ctx.positions = create_positions(size)
+            for name in names:
+                duration, num_points = measure(ctx, BENCHMARKS[name],
+                                               args.repeat)
+                usec_per_point = duration / num_points * 1000000.0
+                results[name][str(size)] = {
+                    "seconds": duration,
+                    "points": num_points,
+                    "usec_per_point": usec_per_point}
+
+                line = "%-22s %8d %10.4f s %10.3f us/point" % (
+                            name, size, duration, usec_per_point)
+                old_sizes = (baseline or dict()).get(name, dict())
+                if str(size) in old_sizes:
+                    old = old_sizes[str(size)]["usec_per_point"]
+                    line += " (baseline %.3f, %+.0f%%)" % (
+                            old, (usec_per_point / old - 1.0) * 100.0)
+                print(line)
+                sys.stdout.flush()
+    finally:
+        ctx.close()
+
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "sizes": sizes,
+                       "results": results}, fp, indent=2)
+
+    failures = check_results(results, baseline, args.threshold,
+                             args.max_growth)
+    for failure in failures:
+        print("REGRESSION: %s" % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
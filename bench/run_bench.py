@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+# End-to-end benchmark of the logger. Starts the gpsd stand-in
+# (fake_gpsd.py) and the submit.php stand-in (fake_server.py) as separate
+# processes and drives the collector and the submitter of the logger
+# against them for the given duration. Afterwards, the backlog is drained.
+# Reports the ingested fixes per second, the fix-to-ack latency
+# percentiles, the backlog drain time and the CPU time and peak RSS of
+# the logger process.
+
+import argparse
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from lib import GlobalData
+from lib import DataSubmitter
+from lib import DataCollector
+from lib import GpsBacklog
+from lib import PersistenceWorker
+from lib import SubmitScheduler
+from lib import LatencyStats
+from lib import journal_class
+
+
+# Collector that records when a position was stored.
+class BenchCollector(DataCollector):
+
+    def __init__(self, global_data, fix_times):
+        DataCollector.__init__(self, global_data)
+        self.fix_times = fix_times
+        self.element = None
+
+    def build_element(self, tpv, fix_time=None):
+        self.element = DataCollector.build_element(self, tpv, fix_time)
+        return self.element
+
+    def process_tpv(self, tpv, fix_time=None):
+        DataCollector.process_tpv(self, tpv, fix_time)
+        if self.element is not None and "seq" in self.element:
+            self.fix_times[self.element["seq"]] = time.monotonic()
+        self.element = None
+
+
+# Submitter that records the time from storing a position until
+# the server acknowledged it.
+class BenchSubmitter(DataSubmitter):
+
+    def __init__(self, global_data, fix_times, fix_latency):
+        DataSubmitter.__init__(self, global_data)
+        self.fix_times = fix_times
+        self.fix_latency = fix_latency
+
+    def ack_chunk(self, chunk):
+        DataSubmitter.ack_chunk(self, chunk)
+        now = time.monotonic()
+        for seq in range(chunk.first_seq, chunk.last_seq + 1):
+            fix_time = self.fix_times.pop(seq, None)
+            if fix_time is not None:
+                self.fix_latency.record(now - fix_time)
+
+
+# Returns a free local tcp port.
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# Waits until the given local tcp port accepts connections.
+def wait_for_port(port, timeout=10.0):
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Port %d not reachable." % port)
+
+
+# Returns the resident set size of this process in KiB.
+def current_rss():
+    with open("/proc/self/statm", "r") as fp:
+        return (int(fp.read().split()[1])
+                * os.sysconf("SC_PAGE_SIZE") // 1024)
+
+
+# Samples the peak resident set size while the benchmark runs.
+class RssSampler(threading.Thread):
+
+    def __init__(self, interval=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0
+        self.exit_event = threading.Event()
+
+    def run(self):
+        while not self.exit_event.is_set():
+            self.peak = max(self.peak, current_rss())
+            self.exit_event.wait(self.interval)
+
+    def exit(self):
+        self.exit_event.set()
+
+
+# Creates the settings of the logger for the benchmark.
+def create_global_data(args, work_dir, server_port, gpsd_port):
+    global_data = GlobalData()
+    global_data.server = "http://127.0.0.1:%d/" % server_port
+    global_data.username = "user"
+    global_data.password = "password"
+    global_data.secret = "bench"
+    global_data.device_name = "bench"
+    global_data.gpsd_port = gpsd_port
+    global_data.submission_interval = args.interval
+    global_data.gpslogging_interval = 0
+    global_data.submission_mode = args.mode
+    global_data.gps_chunk = args.chunk
+    global_data.inflight_chunks = args.inflight
+    global_data.compact_encoding = (args.encoding == "compact")
+    global_data.compression = args.compression
+    global_data.durability = args.durability
+    global_data.storage_format = args.storage_format
+    global_data.sampling = args.sampling
+    global_data.simplify_tolerance = args.simplify
+    global_data.lat_change = 0.0
+    global_data.lon_change = 0.0
+    global_data.alt_change = 0.0
+
+    global_data.gps_data = GpsBacklog(global_data.max_memory_points,
+                                      os.path.join(work_dir, "spill"))
+    global_data.journal = journal_class(global_data.storage_format)(
+                                    os.path.join(work_dir, "gps.journal"),
+                                    global_data.durability,
+                                    global_data.sync_stats)
+    global_data.journal.open()
+    return global_data
+
+
+def run(args, work_dir):
+    server_port = free_port()
+    gpsd_port = free_port()
+
+    server_cmd = [sys.executable, os.path.join(BENCH_DIR, "fake_server.py"),
+                  "--port", str(server_port),
+                  "--latency", str(args.latency),
+                  "--jitter", str(args.jitter),
+                  "--error-rate", str(args.error_rate)]
+    for outage in args.outage:
+        server_cmd.extend(["--outage", outage])
+    gpsd_cmd = [sys.executable, os.path.join(BENCH_DIR, "fake_gpsd.py"),
+                "--port", str(gpsd_port),
+                "--rate", str(args.rate)]
+    if args.replay is not None:
+        gpsd_cmd.extend(["--replay", args.replay])
+
+    server_log = open(os.path.join(work_dir, "server.log"), "w")
+    server = subprocess.Popen(server_cmd, stdout=server_log,
+                              stderr=subprocess.STDOUT)
+    gpsd = subprocess.Popen(gpsd_cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(server_port)
+        wait_for_port(gpsd_port)
+        results = run_logger(args, work_dir, server_port, gpsd_port)
+    finally:
+        gpsd.terminate()
+        server.terminate()
+        server.wait()
+        server_log.close()
+
+    # The statistics of the fake server are logged when it exits.
+    with open(os.path.join(work_dir, "server.log"), "r") as fp:
+        last_line = fp.read().strip().split("\n")[-1]
+    results["server"] = last_line.split(": ", 1)[-1]
+    results["work_dir"] = work_dir
+    return results
+
+
+def run_logger(args, work_dir, server_port, gpsd_port):
+    global_data = create_global_data(args, work_dir, server_port, gpsd_port)
+
+    fix_times = dict()
+    fix_latency = LatencyStats("fix_to_ack", max_samples=1000000)
+
+    rss = RssSampler()
+    rss.start()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.monotonic()
+
+    persistence = PersistenceWorker(global_data)
+    global_data.persistence = persistence
+    persistence.daemon = True
+    persistence.start()
+
+    global_data.scheduler = SubmitScheduler(global_data)
+    submitter = BenchSubmitter(global_data, fix_times, fix_latency)
+    submitter.daemon = True
+    submitter.start()
+
+    collector = BenchCollector(global_data, fix_times)
+    collector.daemon = True
+    collector.start()
+
+    # Ingest phase.
+    time.sleep(args.duration)
+    collector.exit()
+    collector.join()
+    ingest_time = time.monotonic() - start_time
+    backlog_at_stop = len(global_data.gps_data)
+
+    # Drain phase.
+    stop_time = time.monotonic()
+    drained = False
+    while time.monotonic() - stop_time < args.drain_timeout:
+        global_data.gps_lock.acquire()
+        backlog = len(global_data.gps_data)
+        global_data.gps_lock.release()
+        if backlog == 0:
+            drained = True
+            break
+        time.sleep(0.01)
+    drain_time = time.monotonic() - stop_time
+    http_stats = str(submitter.session)
+
+    submitter.exit()
+    submitter.join()
+    persistence.exit()
+    persistence.join()
+
+    wall_time = time.monotonic() - start_time
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    rss.exit()
+    cpu_time = ((usage_end.ru_utime - usage_start.ru_utime)
+                + (usage_end.ru_stime - usage_start.ru_stime))
+
+    return {"rate": args.rate,
+            "duration": args.duration,
+            "mode": args.mode,
+            "fixes_received": collector.num_received,
+            "fixes_stored": collector.num_accepted,
+            "fixes_per_sec": collector.num_received / ingest_time,
+            "stored_per_sec": collector.num_accepted / ingest_time,
+            "acked": fix_latency.count,
+            "latency_p50_ms": fix_latency.percentile(50) * 1000.0,
+            "latency_p95_ms": fix_latency.percentile(95) * 1000.0,
+            "latency_p99_ms": fix_latency.percentile(99) * 1000.0,
+            "latency_max_ms": fix_latency.percentile(100) * 1000.0,
+            "backlog_at_stop": backlog_at_stop,
+            "drained": drained,
+            "drain_time_sec": drain_time,
+            "cpu_sec": cpu_time,
+            "cpu_percent": cpu_time / wall_time * 100.0,
+            "peak_rss_kib": max(rss.peak, usage_end.ru_maxrss),
+            "http": http_stats,
+            "commit": str(global_data.commit_stats)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                        description="End-to-end benchmark of the logger.")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="Fixes per second of the fake gpsd (1 - 50).")
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="Seconds of collecting gps data.")
+    parser.add_argument("--replay", default=None, metavar="FILE",
+                        help="Replay a recording of gpsd reports instead "
+                        + "of the synthetic track.")
+    parser.add_argument("--mode", choices=["interval", "live"],
+                        default="interval")
+    parser.add_argument("--interval", type=int, default=5,
+                        help="Submission interval in seconds.")
+    parser.add_argument("--chunk", type=int, default=100)
+    parser.add_argument("--inflight", type=int, default=1)
+    parser.add_argument("--encoding", choices=["legacy", "compact"],
+                        default="legacy")
+    parser.add_argument("--compression", choices=["none", "gzip", "deflate"],
+                        default="none")
+    parser.add_argument("--durability", choices=["always", "group", "none"],
+                        default="group")
+    parser.add_argument("--storage-format", choices=["json", "binary"],
+                        default="json")
+    parser.add_argument("--sampling", choices=["fixed", "adaptive"],
+                        default="fixed")
+    parser.add_argument("--simplify", type=float, default=0.0,
+                        help="Simplification tolerance in metres.")
+    parser.add_argument("--latency", type=float, default=50.0,
+                        help="Mean latency of the fake server in ms.")
+    parser.add_argument("--jitter", type=float, default=10.0,
+                        help="Standard deviation of the latency in ms.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of requests answered with an error.")
+    parser.add_argument("--outage", action="append", default=[],
+                        metavar="START:DURATION",
+                        help="Outage of the fake server (in seconds).")
+    parser.add_argument("--drain-timeout", type=float, default=120.0,
+                        help="Maximal seconds to wait for the backlog to "
+                        + "be drained.")
+    parser.add_argument("--json", default=None, metavar="FILE",
+                        help="Write the results as json into the file.")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Log to the console instead of the log file "
+                        + "in the work directory.")
+    args = parser.parse_args()
+
+    if not 1.0 <= args.rate <= 50.0:
+        parser.error("The rate has to be between 1 and 50 Hz.")
+
+    # Journal, spill segments and logs of the run.
+    work_dir = tempfile.mkdtemp(prefix="chasr-bench-")
+    if args.verbose:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+    else:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                            filename=os.path.join(work_dir, "chasr.log"),
+                            level=logging.INFO)
+
+    results = run(args, work_dir)
+
+    for key, value in results.items():
+        if type(value) == float:
+            print("%-16s %.3f" % (key, value))
+        else:
+            print("%-16s %s" % (key, value))
+    if args.json is not None:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,12 +15,34 @@ import json
 import time
 import re
 import signal
+import argparse
+import copy
 from lib import GlobalData
 from lib import DataSubmitter
 from lib import DataCollector
+from lib import journal_class
+from lib import convert_journal
+from lib import GpsBacklog
+from lib import JournalCompactor
+from lib import Durability
+from lib import Compression
+from lib import PersistenceWorker
+from lib import SubmitScheduler
+from lib import TimedLock
+from lib import FleetSubmitter
+from lib import FleetCollector
+from lib import TrackImporter
+from lib import MetricsExporter
+from lib import register_backlog_metrics
+from lib import SamplingProfiler
+from lib import dump_threads
+from lib import remove_old_files
 
 submitter = None
 collector = None
+compactor = None
+profiler = None
+persistence = None
 
 # Function creates a path location for the given user input.
 def make_path(input_location):
@@ -33,74 +55,327 @@ def make_path(input_location):
     # Assume we have a given relative path.
     return os.path.dirname(os.path.abspath(__file__)) + "/" + input_location
 
-# Function parses the gps data and stores it.
-def parse_gps(global_data, data):
-    if not data:
-        return
-    gps_data = json.loads(data)
+# Precompiled check for a stored gps value: 1 to 14 characters
+# consisting of digits and at most one dot.
+gps_value_pattern = re.compile(r'(?=[0-9.]{1,14}\Z)[0-9]*\.?[0-9]*\Z')
+
+# Precompiled check for a stored gps value that can be negative (latitude
+# in the southern, longitude in the western hemisphere and altitude below
+# sea level): the same with an optional leading minus and at least one digit.
+signed_gps_value_pattern = re.compile(
+                    r'(?=[-0-9.]{1,14}\Z)(?=-?\.?[0-9])-?[0-9]*\.?[0-9]*\Z')
+
+# Allowed names of the devices of a fleet (also used as directory name).
+device_name_pattern = re.compile(r'[A-Za-z0-9_.-]+\Z')
+
+# Function checks if a stored gps position is valid.
+def check_gps(data):
+    if type(data) != dict:
+        return False
+    if type(data.get("utctime")) != int:
+        return False
+    for key in ("lat", "lon", "alt"):
+        value = data.get(key)
+        if (type(value) != str
+           or signed_gps_value_pattern.match(value) is None):
+            return False
+    value = data.get("speed")
+    if type(value) != str or gps_value_pattern.match(value) is None:
+        return False
+    return True
+
+# Function streams the gps data of an old tempfile (a json array of
+# positions) and yields all valid positions. Positions are decoded one by one
+# without loading the whole file. If the file is truncated (e.g., because
+# of a power loss), all positions before the truncated tail are recovered.
+# Corrupt positions are skipped up to the start of the next position.
+def parse_gps(fp, read_size=65536):
 
     file_name = os.path.basename(__file__)
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
 
-    to_remove = list()
-    for data in gps_data:
-        if type(data["utctime"]) != int:
-            logging.error("[%s] Stored position corrupt. Removing it."
-                          % file_name)
-            to_remove.append(data)
-            continue
-        skip = False
-        for key in ["lat", "lon", "alt", "speed"]:
-            if type(data[key]) != str:
-                logging.error("[%s] Stored position corrupt. Removing it."
-                              % file_name)
-                to_remove.append(data)
-                skip = True
-                break
-            if len(data[key]) > 14:
-                logging.error("[%s] Stored position corrupt. Removing it."
-                              % file_name)
-                to_remove.append(data)
-                skip = True
-                break
-            if not bool(re.match(r'^[0-9.]+$', data[key])):
-                logging.error("[%s] Stored position corrupt. Removing it."
-                              % file_name)
-                to_remove.append(data)
-                skip = True
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+    while True:
+
+        # Skip whitespace and separators.
+        while pos < len(buf) and (buf[pos] in whitespace
+                                  or (started and buf[pos] == ",")):
+            pos += 1
+
+        # Read more data if the buffer is exhausted.
+        if pos >= len(buf):
+            if eof:
                 break
-            if sum(c == "." for c in data[key]) > 1:
+            buf = buf[pos:] + fp.read(read_size)
+            pos = 0
+            eof = (len(buf) == 0)
+            continue
+
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("Tempfile does not contain a json array.")
+            started = True
+            pos += 1
+            continue
+
+        if buf[pos] == "]":
+            return
+
+        try:
+            data, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+
+            # Positions are flat json objects. If the next position starts
+            # in the buffer, the current one is corrupt and not just
+            # incomplete.
+            next_pos = buf.find("{", pos + 1)
+            if next_pos != -1:
                 logging.error("[%s] Stored position corrupt. Removing it."
                               % file_name)
-                to_remove.append(data)
-                skip = True
-                break
-        if skip:
+                pos = next_pos
+                continue
+
+            chunk = fp.read(read_size)
+            if not chunk:
+                logging.warning("[%s] Stored positions truncated. "
+                                % file_name
+                                + "Ignoring truncated tail.")
+                return
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        if not check_gps(data):
+            logging.error("[%s] Stored position corrupt. Removing it."
+                          % file_name)
             continue
 
-    # Remove corrupt data.
-    for data in to_remove:
-        gps_data.remove(data)
+        yield data
 
-    global_data.gps_lock.acquire()
-    global_data.gps_data = gps_data
-    global_data.gps_lock.release()
+        # Drop the decoded part of the buffer.
+        if pos > read_size:
+            buf = buf[pos:]
+            pos = 0
+
+    if started:
+        logging.warning("[%s] Stored positions truncated. "
+                        % file_name
+                        + "Ignoring truncated tail.")
 
 # Signal handler to gracefully shutdown the client.
 def sigterm_handler(signum, frame):
-    global collector, submitter
+    global collector, submitter, compactor
     if collector:
         collector.exit()
 
     if submitter:
         submitter.exit()
 
+    if compactor:
+        compactor.exit()
+
+# Signal handler to start and stop the sampling profiler.
+def sigusr1_handler(signum, frame):
+    global profiler, global_data
+    if profiler is not None and profiler.is_alive():
+        profiler.exit()
+        return
+    profiler = SamplingProfiler(global_data)
+    # set thread to daemon
+    # => threads terminates when main thread terminates
+    profiler.daemon = True
+    profiler.start()
+
+# Signal handler to dump the stacks of all threads and the timers of the
+# hot paths.
+def sigusr2_handler(signum, frame):
+    global submitter, global_data, devices
+    file_name = os.path.basename(__file__)
+    stats = [global_data.commit_stats, global_data.sync_stats]
+    if devices:
+        for device in devices:
+            stats.append(device.gps_lock)
+            stats.append("%s: %s" % (device.device_name, device.gps_data))
+    else:
+        stats.append(global_data.gps_lock)
+        stats.append(global_data.gps_data)
+    if submitter:
+        stats.append(submitter.session)
+
+    prefix = "chasr-stacks-"
+    location = os.path.join(global_data.profile_dir,
+                            prefix + time.strftime("%Y%m%d-%H%M%S") + ".txt")
+    try:
+        dump_threads(location, stats, global_data.metrics)
+        remove_old_files(global_data.profile_dir, prefix, ".txt",
+                         global_data.profile_keep_files)
+    except:
+        logging.exception("[%s] Can not dump threads" % file_name)
+        return
+    logging.info("[%s] Threads dumped to %s." % (file_name, location))
+
+
+# Function creates the backlog of the given gps data, opens its journal
+# (converting it if the storage format was changed) and replays the
+# stored gps data.
+def load_gps_data(global_data):
+    file_name = os.path.basename(__file__)
+
+    # Create backlog for the gps data.
+    try:
+        global_data.gps_data = GpsBacklog(global_data.max_memory_points,
+                                          global_data.spill_dir)
+    except:
+        logging.exception("[%s]: Can not create spill directory (%s)"
+                          % (file_name, global_data.spill_dir))
+        sys.exit(1)
+
+    # Migrate the journal if the storage format was changed.
+    if global_data.storage_format == "binary":
+        old_journal_file = global_data.journal_file
+        global_data.journal_file = global_data.binary_journal_file
+    else:
+        old_journal_file = global_data.binary_journal_file
+    if (os.path.exists(old_journal_file)
+       and not os.path.exists(global_data.journal_file)):
+        try:
+            if os.path.getsize(old_journal_file) > 0:
+                convert_journal(old_journal_file,
+                                global_data.journal_file,
+                                global_data.storage_format,
+                                check_gps)
+            os.remove(old_journal_file)
+        except:
+            logging.exception("[%s]: Can not migrate journal (%s)"
+                              % (file_name, old_journal_file))
+            sys.exit(1)
+
+    # Replay journal with stored gps data.
+    global_data.journal = journal_class(global_data.storage_format)(
+                                            global_data.journal_file,
+                                            global_data.durability,
+                                            global_data.sync_stats)
+    try:
+        global_data.gps_data.extend(global_data.journal.replay(check_gps))
+    except:
+        logging.exception("[%s]: Can not replay journal (%s)"
+                          % (file_name, global_data.journal_file))
+        sys.exit(1)
+
+# Function creates the settings of a device of the fleet from its config
+# section ([device:<name>]). All settings not given in the section are taken
+# from the given global settings.
+def create_device(config, section, global_data):
+    device = copy.copy(global_data)
+    device.device_name = section[len("device:"):]
+    if not device_name_pattern.match(device.device_name):
+        raise ValueError("Illegal device name '%s'." % device.device_name)
+
+    device.secret = config.get(section, "secret",
+                               fallback=global_data.secret)
+    if device.secret is None:
+        raise ValueError("No secret for device '%s'." % device.device_name)
+    device.gpsd_host = config.get(section, "gpsdhost",
+                                  fallback=global_data.gpsd_host)
+    device.gpsd_port = config.getint(section, "gpsdport",
+                                     fallback=global_data.gpsd_port)
+
+    # Every device stores its gps data in its own directory.
+    storage_dir = make_path(config.get(section, "storagedir",
+                                       fallback="config/devices/"
+                                       + device.device_name))
+    os.makedirs(storage_dir, exist_ok=True)
+    device.journal_file = os.path.join(storage_dir, "gps.journal")
+    device.binary_journal_file = os.path.join(storage_dir, "gps.bin")
+    device.spill_dir = os.path.join(storage_dir, "spill")
+
+    device.gps_lock = TimedLock("gps_lock_" + device.device_name,
+                                *global_data.gps_lock_histograms())
+    device.live_submitter = None
+    return device
+
+# Function converts a journal into the given storage format.
+def convert(src_file, dst_file, storage_format):
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=logging.INFO)
+    try:
+        num = convert_journal(src_file, dst_file, storage_format, check_gps)
+    except Exception as e:
+        print("Could not convert journal.")
+        print(e)
+        sys.exit(1)
+    print("Converted %d gps positions into %s (%s)."
+          % (num, dst_file, storage_format))
+    sys.exit(0)
+
+# Function imports the given NMEA logs and GPX files and exits.
+def import_tracks(global_data, file_locations, restart):
+    file_name = os.path.basename(__file__)
+
+    # Show the progress on the console as well.
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    logging.getLogger().addHandler(console)
+    logging.getLogger().setLevel(min(logging.getLogger().level,
+                                     logging.INFO))
+
+    importer = TrackImporter(global_data, global_data.import_dir, check_gps)
+    success = True
+    try:
+        for file_location in file_locations:
+            if not importer.import_file(file_location, restart):
+                logging.error("[%s] Import of %s failed. Run the import "
+                              % (file_name, file_location)
+                              + "again to resume it.")
+                success = False
+                break
+    except:
+        logging.exception("[%s] Import failed." % file_name)
+        success = False
+    finally:
+        importer.close()
+    sys.exit(0 if success else 1)
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="ChasR Linux Logger")
+    parser.add_argument("--convert", nargs=2, metavar=("SRC", "DST"),
+                        help="Convert the journal SRC into the journal DST "
+                        + "and exit.")
+    parser.add_argument("--format", choices=["json", "binary"],
+                        default="binary",
+                        help="Storage format of the converted journal "
+                        + "(default: binary).")
+    parser.add_argument("--import", nargs="+", metavar="FILE",
+                        dest="import_files",
+                        help="Upload the tracks of the given NMEA logs or "
+                        + "GPX files and exit. An aborted import is "
+                        + "resumed when it is started again.")
+    parser.add_argument("--device", metavar="NAME",
+                        help="Device of the fleet the imported tracks "
+                        + "belong to.")
+    parser.add_argument("--restart", action="store_true",
+                        help="Import the files from the beginning, even if "
+                        + "they were (partially) imported before.")
+    args = parser.parse_args()
+
+    if args.convert:
+        convert(args.convert[0], args.convert[1], args.format)
+
     # Parse logging settings from config file.
     config = None
     file_name = os.path.basename(__file__)
     global_data = GlobalData()
     global_data.tempfile = make_path(global_data.tempfile)
+    global_data.journal_file = make_path(global_data.journal_file)
+    global_data.binary_journal_file = make_path(
+                                            global_data.binary_journal_file)
+    global_data.spill_dir = make_path(global_data.spill_dir)
+    global_data.import_dir = make_path(global_data.import_dir)
     try:
         config = configparser.RawConfigParser(allow_no_value=False)
         config.read([make_path("config/config.conf")])
@@ -125,63 +400,351 @@ if __name__ == '__main__':
         logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', 
             datefmt='%m/%d/%Y %H:%M:%S', filename=logfile, level=loglevel)
 
+        # Profiles are written next to the log file.
+        global_data.profile_dir = os.path.dirname(os.path.abspath(logfile))
+
     except Exception as e:
         print("Could not parse configuration file.")
         print(e)
         sys.exit(1)
 
+    # In fleet mode, every device has its own config section and the
+    # [gps] section holds the settings shared by all devices.
+    device_sections = [x for x in config.sections()
+                       if x.startswith("device:")]
+
     # Parse settings from config file.
     try:
         global_data.server = config.get("server", "location")
         global_data.username = config.get("server", "username")
         global_data.password = config.get("server", "password")
-        global_data.secret = config.get("server", "secret")
-        global_data.device_name = config.get("gps", "name")
+        if device_sections:
+            global_data.secret = config.get("server", "secret",
+                                            fallback=None)
+        else:
+            global_data.secret = config.get("server", "secret")
+        global_data.connect_timeout = config.getfloat(
+                                            "server",
+                                            "connecttimeout",
+                                            fallback=global_data.connect_timeout)
+        global_data.read_timeout = config.getfloat(
+                                            "server",
+                                            "readtimeout",
+                                            fallback=global_data.read_timeout)
+        global_data.pool_size = config.getint("server",
+                                              "poolsize",
+                                              fallback=global_data.pool_size)
+        encoding = config.get("server", "encoding", fallback="legacy")
+        if encoding not in ["legacy", "compact"]:
+            raise ValueError("No valid encoding in config file.")
+        global_data.compact_encoding = (encoding == "compact")
+        compression = config.get("server", "compression",
+                                 fallback=global_data.compression).lower()
+        if compression not in [Compression.NONE,
+                               Compression.GZIP,
+                               Compression.DEFLATE]:
+            raise ValueError("No valid compression in config file.")
+        global_data.compression = compression
+        if not device_sections:
+            global_data.device_name = config.get("gps", "name")
+        global_data.gpsd_host = config.get("gps", "gpsdhost",
+                                           fallback=global_data.gpsd_host)
+        global_data.gpsd_port = config.getint("gps", "gpsdport",
+                                              fallback=global_data.gpsd_port)
         global_data.submission_interval = config.getint("gps",
                                                         "submissioninterval")
         global_data.gpslogging_interval = config.getint("gps",
                                                         "gpslogginginterval")
-        global_data.sync_always = config.getboolean("gps", "syncalways")
-    except:
+        global_data.pipeline_depth = config.getint(
+                                            "gps",
+                                            "pipelinedepth",
+                                            fallback=global_data.pipeline_depth)
+        global_data.inflight_chunks = config.getint(
+                                            "gps",
+                                            "inflightchunks",
+                                            fallback=global_data.inflight_chunks)
+        global_data.crypto_processes = config.getint(
+                                            "gps",
+                                            "cryptoprocesses",
+                                            fallback=global_data.crypto_processes)
+        global_data.sync_always = config.getboolean("gps", "syncalways",
+                                                    fallback=False)
+
+        # Old configurations only know the "syncalways" option.
+        if global_data.sync_always:
+            default_durability = Durability.ALWAYS
+        else:
+            default_durability = Durability.NONE
+        durability = config.get("gps", "durability",
+                                fallback=default_durability).lower()
+        if durability not in [Durability.ALWAYS,
+                              Durability.GROUP,
+                              Durability.NONE]:
+            raise ValueError("No valid durability in config file.")
+        global_data.durability = durability
+        global_data.group_commit_ms = config.getint(
+                                            "gps",
+                                            "groupcommitms",
+                                            fallback=global_data.group_commit_ms)
+        global_data.commit_window_ms = config.getint(
+                                            "gps",
+                                            "commitwindowms",
+                                            fallback=global_data.commit_window_ms)
+        global_data.commit_batch_size = config.getint(
+                                            "gps",
+                                            "commitbatchsize",
+                                            fallback=global_data.commit_batch_size)
+        global_data.max_memory_points = config.getint(
+                                            "gps",
+                                            "maxmemorypoints",
+                                            fallback=global_data.max_memory_points)
+        if config.has_option("gps", "spilldir"):
+            global_data.spill_dir = make_path(config.get("gps", "spilldir"))
+        global_data.submit_max_backoff = config.getint(
+                                        "gps",
+                                        "maxbackoff",
+                                        fallback=global_data.submit_max_backoff)
+        global_data.breaker_timeout = config.getint(
+                                        "gps",
+                                        "breakertimeout",
+                                        fallback=global_data.breaker_timeout)
+        global_data.early_submit_points = config.getint(
+                                        "gps",
+                                        "earlysubmitpoints",
+                                        fallback=global_data.early_submit_points)
+        submission_mode = config.get("gps", "submissionmode",
+                                     fallback=global_data.submission_mode)
+        if submission_mode not in ["interval", "live"]:
+            raise ValueError("No valid submission mode in config file.")
+        global_data.submission_mode = submission_mode
+        global_data.live_window_ms = config.getint(
+                                        "gps",
+                                        "livewindowms",
+                                        fallback=global_data.live_window_ms)
+        sampling = config.get("gps", "sampling",
+                              fallback=global_data.sampling)
+        if sampling not in ["fixed", "adaptive"]:
+            raise ValueError("No valid sampling in config file.")
+        global_data.sampling = sampling
+        global_data.sample_min_distance = config.getfloat(
+                                    "gps",
+                                    "samplemindistance",
+                                    fallback=global_data.sample_min_distance)
+        global_data.sample_max_distance = config.getfloat(
+                                    "gps",
+                                    "samplemaxdistance",
+                                    fallback=global_data.sample_max_distance)
+        global_data.sample_heading_change = config.getfloat(
+                                    "gps",
+                                    "sampleheadingchange",
+                                    fallback=global_data.sample_heading_change)
+        global_data.sample_max_interval = config.getfloat(
+                                    "gps",
+                                    "samplemaxinterval",
+                                    fallback=global_data.sample_max_interval)
+        global_data.simplify_tolerance = config.getfloat(
+                                    "gps",
+                                    "simplifytolerance",
+                                    fallback=global_data.simplify_tolerance)
+        drain_order = config.get("gps", "drainorder",
+                                 fallback=global_data.drain_order)
+        if drain_order not in ["oldest", "newest"]:
+            raise ValueError("No valid drain order in config file.")
+        global_data.drain_order = drain_order
+        global_data.recent_points = config.getint(
+                                        "gps",
+                                        "recentpoints",
+                                        fallback=global_data.recent_points)
+        global_data.history_share = config.getfloat(
+                                        "gps",
+                                        "historyshare",
+                                        fallback=global_data.history_share)
+        storage_format = config.get("gps", "storageformat",
+                                    fallback=global_data.storage_format)
+        journal_class(storage_format)
+        global_data.storage_format = storage_format
+
+    # Do not start with partially parsed settings.
+    except Exception as e:
         logging.exception("[%s] Failed parsing config file" % file_name)
+        print("Could not parse configuration file.")
+        print(e)
+        sys.exit(1)
 
-    # Check temp file exists.
-    if not os.path.exists(global_data.tempfile):
-        # Create new file if not exists.
+    # Parse metrics settings.
+    try:
+        textfile = config.get("metrics", "textfile", fallback="")
+        if textfile:
+            global_data.metrics_textfile = make_path(textfile)
+        global_data.metrics_interval = config.getint(
+                                        "metrics",
+                                        "interval",
+                                        fallback=global_data.metrics_interval)
+        global_data.metrics_http_address = config.get(
+                                    "metrics",
+                                    "httpaddress",
+                                    fallback=global_data.metrics_http_address)
+        global_data.metrics_http_port = config.getint(
+                                    "metrics",
+                                    "httpport",
+                                    fallback=global_data.metrics_http_port)
+    except:
+        logging.exception("[%s] Failed parsing metrics settings"
+                          % file_name)
+
+    # Parse profiling settings.
+    try:
+        global_data.profile_interval_ms = config.getint(
+                                    "profiling",
+                                    "intervalms",
+                                    fallback=global_data.profile_interval_ms)
+        global_data.profile_max_duration = config.getint(
+                                    "profiling",
+                                    "maxduration",
+                                    fallback=global_data.profile_max_duration)
+        global_data.profile_max_size = config.getint(
+                                    "profiling",
+                                    "maxsize",
+                                    fallback=global_data.profile_max_size)
+        global_data.profile_keep_files = config.getint(
+                                    "profiling",
+                                    "keepfiles",
+                                    fallback=global_data.profile_keep_files)
+    except:
+        logging.exception("[%s] Failed parsing profiling settings"
+                          % file_name)
+
+    # Import track files of a device.
+    if args.import_files:
+        import_data = global_data
+        if device_sections:
+            if ("device:%s" % args.device) not in device_sections:
+                print("Import in fleet mode needs the device (--device).")
+                sys.exit(1)
+            import_data = create_device(config,
+                                        "device:%s" % args.device,
+                                        global_data)
+        import_tracks(import_data, args.import_files, args.restart)
+
+    # Fleet mode: one config section per device.
+    devices = list()
+    if device_sections:
         try:
-            with open(global_data.tempfile, 'w') as fp:
-                pass
+            for section in device_sections:
+                devices.append(create_device(config, section, global_data))
         except:
-            logging.exception("[%s]: Can not create tempfile (%s)"
-                              % (file_name, global_data.tempfile))
+            logging.exception("[%s] Failed parsing device sections"
+                              % file_name)
             sys.exit(1)
+        if (global_data.submission_mode == "live"
+           or global_data.drain_order == "newest"):
+            logging.warning("[%s] Live submission and newest-first drain "
+                            % file_name
+                            + "are not supported in fleet mode. "
+                            + "Ignoring them.")
+        for device in devices:
+            load_gps_data(device)
 
-    # Parse stored gps data.
     else:
-        try:
-            with open(global_data.tempfile, 'r') as fp:
-                parse_gps(global_data, fp.read())
-        except:
-            logging.exception("[%s]: Can not parse tempfile (%s)"
-                              % (file_name, global_data.tempfile))
-            sys.exit(1)
+        load_gps_data(global_data)
+
+        # Migrate gps data of an old tempfile into the journal.
+        if os.path.exists(global_data.tempfile):
+            try:
+                with open(global_data.tempfile, 'r') as fp:
+                    for data in parse_gps(fp):
+                        global_data.journal.append(data)
+                        global_data.gps_data.append(data)
+                os.remove(global_data.tempfile)
+            except:
+                logging.exception("[%s]: Can not migrate tempfile (%s)"
+                                  % (file_name, global_data.tempfile))
+                sys.exit(1)
+
+    persistence = PersistenceWorker(global_data)
+    global_data.persistence = persistence
+    # set thread to daemon
+    # => threads terminates when main thread terminates
+    persistence.daemon = True
+    persistence.start()
 
-    submitter = DataSubmitter(global_data)
+    global_data.scheduler = SubmitScheduler(global_data)
+
+    if devices:
+        for device in devices:
+            device.persistence = persistence.writer(device.journal)
+            device.scheduler = global_data.scheduler
+        compactor = JournalCompactor([x.journal for x in devices])
+    else:
+        compactor = JournalCompactor(global_data.journal)
+    # set thread to daemon
+    # => threads terminates when main thread terminates
+    compactor.daemon = True
+    compactor.start()
+
+    if devices:
+        submitter = FleetSubmitter(global_data, devices)
+    else:
+        submitter = DataSubmitter(global_data)
     # set thread to daemon
     # => threads terminates when main thread terminates
     submitter.daemon = True
     submitter.start()
-    
-    collector = DataCollector(global_data)
+
+    if devices:
+        collector = FleetCollector(global_data,
+                                   [DataCollector(x) for x in devices])
+    else:
+        collector = DataCollector(global_data)
     # set thread to daemon
     # => threads terminates when main thread terminates
     collector.daemon = True
     collector.start()
 
+    # Export the metrics if a text file or an http endpoint is configured.
+    exporter = None
+    if (global_data.metrics_textfile is not None
+       or global_data.metrics_http_port > 0):
+        register_backlog_metrics(global_data.metrics,
+                                 devices if devices else [global_data])
+        exporter = MetricsExporter(global_data)
+        # set thread to daemon
+        # => threads terminates when main thread terminates
+        exporter.daemon = True
+        exporter.start()
+
     # Register sigterm handler to gracefully shutdown the server.
     signal.signal(signal.SIGTERM, sigterm_handler)
 
+    # Register handlers of the profiling hooks.
+    signal.signal(signal.SIGUSR1, sigusr1_handler)
+    signal.signal(signal.SIGUSR2, sigusr2_handler)
+
     # We never come back from this call.
     submitter.join()
     collector.join()
+
+    # Write all queued changes of the gps data before exiting.
+    persistence.exit()
+    persistence.join()
+
+    # Write the profile of a running profiler.
+    if profiler is not None and profiler.is_alive():
+        profiler.exit()
+        profiler.join()
+
+    # Write the final metrics.
+    if exporter is not None:
+        exporter.exit()
+        exporter.join()
+
+    if devices:
+        for device in devices:
+            logging.info("[%s] Device '%s' %s"
+                         % (file_name, device.device_name, device.gps_data))
+    else:
+        logging.info("[%s] %s" % (file_name, global_data.gps_data))
+        logging.info("[%s] %s" % (file_name, global_data.gps_lock))
+    logging.info("[%s] %s" % (file_name, global_data.commit_stats))
+    logging.info("[%s] %s" % (file_name, global_data.sync_stats))
     logging.info("[%s] Exiting." % file_name)
\ No newline at end of file
@@ -9,4 +9,21 @@
 
 from .globalData import GlobalData
 from .submitter import DataSubmitter
-from .collector import DataCollector
\ No newline at end of file
+from .collector import DataCollector
+from .journal import GpsJournal, BinaryGpsJournal, JournalCompactor
+from .journal import journal_class, convert_journal
+from .durability import Durability
+from .stats import TimingStats, TimedLock, LatencyStats
+from .persistence import PersistenceWorker, JournalWriter
+from .scheduler import SubmitScheduler
+from .backlog import GpsBacklog
+from .connection import SubmitSession
+from .encoding import ChunkEncoder, Compression
+from .crypto import CryptoEngine
+from .gpsd import GpsdClient
+from .fleet import FleetSubmitter, FleetCollector
+from .sampler import AdaptiveSampler, haversine
+from .simplify import TrajectorySimplifier
+from .importer import TrackImporter
+from .metrics import MetricsRegistry, MetricsExporter, register_backlog_metrics
+from .profiler import SamplingProfiler, dump_threads, remove_old_files
@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import array
+import bisect
+import collections
+import os
+from .spill import SpillSegment
+from .journal import AckSet
+
+
+# Backlog of collected gps positions that are not acknowledged by the
+# server yet. Every position carries a monotonically increasing sequence
+# number ("seq") which is used to acknowledge submitted positions.
+#
+# Positions are stored in parallel arrays (columns) instead of one dict per
+# position (about 48 instead of 600+ bytes per position). The string values
+# are converted to floats and back to strings when positions are read
+# (which happens when a chunk is encrypted). Values that do not survive this
+# conversion unchanged are kept as strings in a separate dict.
+#
+# If a maximal number of positions in memory is given, the oldest positions
+# are moved into memory-mapped segment files in the spill directory once
+# this number is exceeded. The memory usage then stays flat no matter how
+# long the device is offline. The segment files are only a cache, the
+# positions are persisted by the journal.
+#
+# Positions are usually acknowledged oldest first. Positions acknowledged
+# out of order (e.g., live positions sent ahead of the backlog) are
+# remembered in an ack set and skipped until all older positions are
+# acknowledged as well.
+class GpsBacklog(object):
+
+    def __init__(self, max_memory_points=0, spill_dir=None,
+                 segment_size=4096):
+        self.seqs = array.array("q")
+        self.utctimes = array.array("q")
+        self.lats = array.array("d")
+        self.lons = array.array("d")
+        self.alts = array.array("d")
+        self.speeds = array.array("d")
+
+        # Index of the oldest not acknowledged position in the arrays.
+        self.head = 0
+
+        # Original string values of positions (by sequence number) that
+        # can not be restored from their float values.
+        self.raw_values = dict()
+
+        # Segments of spilled positions (oldest first).
+        self.max_memory_points = max_memory_points
+        self.spill_dir = spill_dir
+        self.segment_size = segment_size
+        self.segments = collections.deque()
+        self.num_spilled = 0
+        self.segment_ctr = 0
+
+        # Positions acknowledged out of order and their number.
+        self.acked = AckSet()
+        self.num_acked = 0
+
+        # Remove segment files of a previous run.
+        if self.max_memory_points > 0:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            for file_name in os.listdir(self.spill_dir):
+                if file_name.endswith(".seg"):
+                    os.remove(os.path.join(self.spill_dir, file_name))
+
+    def __len__(self):
+        return self.num_spilled + len(self.seqs) - self.head - self.num_acked
+
+    def __iter__(self):
+        for segment in self.segments:
+            for element in segment.read_after(None, len(segment)):
+                if not self.acked.contains(element["seq"]):
+                    yield element
+        for i in range(self.head, len(self.seqs)):
+            if not self.acked.contains(self.seqs[i]):
+                yield self._get(i)
+
+    # Converts a stored string value to its float value. Returns None if
+    # the string can not be restored from the float value.
+    @staticmethod
+    def _to_float(value):
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        if repr(number) != value:
+            return None
+        return number
+
+    # Returns the position at the given array index as dict.
+    def _get(self, i):
+        seq = self.seqs[i]
+        raw = self.raw_values.get(seq)
+        if raw is not None:
+            lat, lon, alt, speed = raw
+        else:
+            lat = repr(self.lats[i])
+            lon = repr(self.lons[i])
+            alt = repr(self.alts[i])
+            speed = repr(self.speeds[i])
+        return {"lat": lat,
+                "lon": lon,
+                "alt": alt,
+                "speed": speed,
+                "utctime": self.utctimes[i],
+                "seq": seq}
+
+    # Appends a gps position. The sequence number has to be larger than
+    # the sequence numbers of all stored positions.
+    def append(self, element):
+        seq = element["seq"]
+        if len(self.seqs) > self.head and seq <= self.seqs[-1]:
+            raise ValueError("Sequence number %d is not increasing." % seq)
+
+        values = list()
+        for key in ("lat", "lon", "alt", "speed"):
+            values.append(self._to_float(element[key]))
+        if None in values:
+            self.raw_values[seq] = (element["lat"],
+                                    element["lon"],
+                                    element["alt"],
+                                    element["speed"])
+            values = [x if x is not None else 0.0 for x in values]
+
+        self.seqs.append(seq)
+        self.utctimes.append(element["utctime"])
+        self.lats.append(values[0])
+        self.lons.append(values[1])
+        self.alts.append(values[2])
+        self.speeds.append(values[3])
+
+        # Move oldest positions out of memory.
+        if (self.max_memory_points > 0
+           and len(self.seqs) - self.head > self.max_memory_points):
+            self._spill()
+
+    # Moves the oldest segment_size positions in memory into
+    # a segment file.
+    def _spill(self):
+        end = min(self.head + self.segment_size, len(self.seqs))
+        elements = [self._get(i) for i in range(self.head, end)]
+        path = os.path.join(self.spill_dir, "%d.seg" % self.segment_ctr)
+        self.segment_ctr += 1
+        self.segments.append(SpillSegment(path, elements))
+        self.num_spilled += len(elements)
+        self._drop_memory(end)
+
+    def extend(self, elements):
+        for element in elements:
+            self.append(element)
+
+    # Returns the oldest num gps positions.
+    def peek(self, num):
+        return self.peek_after(None, num)
+
+    # Returns the sequence number of the newest gps position
+    # (or None if the backlog is empty).
+    def last_seq(self):
+        if len(self.seqs) > self.head:
+            return self.seqs[-1]
+        if self.segments:
+            return self.segments[-1].last_seq
+        return None
+
+    # Returns the sequence number of the oldest stored gps position
+    # (or None if the backlog is empty).
+    def first_seq(self):
+        if self.segments:
+            return self.segments[0].head_seq()
+        if len(self.seqs) > self.head:
+            return self.seqs[self.head]
+        return None
+
+    # Returns the sequence numbers of the stored gps positions from
+    # first_seq to last_seq (inclusive).
+    def _seqs_in_range(self, first_seq, last_seq):
+        result = list()
+        for segment in self.segments:
+            if segment.last_seq < first_seq or segment.first_seq > last_seq:
+                continue
+            result.extend(segment.seqs_in_range(first_seq, last_seq))
+        start = bisect.bisect_left(self.seqs, first_seq, self.head)
+        end = bisect.bisect_right(self.seqs, last_seq, self.head)
+        result.extend(self.seqs[start:end])
+        return result
+
+    # Returns the oldest num not acknowledged gps positions with a sequence
+    # number larger than the given one (or the oldest positions if seq
+    # is None).
+    def peek_after(self, seq, num):
+        result = self._peek_after(seq, num)
+        if self.num_acked == 0:
+            return result
+
+        # Skip positions that were acknowledged out of order.
+        filtered = list()
+        while result:
+            filtered.extend(x for x in result
+                            if not self.acked.contains(x["seq"]))
+            if len(filtered) >= num:
+                break
+            result = self._peek_after(result[-1]["seq"], num - len(filtered))
+        return filtered[:num]
+
+    def _peek_after(self, seq, num):
+        result = list()
+
+        # Only the segment files containing the requested
+        # positions are read.
+        for segment in self.segments:
+            if seq is not None and segment.last_seq <= seq:
+                continue
+            result.extend(segment.read_after(seq, num - len(result)))
+            if len(result) >= num:
+                return result
+
+        if seq is None:
+            start = self.head
+        else:
+            start = bisect.bisect_right(self.seqs, seq, self.head)
+        end = min(start + num - len(result), len(self.seqs))
+        result.extend(self._get(i) for i in range(start, end))
+        return result
+
+    # Returns the newest num not acknowledged gps positions with a sequence
+    # number smaller or equal to the given one (ordered by sequence number).
+    def peek_before(self, seq, num):
+        result = list()
+
+        i = bisect.bisect_right(self.seqs, seq, self.head) - 1
+        while i >= self.head and len(result) < num:
+            if not self.acked.contains(self.seqs[i]):
+                result.append(self._get(i))
+            i -= 1
+        result.reverse()
+
+        for segment in reversed(self.segments):
+            if len(result) >= num:
+                break
+            if segment.first_seq > seq:
+                continue
+            cursor = min(seq, segment.last_seq)
+            while len(result) < num:
+                elements = segment.read_before(cursor, num - len(result))
+                if not elements:
+                    break
+                cursor = elements[0]["seq"] - 1
+                result[0:0] = [x for x in elements
+                               if not self.acked.contains(x["seq"])]
+
+        return result
+
+    # Removes all gps positions up to (and including) the given
+    # sequence number.
+    def ack(self, seq):
+        self._forget_acked(seq)
+
+        while self.segments and self.segments[0].last_seq <= seq:
+            segment = self.segments.popleft()
+            self.num_spilled -= len(segment)
+            segment.remove()
+        if self.segments and self.segments[0].first_seq <= seq:
+            segment = self.segments[0]
+            self.num_spilled -= len(segment)
+            segment.ack(seq)
+            self.num_spilled += len(segment)
+
+        self._drop_memory(bisect.bisect_right(self.seqs, seq, self.head))
+
+    # Removes the out of order acknowledgements up to (and including) the
+    # given sequence number (the positions are removed by a prefix ack).
+    def _forget_acked(self, seq):
+        firsts = self.acked.firsts
+        lasts = self.acked.lasts
+        while firsts and firsts[0] <= seq:
+            self.num_acked -= len(self._seqs_in_range(firsts[0],
+                                                      min(lasts[0], seq)))
+            if lasts[0] <= seq:
+                del firsts[0]
+                del lasts[0]
+            else:
+                firsts[0] = seq + 1
+
+    # Removes all gps positions from first_seq to last_seq (inclusive).
+    # Positions that are not the oldest ones are only marked as acknowledged
+    # until all older positions are acknowledged.
+    def ack_range(self, first_seq, last_seq):
+        oldest = self.first_seq()
+        if oldest is None:
+            return
+
+        if first_seq <= oldest:
+            self.ack(last_seq)
+
+            # Remove the positions acknowledged out of order that are
+            # the oldest ones now.
+            while self.acked.firsts:
+                oldest = self.first_seq()
+                if oldest is None or self.acked.firsts[0] > oldest:
+                    break
+                self.ack(self.acked.lasts[0])
+            return
+
+        for seq in self._seqs_in_range(first_seq, last_seq):
+            if not self.acked.contains(seq):
+                self.num_acked += 1
+        self.acked.add(first_seq, last_seq)
+
+    # Removes all positions in memory before the given array index.
+    def _drop_memory(self, new_head):
+        if self.raw_values:
+            for i in range(self.head, new_head):
+                self.raw_values.pop(self.seqs[i], None)
+        self.head = new_head
+
+        # Drop acknowledged positions from the arrays once they make up
+        # the larger part of them (amortized O(1) per position).
+        if self.head >= 1024 and self.head * 2 >= len(self.seqs):
+            for column in (self.seqs, self.utctimes, self.lats,
+                           self.lons, self.alts, self.speeds):
+                del column[:self.head]
+            self.head = 0
+
+    # Returns the number of bytes of memory used by the positions
+    # in memory.
+    def memory_bytes(self):
+        size = 0
+        for column in (self.seqs, self.utctimes, self.lats,
+                       self.lons, self.alts, self.speeds):
+            size += column.buffer_info()[1] * column.itemsize
+        # Roughly the size of a dict entry with a tuple of four strings.
+        size += len(self.raw_values) * 200
+        return size
+
+    # Returns the number of bytes of memory used per position in memory.
+    def bytes_per_point(self):
+        num = len(self.seqs) - self.head
+        if num == 0:
+            return 0.0
+        return float(self.memory_bytes()) / num
+
+    def __str__(self):
+        return ("backlog: %d positions (%d spilled to disk), "
+                % (len(self), self.num_spilled)
+                + "%.1f bytes per position in memory"
+                % self.bytes_per_point())
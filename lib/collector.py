@@ -12,10 +12,8 @@ import threading
 import os
 import time
 import json
-import ctypes
-import datetime
-import calendar
-from gps3 import gps3
+from .gpsd import GpsdClient, extract_time, parse_time
+from .sampler import AdaptiveSampler
 
 
 class DataCollector(threading.Thread):
@@ -34,8 +32,10 @@ class DataCollector(threading.Thread):
 
         # Data needed for collecting gps data.
         self.gpslogging_interval = self.global_data.gpslogging_interval
-        self.max_failed_gps_pos = self.global_data.max_failed_gps_pos
-        self.gps_collect_sleep_time = self.global_data.gps_collect_sleep_time
+        self.gpsd_host = self.global_data.gpsd_host
+        self.gpsd_port = self.global_data.gpsd_port
+        self.gpsd_timeout = self.global_data.gpsd_timeout
+        self.gpsd_max_backoff = self.global_data.gpsd_max_backoff
 
         # Gps data.
         self.gps_data = self.global_data.gps_data
@@ -46,16 +46,61 @@ class DataCollector(threading.Thread):
         self.lon_change = self.global_data.lon_change
         self.alt_change = self.global_data.alt_change
 
-        # Data needed for storing gps data in file.
-        self.tempfile = self.global_data.tempfile
-        self.sync_always = self.global_data.sync_always
-        if self.sync_always:
-            self.libc = ctypes.CDLL("libc.so.6")
-        else:
-            self.libc = None
+        # Adaptive sampler that replaces the tolerance for position change
+        # (None if the positions are sampled with the fixed tolerance).
+        self.sampler = None
+        if self.global_data.sampling == "adaptive":
+            self.sampler = AdaptiveSampler(
+                                    self.global_data.sample_min_distance,
+                                    self.global_data.sample_max_distance,
+                                    self.global_data.sample_heading_change,
+                                    self.global_data.sample_max_interval)
+
+        # Number of received fixes and number of stored positions.
+        self.num_received = 0
+        self.num_accepted = 0
+
+        # Metrics of the received fixes and of the connection to gpsd.
+        metrics = self.global_data.metrics
+        self.received_counter = metrics.counter(
+                                    "chasr_fixes_received_total",
+                                    "Number of TPV reports received "
+                                    + "from gpsd.")
+        self.accepted_counter = metrics.counter(
+                                    "chasr_fixes_accepted_total",
+                                    "Number of stored gps positions.")
+        dropped_counter = metrics.counter(
+                                    "chasr_fixes_dropped_total",
+                                    "Number of TPV reports not stored.",
+                                    ["reason"])
+        self.dropped_counters = dict()
+        for reason in ["invalid", "interval", "sampling", "unchanged"]:
+            self.dropped_counters[reason] = dropped_counter.labels(reason)
+        self.connect_counter = metrics.counter(
+                                    "chasr_gpsd_connects_total",
+                                    "Number of connection attempts to gpsd.",
+                                    ["result"])
+        self.reset_counter = metrics.counter(
+                                    "chasr_gpsd_resets_total",
+                                    "Number of connections to gpsd reset "
+                                    + "because of errors or missing data.")
+
+        # Journal used for storing gps data in file and the thread
+        # writing into it.
+        self.journal = self.global_data.journal
+        self.persistence = self.global_data.persistence
+
+        # Scheduler of the submitter that is woken up early
+        # if the backlog grows too large.
+        self.scheduler = self.global_data.scheduler
+
+        # Thread of the submitter that submits new positions right away
+        # (only in live mode).
+        self.live_submitter = self.global_data.live_submitter
 
         # Flag indicates if thread should exit.
         self.exit_flag = False
+        self.exit_event = threading.Event()
 
         # Last gps data.
         self.last_utc_time = 0
@@ -63,164 +108,246 @@ class DataCollector(threading.Thread):
         self.last_lon = 0
         self.last_alt = 0
 
+    # Processes a raw report of gpsd. Only TPV reports are decoded, and
+    # only if the logging interval since the last collected position is
+    # reached.
+    def process_report(self, report):
+
+        # Skip all other report classes without decoding them.
+        if b'"TPV"' not in report:
+            return
+        self.num_received += 1
+        self.received_counter.inc()
+
+        try:
+            fix_time = extract_time(report)
+        except:
+            logging.warning("[%s]: Parsing gps time failed."
+                            % self.file_name)
+            self.dropped_counters["invalid"].inc()
+            return
+        if fix_time is None:
+            self.dropped_counters["invalid"].inc()
+            return
+
+        # Check if the interval in which we would like
+        # to collect gps data is reached.
+        if (fix_time - self.last_utc_time) < self.gpslogging_interval:
+            self.dropped_counters["interval"].inc()
+            return
+
+        try:
+            tpv = json.loads(report.decode("utf-8"))
+        except:
+            logging.warning("[%s]: Unpacking gps data failed."
+                            % self.file_name)
+            self.dropped_counters["invalid"].inc()
+            return
+
+        if type(tpv) != dict or tpv.get("class") != "TPV":
+            self.dropped_counters["invalid"].inc()
+            return
+
+        self.process_tpv(tpv, fix_time)
+
+    # Returns the gps position to store for a TPV (time-position-velocity)
+    # report of gpsd or None if the report is invalid or the position is
+    # skipped (logging interval, sampling or tolerance for position change).
+    # The returned position becomes the last collected position.
+    def build_element(self, tpv, fix_time=None):
+
+        # Check if received data is valid.
+        is_valid = True
+        is_valid &= (type(tpv.get("lat")) == float)
+        is_valid &= (type(tpv.get("lon")) == float)
+        is_valid &= (type(tpv.get("alt")) == float)
+        is_valid &= (type(tpv.get("speed")) == float)
+        is_valid &= (type(tpv.get("time")) == str)
+        if not is_valid:
+            self.dropped_counters["invalid"].inc()
+            return
+
+        # Convert time string to utc timestamp.
+        time_str = tpv["time"]
+        if fix_time is None:
+            fix_time = parse_time(time_str)
+
+        # Check if the interval in which we would like
+        # to collect gps data is reached.
+        if (fix_time - self.last_utc_time) < self.gpslogging_interval:
+            self.dropped_counters["interval"].inc()
+            return
+
+        # Positions are stored with a precision of seconds.
+        utc_time = int(fix_time)
+
+        if self.sampler is not None:
+            heading = tpv.get("track")
+            if type(heading) != float:
+                heading = None
+            if not self.sampler.accept(fix_time, tpv["lat"], tpv["lon"],
+                                       tpv["speed"], heading):
+                logging.debug("[%s]: Position skipped by sampler."
+                              % self.file_name)
+                self.dropped_counters["sampling"].inc()
+                return
+
+        else:
+            # Get difference of current gps data to the last data.
+            diff_lat = self.last_lat - tpv["lat"]
+            diff_lon = self.last_lon - tpv["lon"]
+            diff_alt = self.last_alt - tpv["alt"]
+
+            # Check if we recognize the gps data as changed position.
+            no_change = True
+            no_change &= self.lat_change*(-1) <= diff_lat
+            no_change &= diff_lat <= self.lat_change
+            no_change &= self.lon_change*(-1) <= diff_lon
+            no_change &= diff_lon <= self.lon_change
+            no_change &= self.alt_change*(-1) <= diff_alt
+            no_change &= diff_alt <= self.alt_change
+            if no_change:
+                logging.debug("[%s]: Position has not changed."
+                              % self.file_name)
+                self.dropped_counters["unchanged"].inc()
+                return
+
+        # Allow only a precision of 14 characters for the
+        # gps data (usual precision is 12 characters).
+        lat = str(tpv["lat"])[:14]
+        lon = str(tpv["lon"])[:14]
+        alt = str(tpv["alt"])[:14]
+        speed = str(tpv["speed"])[:14]
+
+        logging.debug("[%s]: Lat: %s Lon: %s "
+                      % (self.file_name, lat, lon)
+                      + "Alt: %s Speed: %s Time: %s"
+                      % (alt, speed, time_str))
+
+        element = {"lat": lat,
+                   "lon": lon,
+                   "alt": alt,
+                   "speed": speed,
+                   "utctime": utc_time}
+
+        # Set current gps data as last position we collected.
+        self.last_utc_time = fix_time
+        self.last_lat = tpv["lat"]
+        self.last_lon = tpv["lon"]
+        self.last_alt = tpv["alt"]
+
+        return element
+
+    # Processes a TPV (time-position-velocity) report of gpsd.
+    def process_tpv(self, tpv, fix_time=None):
+
+        element = self.build_element(tpv, fix_time)
+        if element is None:
+            return
+
+        # Append new gps position to gps data.
+        logging.debug("[%s]: Acquire lock." % self.file_name)
+        self.gps_lock.acquire()
+
+        self.journal.assign_seq(element)
+        self.gps_data.append(element)
+
+        # Queue gps position for writing it to the journal on storage.
+        self.persistence.append(element)
+        backlog_size = len(self.gps_data)
+
+        # Claim the position for the live submission before the lock is
+        # released, so a submission round can not send it as well.
+        if self.live_submitter is not None:
+            self.live_submitter.push(element)
+
+        logging.debug("[%s]: Release lock." % self.file_name)
+        self.gps_lock.release()
+
+        self.scheduler.backlog_changed(backlog_size)
+
+        self.num_accepted += 1
+        self.accepted_counter.inc()
+
     def run(self):
 
         logging.info("[%s]: Starting collector thread with %s sec interval."
                      % (self.file_name, self.gpslogging_interval))
 
+        gpsd = GpsdClient(self.gpsd_host, self.gpsd_port)
+        backoff = 1.0
         while True:
 
             # Should we exit thread?
             if self.exit_flag:
+                logging.info("[%s]: %s" % (self.file_name,
+                                           self.sampling_stats()))
                 logging.info("[%s]: Exiting collector thread."
                              % self.file_name)
+                gpsd.close()
                 return
 
             logging.info("[%s]: Connect to gpsd."
                          % self.file_name)
             try:
-                gps_socket = gps3.GPSDSocket()
-                data_stream = gps3.DataStream()
-                gps_socket.connect()
-                gps_socket.watch()
+                gpsd.connect()
             except:
                 logging.exception("[%s]: Failed to establish connection "
                                   % self.file_name
-                                  + "to gpsd.")
-                time.sleep(1)
+                                  + "to gpsd. Retrying in %.0f sec."
+                                  % backoff)
+                self.connect_counter.labels("failed").inc()
+                self.exit_event.wait(backoff)
+                backoff = min(backoff * 2, self.gpsd_max_backoff)
                 continue
 
-            failed_ctr = 0
-            for new_data in gps_socket:
+            self.connect_counter.labels("ok").inc()
+            last_report_time = time.monotonic()
+            while True:
 
                 # Should we exit thread?
                 if self.exit_flag:
-                    logging.info("[%s]: Exiting collector thread."
-                                 % self.file_name)
-                    return
-
-                if failed_ctr > self.max_failed_gps_pos:
-                    logging.error("[%s]: Failed %d times to collect gps data. "
-                                  % (self.file_name, failed_ctr)
-                                  + "Resetting connection to gpsd.")
-                    gps_socket.close()
                     break
 
-                # Check if we received data.
-                if new_data:
-                    try:
-                        data_stream.unpack(new_data)
-                    except:
-                        logging.warning("[%s]: Unpacking gps data failed."
-                                        % self.file_name)
-                        continue
-
-                    # Reset failed counter.
-                    failed_ctr = 0
-
-                    # Check if received data is valid.
-                    is_valid = True
-                    is_valid &= (type(data_stream.TPV["lat"]) == float)
-                    is_valid &= (type(data_stream.TPV["lon"]) == float)
-                    is_valid &= (type(data_stream.TPV["alt"]) == float)
-                    is_valid &= (type(data_stream.TPV["speed"]) == float)
-                    is_valid &= (type(data_stream.TPV["time"]) == str)
-                    if is_valid:
-
-                        # When time string has following form:
-                        # 2018-02-01T20:01:18.500Z
-                        # we have to remove the ".500Z"
-                        time_str = data_stream.TPV["time"]
-                        if time_str.find(".") != -1:
-                            time_str = time_str[0:time_str.find(".")]
-
-                        # Convert time string to utc timestamp.
-                        dt_obj = datetime.datetime.strptime(
-                                                        time_str,
-                                                        "%Y-%m-%dT%H:%M:%S")
-                        utc_time = calendar.timegm(dt_obj.timetuple())
-
-                        # Check if the interval in which we would like
-                        # to collect gps data is reached.
-                        if ((utc_time - self.last_utc_time)
-                           < self.gpslogging_interval):
-                            continue
-
-                        # Get difference of current gps data to the last data.
-                        diff_lat = self.last_lat - data_stream.TPV["lat"]
-                        diff_lon = self.last_lon - data_stream.TPV["lon"]
-                        diff_alt = self.last_alt - data_stream.TPV["alt"]
-
-                        # Check if we recognize the gps data as changed
-                        # position.
-                        no_change = True
-                        no_change &= self.lat_change*(-1) <= diff_lat
-                        no_change &= diff_lat <= self.lat_change
-                        no_change &= self.lon_change*(-1) <= diff_lon
-                        no_change &= diff_lon <= self.lon_change
-                        no_change &= self.alt_change*(-1) <= diff_alt
-                        no_change &= diff_alt <= self.alt_change
-                        if no_change:
-                            logging.debug("[%s]: Position has not changed."
-                                          % self.file_name)
-                            continue
-
-                        # Allow only a precision of 14 characters for the
-                        # gps data (usual precision is 12 characters).
-                        lat = str(data_stream.TPV["lat"])[:14]
-                        lon = str(data_stream.TPV["lon"])[:14]
-                        alt = str(data_stream.TPV["alt"])[:14]
-                        speed = str(data_stream.TPV["speed"])[:14]
-
-                        logging.debug("[%s]: Lat: %s Lon: %s "
-                                      % (self.file_name, lat, lon)
-                                      + "Alt: %s Speed: %s Time: %s"
-                                      % (alt, speed, time_str))
-
-                        element = {"lat": lat,
-                                   "lon": lon,
-                                   "alt": alt,
-                                   "speed": speed,
-                                   "utctime": utc_time}
-
-                        # Append new gps position to gps data.
-                        logging.debug("[%s]: Acquire lock." % self.file_name)
-                        self.gps_lock.acquire()
-                        self.gps_data.append(element)
-
-                        # Wirte data to storage.
-                        try:
-                            with open(self.tempfile, 'w') as fp:
-                                fp.write(json.dumps(self.gps_data))
-
-                            # Sync filesystem to force writing on storage
-                            if self.sync_always:
-                                self.libc.sync()
-                        except:
-                            logging.exception("[%s]: Can not write into "
-                                              % self.file_name
-                                              + "tempfile (%s)."
-                                              % self.tempfile)
-
-                        logging.debug("[%s]: Release lock." % self.file_name)
-                        self.gps_lock.release()
-
-                        # Set current gps data as last position we
-                        # collected.
-                        self.last_utc_time = utc_time
-                        self.last_lat = data_stream.TPV["lat"]
-                        self.last_lon = data_stream.TPV["lon"]
-                        self.last_alt = data_stream.TPV["alt"]
-
-                # We got no data from gpsd.
-                else:
-                    failed_ctr += 1
-
-                # Sleep to give gpsd time to give us the next position.
-                time.sleep(self.gps_collect_sleep_time)
+                # Wait for the next reports of gpsd.
+                try:
+                    reports = gpsd.read_reports(1.0)
+                except:
+                    logging.exception("[%s]: Failed to read from gpsd."
+                                      % self.file_name)
+                    self.reset_counter.inc()
+                    break
+
+                if not reports:
+                    if (time.monotonic() - last_report_time
+                       > self.gpsd_timeout):
+                        logging.error("[%s]: Got no gps data for %.0f sec. "
+                                      % (self.file_name, self.gpsd_timeout)
+                                      + "Resetting connection to gpsd.")
+                        self.reset_counter.inc()
+                        break
+                    continue
+
+                last_report_time = time.monotonic()
+                backoff = 1.0
+
+                for report in reports:
+                    self.process_report(report)
+
+            gpsd.close()
+
+    # Returns the number of received fixes, stored positions and
+    # the ratio of them.
+    def sampling_stats(self):
+        ratio = 0.0
+        if self.num_received > 0:
+            ratio = float(self.num_accepted) / self.num_received
+        return ("sampling: received=%d accepted=%d ratio=%.3f"
+                % (self.num_received, self.num_accepted, ratio))
 
     # Sets exit flag.
     def exit(self):
         logging.debug("[%s]: Telling collector thread to exit."
                       % self.file_name)
-        self.exit_flag = True
\ No newline at end of file
+        self.exit_flag = True
+        self.exit_event.set()
\ No newline at end of file
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import requests
+import requests.adapters
+import logging
+import os
+import time
+from .stats import TimingStats
+
+
+# Long-lived http session to the ChasR server. Connections are kept alive and
+# reused for all requests in order to not pay for a new TCP and TLS
+# handshake for every submitted chunk.
+class SubmitSession(object):
+
+    def __init__(self, server, verify_cert, connect_timeout, read_timeout,
+                 pool_size):
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.server = server
+        self.verify_cert = verify_cert
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                     pool_maxsize=pool_size,
+                                                     pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+        # Measured latencies of the requests.
+        self.latency_stats = TimingStats("http")
+
+        # Number of sent request body bytes and gps positions.
+        self.bytes_sent = 0
+        self.points_sent = 0
+
+    # Sends the given data as POST request to the server and
+    # returns the response. The number of gps positions contained in
+    # the data is only used for the statistics.
+    def post(self, data, headers=None, num_points=0):
+        if type(data) == bytes:
+            self.bytes_sent += len(data)
+        self.points_sent += num_points
+        start = time.monotonic()
+        r = self.session.post(self.server,
+                              verify=self.verify_cert,
+                              data=data,
+                              headers=headers,
+                              timeout=self.timeout)
+        duration = time.monotonic() - start
+        self.latency_stats.record(duration)
+        logging.debug("[%s]: POST request took %.2f ms."
+                      % (self.file_name, duration * 1000.0))
+        return r
+
+    # Returns the ratio of requests that reused an existing connection.
+    def reuse_ratio(self):
+        num_connections = 0
+        num_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_connections += pool.num_connections
+            num_requests += pool.num_requests
+        if num_requests == 0:
+            return 0.0
+        return 1.0 - (float(num_connections) / num_requests)
+
+    def close(self):
+        self.session.close()
+
+    # Returns the number of request body bytes sent per gps position.
+    def bytes_per_point(self):
+        if self.points_sent == 0:
+            return 0.0
+        return float(self.bytes_sent) / self.points_sent
+
+    def __str__(self):
+        return ("%s reuse_ratio=%.2f bytes_sent=%d bytes_per_point=%.1f"
+                % (self.latency_stats, self.reuse_ratio(),
+                   self.bytes_sent, self.bytes_per_point()))
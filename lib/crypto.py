@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import os
+import binascii
+import hashlib
+import hmac
+import multiprocessing
+import concurrent.futures
+from Crypto.Cipher import AES
+
+
+# Creates the encryption key from the secret.
+def derive_key(secret):
+    sha256 = hashlib.sha256()
+    sha256.update(secret.encode("utf-8"))
+    return sha256.digest()
+
+
+# Pads data in PKCS#7.
+def pad_data(data: bytes):
+    padding = 16 - (len(data) % 16)
+    return data + bytes([padding]) * padding
+
+
+# Encrypts gps data with AES in CBC mode.
+def encrypt_data(key: bytes, iv: bytes, data: str):
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    return cipher.encrypt(pad_data(data.encode("utf-8")))
+
+
+# Creates auth tag (HMAC-SHA256) for data.
+def get_auth_tag(key, device_name, utctime, lat, lon, alt, speed):
+
+    mac = hmac.new(key, digestmod=hashlib.sha256)
+
+    # Convert to bytes if string.
+    if type(device_name) == str:
+        device_name = device_name.encode("utf-8")
+    if type(lat) == str:
+        lat = lat.encode("utf-8")
+    if type(lon) == str:
+        lon = lon.encode("utf-8")
+    if type(alt) == str:
+        alt = alt.encode("utf-8")
+    if type(speed) == str:
+        speed = speed.encode("utf-8")
+    utctime = str(utctime).encode("utf-8")
+
+    mac.update(device_name)
+    mac.update(utctime)
+    mac.update(lat)
+    mac.update(lon)
+    mac.update(alt)
+    mac.update(speed)
+    return mac.hexdigest()
+
+
+# Builds the data points sent to the server for the given gps positions.
+# The AES and HMAC objects are only created once for the whole batch:
+# every field fits into a single AES block, and CBC encryption of a single
+# block equals ECB encryption of the block xored with the IV. The output
+# is identical to encrypting every field with encrypt_data() and creating
+# the auth tag with get_auth_tag().
+def build_data_points(key, device_name, gps_data, ivs=None):
+
+    ecb = AES.new(key, AES.MODE_ECB)
+    base_mac = hmac.new(key, digestmod=hashlib.sha256)
+    base_mac.update(device_name.encode("utf-8"))
+
+    data_points = list()
+    for i, data in enumerate(gps_data):
+
+        # Get IV for encryption.
+        if ivs is None:
+            iv = os.urandom(16)
+        else:
+            iv = ivs[i]
+        iv_int = int.from_bytes(iv, "big")
+
+        values = list()
+        for key_name in ["lat", "lon", "alt", "speed"]:
+            values.append(data[key_name].encode("utf-8"))
+
+        # Create auth tag for data.
+        mac = base_mac.copy()
+        mac.update(str(data["utctime"]).encode("utf-8"))
+        for value in values:
+            mac.update(value)
+
+        # Encrypt gps data.
+        enc_values = list()
+        if all(len(value) < 16 for value in values):
+            blocks = b"".join(
+                (int.from_bytes(pad_data(value), "big")
+                 ^ iv_int).to_bytes(16, "big")
+                for value in values)
+            enc_blocks = ecb.encrypt(blocks)
+            for pos in range(0, 64, 16):
+                enc_values.append(enc_blocks[pos:pos+16])
+        else:
+            for value in values:
+                cipher = AES.new(key, AES.MODE_CBC, iv)
+                enc_values.append(cipher.encrypt(pad_data(value)))
+
+        data_point = dict()
+        data_point["iv"] = binascii.hexlify(iv).decode("utf-8")
+        data_point["device_name"] = device_name
+        data_point["utctime"] = data["utctime"]
+        data_point["authtag"] = mac.hexdigest()
+        data_point["lat"] = binascii.hexlify(enc_values[0]).decode("utf-8")
+        data_point["lon"] = binascii.hexlify(enc_values[1]).decode("utf-8")
+        data_point["alt"] = binascii.hexlify(enc_values[2]).decode("utf-8")
+        data_point["speed"] = binascii.hexlify(enc_values[3]).decode("utf-8")
+        data_points.append(data_point)
+
+    return data_points
+
+
+# Batch crypto engine that encrypts blocks of gps positions. Large batches
+# are split over a pool of processes (one per core), small batches are
+# processed in the calling thread.
+class CryptoEngine(object):
+
+    def __init__(self, key, device_name, num_processes=0, min_batch=1000):
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.key = key
+        self.device_name = device_name
+        self.min_batch = min_batch
+
+        if num_processes <= 0:
+            num_processes = os.cpu_count() or 1
+        self.num_processes = num_processes
+
+        # Process pool is created when it is needed for the first time.
+        self.pool = None
+
+    def _get_pool(self):
+        if self.pool is None:
+
+            # Do not fork the multi-threaded process.
+            try:
+                context = multiprocessing.get_context("forkserver")
+            except ValueError:
+                context = multiprocessing.get_context("spawn")
+
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                                            max_workers=self.num_processes,
+                                            mp_context=context)
+        return self.pool
+
+    # Builds the data points for the given gps positions.
+    def build_data_points(self, gps_data):
+
+        if self.num_processes <= 1 or len(gps_data) < self.min_batch:
+            return build_data_points(self.key, self.device_name, gps_data)
+
+        slice_size = -(-len(gps_data) // self.num_processes)
+        futures = list()
+        try:
+            pool = self._get_pool()
+            for pos in range(0, len(gps_data), slice_size):
+                futures.append(pool.submit(build_data_points,
+                                           self.key,
+                                           self.device_name,
+                                           gps_data[pos:pos+slice_size]))
+            data_points = list()
+            for future in futures:
+                data_points.extend(future.result())
+            return data_points
+
+        except Exception:
+            logging.exception("[%s]: Process pool failed. "
+                              % self.file_name
+                              + "Encrypting in thread.")
+            self.close()
+            self.num_processes = 1
+            return build_data_points(self.key, self.device_name, gps_data)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
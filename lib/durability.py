@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import os
+import time
+
+
+class Durability:
+    # Sync the written file after every write.
+    ALWAYS = "always"
+    # Sync the written file at most every group commit interval.
+    GROUP = "group"
+    # Leave it to the OS when the data is written to storage.
+    NONE = "none"
+
+
+# Syncs the data of the given file descriptor to storage and records the
+# needed time in the given stats.
+def sync_fd(fd, stats=None):
+    start = time.monotonic()
+    os.fdatasync(fd)
+    duration = time.monotonic() - start
+    if stats is not None:
+        stats.record(duration)
+    logging.debug("[%s]: fdatasync took %.2f ms."
+                  % (os.path.basename(__file__), duration * 1000.0))
+
+
+# Syncs the directory entry of the given file to storage. Needed to make
+# a created or renamed file survive a power loss.
+def sync_directory(path, stats=None):
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        start = time.monotonic()
+        os.fsync(dir_fd)
+        if stats is not None:
+            stats.record(time.monotonic() - start)
+    finally:
+        os.close(dir_fd)
+
+
+# Atomically replaces the given file with the given data. The data is written
+# to a temporary file that is synced and renamed to the target afterwards,
+# so the target contains either the old or the new data after a power loss.
+# The temporary file is unique per process, so concurrent writers do not
+# interfere.
+def atomic_write(path, data, stats=None):
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, 'wb') as fp:
+        fp.write(data)
+        fp.flush()
+        sync_fd(fp.fileno(), stats)
+    atomic_replace(temp_path, path, stats)
+
+
+# Atomically moves the already synced file temp_path to path and syncs
+# the directory entry.
+def atomic_replace(temp_path, path, stats=None):
+    os.replace(temp_path, path)
+    sync_directory(path, stats)
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import threading
+import os
+import time
+import json
+import gzip
+import zlib
+import urllib.parse
+
+
+# Fields of a data point in the order of the compact encoding.
+COMPACT_FIELDS = ["iv", "utctime", "authtag", "lat", "lon", "alt", "speed"]
+
+
+class Compression:
+    NONE = "none"
+    GZIP = "gzip"
+    DEFLATE = "deflate"
+
+
+# Compresses the given request body with the given content coding.
+def compress_body(body, compression):
+    if compression == Compression.GZIP:
+        return gzip.compress(body, 6)
+    elif compression == Compression.DEFLATE:
+        return zlib.compress(body, 6)
+    return body
+
+
+# Decompresses the given request body with the given content coding.
+def decompress_body(body, compression):
+    if compression == Compression.GZIP:
+        return gzip.decompress(body)
+    elif compression == Compression.DEFLATE:
+        return zlib.decompress(body)
+    return body
+
+
+# Encodes the data points of a chunk into the "gps_data" field.
+#
+# The legacy encoding is a json list with one object per data point. The
+# compact encoding sends the device name once and every data point as a
+# list of its values:
+# {"device_name": "...", "fields": ["iv", "utctime", ...],
+#  "points": [["...", 1517515278, ...], ...]}
+# It is marked by the additional field "encoding" = "compact". A chunk
+# with data points of several devices (fleet mode) sends the list of
+# device names instead and the index of the device name as
+# additional field "device" of every data point.
+def encode_gps_data(data_points, compact):
+    if not compact:
+        return json.dumps(data_points)
+
+    device_names = list()
+    device_indexes = dict()
+    for data_point in data_points:
+        if data_point["device_name"] not in device_indexes:
+            device_indexes[data_point["device_name"]] = len(device_names)
+            device_names.append(data_point["device_name"])
+
+    if len(device_names) <= 1:
+        points = [[x[key] for key in COMPACT_FIELDS] for x in data_points]
+        return json.dumps({"device_name": (device_names or [""])[0],
+                           "fields": COMPACT_FIELDS,
+                           "points": points},
+                          separators=(",", ":"))
+
+    points = [[x[key] for key in COMPACT_FIELDS]
+              + [device_indexes[x["device_name"]]]
+              for x in data_points]
+    return json.dumps({"device_names": device_names,
+                       "fields": COMPACT_FIELDS + ["device"],
+                       "points": points},
+                      separators=(",", ":"))
+
+
+# Decodes the "gps_data" field of both encodings into a list of
+# data points.
+def decode_gps_data(gps_data, compact):
+    if not compact:
+        return json.loads(gps_data)
+    chunk = json.loads(gps_data)
+    data_points = list()
+    for values in chunk["points"]:
+        data_point = dict(zip(chunk["fields"], values))
+        if "device_names" in chunk:
+            data_point["device_name"] = \
+                chunk["device_names"][data_point.pop("device")]
+        else:
+            data_point["device_name"] = chunk["device_name"]
+        data_points.append(data_point)
+    return data_points
+
+
+# Encoder of the request bodies sent to the server. Uses the configured
+# encoding and compression until the server rejects them, then falls back
+# to the request format every server understands (first without
+# compression, then with the legacy encoding). The configured format is
+# tried again reprobe_interval seconds after the last fallback (e.g., after
+# the server was updated).
+class ChunkEncoder(object):
+
+    def __init__(self, compact=False, compression=Compression.NONE,
+                 reprobe_interval=3600):
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.compact = compact
+        self.compression = compression
+        self.lock = threading.Lock()
+
+        # Configured request format and time of the last fallback.
+        self.configured = (compact, compression)
+        self.reprobe_interval = reprobe_interval
+        self.fallback_time = None
+
+    # Returns the current request format.
+    def state(self):
+        return (self.compact, self.compression)
+
+    # Returns the POST fields for the given data points.
+    def encode_payload(self, username, password, data_points):
+        payload = {"user": username,
+                   "password": password,
+                   "gps_data": encode_gps_data(data_points,
+                                               self.compact)}
+        if self.compact:
+            payload["encoding"] = "compact"
+        return payload
+
+    # Returns True if the given payload was encoded with the current
+    # encoding.
+    def is_current(self, payload):
+        return ("encoding" in payload) == self.compact
+
+    # Returns the (compressed) request body and its headers for the
+    # given POST fields.
+    def encode_body(self, payload):
+        body = urllib.parse.urlencode(payload).encode("ascii")
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if self.compression != Compression.NONE:
+            body = compress_body(body, self.compression)
+            headers["Content-Encoding"] = self.compression
+        return body, headers
+
+    # Returns the request body and its headers for the given data points
+    # in the legacy format (understood by every server).
+    def encode_legacy(self, username, password, data_points):
+        payload = {"user": username,
+                   "password": password,
+                   "gps_data": encode_gps_data(data_points, False)}
+        body = urllib.parse.urlencode(payload).encode("ascii")
+        return body, {"Content-Type": "application/x-www-form-urlencoded"}
+
+    # Falls back to the legacy format without compression after the server
+    # accepted a request in it that it rejected in the given format.
+    def fallback_legacy(self, state):
+        with self.lock:
+
+            # Another request already fell back.
+            if state != self.state():
+                return
+
+            logging.warning("[%s]: Server does not accept the configured "
+                            % self.file_name
+                            + "request format. Using legacy encoding "
+                            + "without compression.")
+            self.compact = False
+            self.compression = Compression.NONE
+            self.fallback_time = time.monotonic()
+
+    # Switches back to the configured request format if the last fallback
+    # is older than the reprobe interval.
+    def reprobe(self):
+        if self.fallback_time is None:
+            return
+        with self.lock:
+            if (self.fallback_time is None
+               or time.monotonic() - self.fallback_time
+               < self.reprobe_interval):
+                return
+            logging.info("[%s]: Trying the configured request format "
+                         % self.file_name
+                         + "again.")
+            self.compact, self.compression = self.configured
+            self.fallback_time = None
+
+    # Falls back to a more compatible request format after the server
+    # rejected a request sent in the given format. Returns True if the
+    # request should be sent again in the new format (False if the legacy
+    # format was rejected).
+    def fallback(self, state):
+        with self.lock:
+
+            # Another request already fell back.
+            if state != self.state():
+                return True
+
+            self.fallback_time = time.monotonic()
+            if self.compression != Compression.NONE:
+                logging.warning("[%s]: Server does not accept %s "
+                                % (self.file_name, self.compression)
+                                + "compressed requests. "
+                                + "Disabling compression.")
+                self.compression = Compression.NONE
+                return True
+            if self.compact:
+                logging.warning("[%s]: Server does not accept the compact "
+                                % self.file_name
+                                + "encoding. Using legacy encoding.")
+                self.compact = False
+                return True
+            return False
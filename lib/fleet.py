@@ -0,0 +1,381 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import threading
+import os
+import time
+import selectors
+import collections
+from .crypto import CryptoEngine, derive_key
+from .gpsd import GpsdClient
+from .submitter import DataSubmitter, ErrorCodes
+
+
+# Connection to the gpsd of one device in fleet mode.
+class GpsdSource(object):
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.client = GpsdClient(collector.gpsd_host,
+                                 collector.gpsd_port,
+                                 connect_timeout=1.0,
+                                 own_selector=False)
+        self.backoff = 1.0
+        self.next_connect = 0.0
+        self.last_report_time = 0.0
+
+    def connected(self):
+        return self.client.sock is not None
+
+
+# Thread that collects the gps data of all devices in fleet mode. The gpsd
+# connections of all devices are waited on with one selector, and the
+# reports are processed by the (not started) collector of the device.
+class FleetCollector(threading.Thread):
+
+    def __init__(self, global_data, collectors):
+
+        threading.Thread.__init__(self)
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.gpsd_timeout = global_data.gpsd_timeout
+        self.gpsd_max_backoff = global_data.gpsd_max_backoff
+
+        self.sources = [GpsdSource(x) for x in collectors]
+        self.selector = selectors.DefaultSelector()
+
+        metrics = global_data.metrics
+        self.connect_counter = metrics.counter(
+                                    "chasr_gpsd_connects_total",
+                                    "Number of connection attempts to gpsd.",
+                                    ["result"])
+        self.reset_counter = metrics.counter(
+                                    "chasr_gpsd_resets_total",
+                                    "Number of connections to gpsd reset "
+                                    + "because of errors or missing data.")
+
+        # Flag indicates if thread should exit.
+        self.exit_flag = False
+
+    def _connect(self, source):
+        try:
+            source.client.connect()
+        except:
+            logging.error("[%s]: Failed to establish connection to gpsd "
+                          % self.file_name
+                          + "of device '%s'. Retrying in %.0f sec."
+                          % (source.collector.global_data.device_name,
+                             source.backoff))
+            source.next_connect = time.monotonic() + source.backoff
+            source.backoff = min(source.backoff * 2, self.gpsd_max_backoff)
+            self.connect_counter.labels("failed").inc()
+            return
+        self.connect_counter.labels("ok").inc()
+        source.last_report_time = time.monotonic()
+        self.selector.register(source.client.sock,
+                               selectors.EVENT_READ,
+                               source)
+
+    def _disconnect(self, source):
+        if source.connected():
+            self.selector.unregister(source.client.sock)
+        source.client.close()
+        source.next_connect = time.monotonic() + source.backoff
+
+    # Connects the sources that are due and resets the connections
+    # that delivered no gps data for too long.
+    def _check_sources(self):
+        now = time.monotonic()
+        for source in self.sources:
+            if not source.connected():
+                if now >= source.next_connect:
+                    self._connect(source)
+            elif now - source.last_report_time > self.gpsd_timeout:
+                logging.error("[%s]: Got no gps data of device '%s' "
+                              % (self.file_name,
+                                 source.collector.global_data.device_name)
+                              + "for %.0f sec. Resetting connection."
+                              % self.gpsd_timeout)
+                self.reset_counter.inc()
+                self._disconnect(source)
+
+    def run(self):
+
+        logging.info("[%s]: Starting fleet collector thread for %d devices."
+                     % (self.file_name, len(self.sources)))
+
+        next_check = 0.0
+        while True:
+
+            # Should we exit thread?
+            if self.exit_flag:
+                for source in self.sources:
+                    logging.info("[%s]: Device '%s' %s"
+                                 % (self.file_name,
+                                    source.collector.global_data.device_name,
+                                    source.collector.sampling_stats()))
+                    self._disconnect(source)
+                self.selector.close()
+                logging.info("[%s]: Exiting fleet collector thread."
+                             % self.file_name)
+                return
+
+            # Checking the sources is O(devices),
+            # so do it at most once a second.
+            if time.monotonic() >= next_check:
+                self._check_sources()
+                next_check = time.monotonic() + 1.0
+
+            if not self.selector.get_map():
+                time.sleep(1.0)
+                continue
+
+            for key, _ in self.selector.select(1.0):
+                source = key.data
+                try:
+                    reports = source.client.read_available()
+                except:
+                    device_name = source.collector.global_data.device_name
+                    logging.exception("[%s]: Failed to read from gpsd of "
+                                      % self.file_name
+                                      + "device '%s'." % device_name)
+                    self.reset_counter.inc()
+                    self._disconnect(source)
+                    continue
+
+                if not reports:
+                    continue
+                source.last_report_time = time.monotonic()
+                source.backoff = 1.0
+
+                for report in reports:
+                    source.collector.process_report(report)
+
+    # Sets exit flag.
+    def exit(self):
+        logging.debug("[%s]: Telling fleet collector thread to exit."
+                      % self.file_name)
+        self.exit_flag = True
+
+
+# Chunk of gps positions of several devices. Every part holds the device,
+# its positions and the acknowledged range of sequence numbers.
+class FleetChunk(object):
+
+    def __init__(self, parts, payload, data_points):
+        self.parts = parts
+        self.payload = payload
+        self.data_points = data_points
+
+
+# Thread that submits the gps data of all devices in fleet mode over one
+# session. Chunks are filled with the positions of several devices (the
+# data points carry their device name), starting with a different device
+# every chunk so no device is starved.
+class FleetSubmitter(DataSubmitter):
+
+    def __init__(self, global_data, devices):
+
+        threading.Thread.__init__(self)
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self._init_common(global_data, global_data.pool_size)
+
+        self.devices = devices
+
+        # The gps data, the journal writer and the chunk builder of the
+        # single device submitter are not used, every device has its own
+        # gps data and journal writer and the chunks are built in the
+        # submitter thread.
+        self.gps_data = None
+        self.gps_lock = None
+        self.persistence = None
+        self.chunk_queue = None
+        self.builder = None
+
+        # One crypto engine per device (encrypting in the calling thread,
+        # the chunks of a fleet are small).
+        self.crypto_engines = dict()
+        for device in self.devices:
+            self.crypto_engines[device.device_name] = CryptoEngine(
+                                                derive_key(device.secret),
+                                                device.device_name,
+                                                1)
+
+        # Index of the device the next chunk starts with.
+        self.next_device = 0
+
+    # The submission rounds cover the gps data of all devices, so there is
+    # no single last sequence number of a round (see has_gps_data()).
+    def round_last_seq(self):
+        raise NotImplementedError("Fleet submitter uses has_gps_data().")
+
+    # Builds the next chunk of the submission round. The cursors hold the
+    # last sequence number put into a chunk and the limits the last
+    # sequence number of the round for each device. Returns None if all
+    # positions of the round are in chunks.
+    def build_fleet_chunk(self, cursors, limits):
+
+        num_devices = len(self.devices)
+        parts = list()
+        num_positions = 0
+        for i in range(num_devices):
+            if num_positions >= self.gps_chunk:
+                break
+            device = self.devices[(self.next_device + i) % num_devices]
+            if device.device_name not in limits:
+                continue
+
+            device.gps_lock.acquire()
+            positions = device.gps_data.peek_after(
+                                            cursors.get(device.device_name),
+                                            self.gps_chunk - num_positions)
+            device.gps_lock.release()
+
+            positions = [x for x in positions
+                         if x["seq"] <= limits[device.device_name]]
+            if not positions:
+                del limits[device.device_name]
+                continue
+
+            parts.append((device, positions))
+            num_positions += len(positions)
+            cursors[device.device_name] = positions[-1]["seq"]
+
+        self.next_device = (self.next_device + 1) % num_devices
+        if not parts:
+            return None
+
+        # Drop positions that do not change the shape of the tracks (the
+        # dropped positions are acknowledged with the chunk).
+        data_points = list()
+        num_dropped = 0
+        for device, positions in parts:
+            send_positions = positions
+            if self.simplifier is not None:
+                send_positions = self.simplifier.simplify(positions)
+                num_dropped += len(positions) - len(send_positions)
+
+            crypto = self.crypto_engines[device.device_name]
+            for data_point in self.build_data_points(crypto, send_positions):
+                if self.check_data_point(data_point):
+                    data_points.append(data_point)
+
+        payload = self.encoder.encode_payload(self.username,
+                                              self.password,
+                                              data_points)
+
+        if self.simplifier is not None and data_points:
+            self.simplifier.record(num_positions,
+                                   num_dropped,
+                                   float(len(payload["gps_data"]))
+                                   / len(data_points))
+        return FleetChunk([(device,
+                            positions[0]["seq"],
+                            positions[-1]["seq"])
+                           for device, positions in parts],
+                          payload,
+                          data_points)
+
+    # Removes the submitted gps positions of the given chunk from the gps
+    # data of the devices and marks them as acknowledged in their journals.
+    def ack_chunk(self, chunk):
+        for device, first_seq, last_seq in chunk.parts:
+            device.gps_lock.acquire()
+            device.gps_data.ack_range(first_seq, last_seq)
+            device.persistence.ack(first_seq, last_seq)
+            device.gps_lock.release()
+            self.submitted_counter.inc(last_seq - first_seq + 1)
+
+    # Returns True if any device has gps data to submit.
+    def has_gps_data(self):
+        for device in self.devices:
+            if len(device.gps_data) > 0:
+                return True
+        return False
+
+    # Submits the gps data of all devices that exists at the start of the
+    # round. Up to inflight_chunks chunks are sent simultaneously, but they
+    # are acknowledged in order. Returns the result code of the first failed
+    # chunk (None if it could not be submitted at all) or NO_ERROR.
+    def submit_gps_data(self):
+
+        limits = dict()
+        for device in self.devices:
+            device.gps_lock.acquire()
+            last_seq = device.gps_data.last_seq()
+            device.gps_lock.release()
+            if last_seq is not None:
+                limits[device.device_name] = last_seq
+        cursors = dict()
+
+        pending = collections.deque()
+        failed = False
+        result = ErrorCodes.NO_ERROR
+        while True:
+
+            # Fill the network stage with chunks.
+            while not failed and len(pending) < self.inflight_chunks:
+                try:
+                    chunk = self.build_fleet_chunk(cursors, limits)
+                except:
+                    logging.exception("[%s]: Failed to build chunk."
+                                      % self.file_name)
+                    chunk = None
+                if chunk is None:
+                    break
+                pending.append((chunk,
+                                self.executor.submit(self.send_chunk, chunk)))
+
+            if not pending:
+                break
+
+            chunk, future = pending.popleft()
+            code = future.result()
+            if failed:
+                continue
+
+            if code == ErrorCodes.NO_ERROR:
+                self.ack_chunk(chunk)
+            else:
+                failed = True
+                result = code
+
+        return result
+
+    def run(self):
+
+        logging.info("[%s]: Starting fleet submitter thread for %d devices "
+                     % (self.file_name, len(self.devices))
+                     + "with %s sec interval." % self.submission_interval)
+
+        while True:
+            # Wait until the scheduler starts the next submission round
+            # or tells the thread to exit.
+            if not self.scheduler.wait():
+                logging.info("[%s]: Exiting fleet submitter thread."
+                             % self.file_name)
+                logging.info("[%s]: %s" % (self.file_name, self.session))
+                if self.simplifier is not None:
+                    logging.info("[%s]: %s" % (self.file_name,
+                                               self.simplifier))
+                self.executor.shutdown(wait=False)
+                self.session.close()
+                return
+
+            if not self.has_gps_data():
+                self.scheduler.record_idle()
+                continue
+
+            self.scheduler.record_result(self.submit_gps_data())
@@ -7,19 +7,58 @@
 # 
 # Licensed under the GNU Affero General Public License, version 3.
 
-import threading
+from .stats import TimingStats, TimedLock, LatencyStats
+from .backlog import GpsBacklog
+from .metrics import MetricsRegistry
 
 
 class GlobalData(object):
 
     def __init__(self):
 
+        # Metrics of the process (counters and histograms). They are
+        # exported into a text file for the textfile collector of
+        # node_exporter every metrics_interval seconds (None disables it)
+        # and on a local http endpoint (port 0 disables it).
+        self.metrics = MetricsRegistry()
+        self.metrics_textfile = None
+        self.metrics_interval = 15
+        self.metrics_http_address = "127.0.0.1"
+        self.metrics_http_port = 0
+
+        # Settings of the sampling profiler started by SIGUSR1. Profiles and
+        # thread dumps (SIGUSR2) are written into profile_dir (the directory
+        # of the log file). Only the newest profile_keep_files profiles
+        # are kept.
+        self.profile_dir = "."
+        self.profile_interval_ms = 10
+        self.profile_max_duration = 60
+        self.profile_max_size = 1048576
+        self.profile_max_depth = 64
+        self.profile_keep_files = 5
+
         # Settings for ChasR server.
         self.username = None
         self.password = None
         self.server = None
         self.verify_cert = True
 
+        # Timeouts (in seconds) for connecting to the server and for
+        # waiting on its response and maximal number of pooled connections.
+        self.connect_timeout = 10.0
+        self.read_timeout = 30.0
+        self.pool_size = 2
+
+        # Request format: compact encoding of the gps data and compression
+        # of the request body ("none", "gzip" or "deflate"). Falls back to
+        # the legacy format if the server does not accept it.
+        self.compact_encoding = False
+        self.compression = "none"
+
+        # Seconds after a fallback to the legacy format until the
+        # configured request format is tried again.
+        self.encoding_reprobe_interval = 3600
+
         # Secret for gps data encryption.
         self.secret = None
 
@@ -30,24 +69,142 @@ class GlobalData(object):
         self.gpslogging_interval = None
         self.sync_always = None
 
-        self.gps_data = list()
-        self.gps_lock = threading.Semaphore(1)
+        # Durability level of the stored gps data
+        # ("always", "group" or "none") and the interval of group commits.
+        self.durability = "none"
+        self.group_commit_ms = 200
+
+        # Measured durations of syncs to storage.
+        self.sync_stats = TimingStats(
+                            "sync",
+                            self.metrics.histogram(
+                                "chasr_journal_sync_seconds",
+                                "Duration of the syncs of the journal."))
+
+        self.gps_data = GpsBacklog()
+
+        # Maximal number of gps positions kept in memory (0 = unlimited).
+        # Older positions are moved into segment files in the spill
+        # directory.
+        self.max_memory_points = 50000
+        self.spill_dir = "config/spill"
+        self.gps_lock = TimedLock("gps_lock", *self.gps_lock_histograms())
 
         # Max number of gps positions transfered simultaneously to the server.
         self.gps_chunk = 100
 
-        # Tempfile for gps data.
+        # Number of chunks that are built ahead of the submission and
+        # number of chunks that are sent to the server simultaneously.
+        self.pipeline_depth = 2
+        self.inflight_chunks = 1
+
+        # Number of processes used to encrypt large backlogs
+        # (0 = one per core) and number of gps positions encrypted at once.
+        self.crypto_processes = 0
+        self.crypto_batch = 2000
+
+        # Directory of the progress checkpoints of imported track files.
+        self.import_dir = "config/imports"
+
+        # Tempfile for gps data (only read to migrate old installations).
         self.tempfile = "config/gps.json"
 
-        # Number of failed gps collection attempts before resetting connection
-        # to gpsd.
-        self.max_failed_gps_pos = 20
+        # Journal for gps data and the thread writing into it. The storage
+        # format selects the json journal or the binary journal.
+        self.storage_format = "json"
+        self.journal_file = "config/gps.journal"
+        self.binary_journal_file = "config/gps.bin"
+        self.journal = None
+        self.persistence = None
+
+        # Scheduler of the submission rounds. Transient errors are retried
+        # with an exponential backoff of at most submit_max_backoff seconds,
+        # authentication and ACL errors suspend submissions for
+        # breaker_timeout seconds. A backlog of early_submit_points
+        # positions starts a round before the submission interval
+        # passed (0 disables it).
+        self.scheduler = None
+        self.submit_max_backoff = 600
+        self.breaker_timeout = 3600
+        self.early_submit_points = 1000
 
-        # Time to sleep after collecting a gps position.
-        self.gps_collect_sleep_time = 0.5
+        # Submission mode: "interval" submits the collected gps data every
+        # submission interval, "live" submits every new position right
+        # away (positions arriving within the live window are sent
+        # together) and drains the backlog in the background.
+        self.submission_mode = "interval"
+
+        # Maximal distance (in metres) of a dropped position to the
+        # simplified track of the submitted positions (0 disables the
+        # simplification).
+        self.simplify_tolerance = 0.0
+
+        # Order in which the backlog is submitted: "oldest" submits the
+        # oldest positions first, "newest" submits the newest recent_points
+        # positions first (newest first) while the older positions get
+        # history_share of the submitted chunks.
+        self.drain_order = "oldest"
+        self.recent_points = 500
+        self.history_share = 0.25
+
+        # Time window (in milliseconds) in which new positions are collected
+        # and submitted together in live mode.
+        self.live_window_ms = 200
+
+        # Thread submitting the new positions in live mode (None in
+        # interval mode). The collector hands new positions to it.
+        self.live_submitter = None
+
+        # Measured times from storing a gps position until the server
+        # acknowledged it.
+        self.fix_latency = LatencyStats("fix_to_ack")
+
+        # Time window (in milliseconds) and maximal number of changes
+        # that are written to the journal with a single group commit.
+        self.commit_window_ms = 50
+        self.commit_batch_size = 500
+
+        # Measured durations of the group commits.
+        self.commit_stats = TimingStats(
+                            "commit",
+                            self.metrics.histogram(
+                                "chasr_journal_commit_seconds",
+                                "Duration of the writes of changes into "
+                                + "the journal."))
+
+        # Location of gpsd.
+        self.gpsd_host = "127.0.0.1"
+        self.gpsd_port = 2947
+
+        # Number of seconds without any gps data before resetting
+        # the connection to gpsd.
+        self.gpsd_timeout = 10.0
+
+        # Maximal number of seconds to wait before reconnecting to gpsd.
+        self.gpsd_max_backoff = 30.0
+
+        # Sampling of the gps positions: "fixed" stores a position every
+        # gps logging interval if it changed more than the tolerance below,
+        # "adaptive" chooses the distance (in metres) between stored
+        # positions from the speed and the heading change.
+        self.sampling = "fixed"
+        self.sample_min_distance = 10.0
+        self.sample_max_distance = 200.0
+        self.sample_heading_change = 15.0
+        self.sample_max_interval = 60.0
 
         # Tolerance we have to exceed in order to have recognize it
         # as a new position.
         self.lat_change = 0.0002
         self.lon_change = 0.0002
-        self.alt_change = 9.0
\ No newline at end of file
+        self.alt_change = 9.0
+
+    # Returns the histograms of the wait and hold times of the lock
+    # of the gps data (shared by all devices of a fleet).
+    def gps_lock_histograms(self):
+        return (self.metrics.histogram("chasr_gps_lock_wait_seconds",
+                                       "Time waited for the lock of the "
+                                       + "gps data."),
+                self.metrics.histogram("chasr_gps_lock_hold_seconds",
+                                       "Time the lock of the gps data "
+                                       + "was held."))
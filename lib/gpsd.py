@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import socket
+import selectors
+import datetime
+import calendar
+
+
+# Connection to gpsd that delivers the newline-delimited json reports
+# as soon as they arrive. The socket is non-blocking and waited on with a
+# selector, so no report has to wait for a polling interval. Without an
+# own selector, the socket is waited on by the caller (e.g., one selector
+# for the connections of all devices in fleet mode).
+class GpsdClient(object):
+
+    def __init__(self, host="127.0.0.1", port=2947, connect_timeout=5.0,
+                 own_selector=True):
+
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.own_selector = own_selector
+
+        self.sock = None
+        self.selector = None
+
+        # Incomplete line received so far.
+        self.partial = b""
+
+    # Connects to gpsd and enables the json watcher mode.
+    def connect(self):
+        self.close()
+        sock = socket.create_connection((self.host, self.port),
+                                        self.connect_timeout)
+        try:
+            sock.sendall(b'?WATCH={"enable":true,"json":true}\n')
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+        self.partial = b""
+        if self.own_selector:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # Reads all data that is available on the socket and returns the
+    # complete reports (as bytes without the newline). Raises ConnectionError
+    # if gpsd closed the connection.
+    def read_available(self):
+        data = list()
+        while True:
+            try:
+                received = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not received:
+                if not data:
+                    raise ConnectionError("Connection closed by gpsd.")
+                break
+            data.append(received)
+            if len(received) < 65536:
+                break
+
+        if not data:
+            return list()
+
+        lines = (self.partial + b"".join(data)).split(b"\n")
+        self.partial = lines.pop()
+        return [line for line in lines if line]
+
+    # Waits at most timeout seconds for new reports and returns them.
+    def read_reports(self, timeout):
+        if not self.selector.select(timeout):
+            return list()
+        return self.read_available()
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+            self.sock = None
+
+
+# Returns the number of days since 1970-01-01 of the given date
+# (proleptic gregorian calendar).
+def days_from_civil(year, month, day):
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100
+                  + day_of_year)
+    return era * 146097 + day_of_era - 719468
+
+
+# Cache of the last converted date (a fix rate of 10 Hz
+# converts the same date 864000 times a day).
+_last_date = [None, 0]
+
+
+# Converts a gpsd time string (e.g., 2018-02-01T20:01:18.500Z) to a utc
+# timestamp with sub-second precision. Uses a cheap fixed-format parser
+# and only falls back to strptime for unexpected formats.
+def parse_time(time_str):
+    try:
+        if (len(time_str) < 20 or time_str[4] != "-" or time_str[10] != "T"
+           or time_str[13] != ":" or time_str[-1] != "Z"):
+            raise ValueError("Unexpected time format.")
+
+        date_str = time_str[0:10]
+        if date_str == _last_date[0]:
+            days = _last_date[1]
+        else:
+            days = days_from_civil(int(time_str[0:4]),
+                                   int(time_str[5:7]),
+                                   int(time_str[8:10]))
+            _last_date[0] = date_str
+            _last_date[1] = days
+
+        timestamp = (days * 86400
+                     + int(time_str[11:13]) * 3600
+                     + int(time_str[14:16]) * 60
+                     + int(time_str[17:19]))
+        if time_str[19] == ".":
+            return timestamp + float("0" + time_str[19:-1])
+        return float(timestamp)
+
+    except (ValueError, IndexError):
+        fraction = 0.0
+        if time_str.find(".") != -1:
+            fraction_str = time_str[time_str.find("."):].rstrip("Z")
+            fraction = float("0" + fraction_str)
+            time_str = time_str[0:time_str.find(".")]
+        dt_obj = datetime.datetime.strptime(time_str.rstrip("Z"),
+                                            "%Y-%m-%dT%H:%M:%S")
+        return calendar.timegm(dt_obj.timetuple()) + fraction
+
+
+# Extracts the time of a raw TPV report without decoding the whole report.
+# Returns None if the report contains no time.
+def extract_time(report):
+    pos = report.find(b'"time"')
+    if pos == -1:
+        return None
+    start = report.find(b'"', pos + 6)
+    end = report.find(b'"', start + 1)
+    if start == -1 or end == -1:
+        return None
+    return parse_time(report[start+1:end].decode("ascii"))
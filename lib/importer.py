@@ -0,0 +1,444 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import os
+import time
+import json
+import copy
+import hashlib
+import datetime
+import collections
+import xml.etree.ElementTree
+from .collector import DataCollector
+from .submitter import DataSubmitter, ErrorCodes
+from .gpsd import parse_time
+from .sampler import haversine
+from .durability import atomic_write
+
+
+# Knots to metres per second.
+KNOTS = 0.514444
+
+
+# Returns the sentence of a NMEA line without the checksum or None if the
+# line is no NMEA sentence or its checksum is wrong.
+def nmea_sentence(line):
+    line = line.strip()
+    if not line.startswith("$"):
+        return None
+    pos = line.find("*")
+    if pos == -1:
+        return line[1:]
+    checksum = 0
+    for char in line[1:pos]:
+        checksum ^= ord(char)
+    try:
+        if checksum != int(line[pos+1:pos+3], 16):
+            return None
+    except ValueError:
+        return None
+    return line[1:pos]
+
+
+# Converts a NMEA coordinate (e.g., 4807.038 and N) to degrees.
+def nmea_coordinate(value, hemisphere):
+    pos = value.find(".")
+    if pos == -1:
+        pos = len(value)
+    degrees = float(value[:pos-2]) + float(value[pos-2:]) / 60.0
+    if hemisphere in ["S", "W"]:
+        degrees = -degrees
+    return degrees
+
+
+# Streams the fixes of a NMEA log. The RMC (date, position, speed, course)
+# and GGA (position, altitude) sentences of an epoch are merged into one
+# fix in the format of a gpsd TPV report. Fields no sentence of the epoch
+# delivered are missing in the fix.
+def read_nmea(fp):
+
+    date = None
+    epoch = None
+    fix = dict()
+    for line in fp:
+
+        sentence = nmea_sentence(line)
+        if sentence is None:
+            continue
+        fields = sentence.split(",")
+        kind = fields[0][2:]
+        if kind not in ["RMC", "GGA"]:
+            continue
+
+        try:
+            if kind == "RMC":
+                if len(fields) < 10 or fields[2] != "A":
+                    continue
+                date = "20%s-%s-%s" % (fields[9][4:6],
+                                       fields[9][2:4],
+                                       fields[9][0:2])
+            elif len(fields) < 10 or fields[6] in ["", "0"]:
+                continue
+
+            # A new time starts the next epoch.
+            if fields[1] != epoch:
+                if fix and "time" in fix:
+                    yield fix
+                epoch = fields[1]
+                fix = {"class": "TPV"}
+
+            if kind == "RMC":
+                fix["lat"] = nmea_coordinate(fields[3], fields[4])
+                fix["lon"] = nmea_coordinate(fields[5], fields[6])
+                if fields[7]:
+                    fix["speed"] = float(fields[7]) * KNOTS
+                if fields[8]:
+                    fix["track"] = float(fields[8])
+            else:
+                fix["lat"] = nmea_coordinate(fields[2], fields[3])
+                fix["lon"] = nmea_coordinate(fields[4], fields[5])
+                if fields[9]:
+                    fix["alt"] = float(fields[9])
+
+        except (ValueError, IndexError):
+            continue
+
+        if date is not None:
+            fix["time"] = "%sT%s:%s:%sZ" % (date,
+                                            epoch[0:2],
+                                            epoch[2:4],
+                                            epoch[4:])
+
+    if fix and "time" in fix:
+        yield fix
+
+
+# Converts a GPX time (e.g., 2018-02-01T20:01:18+01:00) to the
+# time format of gpsd.
+def gpx_time(value):
+    if value.endswith("Z"):
+        return value
+    dt_obj = datetime.datetime.fromisoformat(value)
+    if dt_obj.tzinfo is not None:
+        dt_obj = dt_obj.astimezone(datetime.timezone.utc)
+    return dt_obj.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+# Streams the track and route points of a GPX file as fixes in the format
+# of a gpsd TPV report. Processed points are removed from the parsed tree,
+# so the memory usage does not grow with the size of the file.
+def read_gpx(fp):
+
+    path = list()
+    for event, elem in xml.etree.ElementTree.iterparse(fp,
+                                                       ("start", "end")):
+        if event == "start":
+            path.append(elem)
+            continue
+        path.pop()
+
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if tag not in ["trkpt", "rtept"]:
+            continue
+
+        try:
+            fix = {"class": "TPV",
+                   "lat": float(elem.get("lat")),
+                   "lon": float(elem.get("lon"))}
+
+            # Speed and course are part of GPX 1.0 or of extensions.
+            for child in elem.iter():
+                name = child.tag.rsplit("}", 1)[-1]
+                if child.text is None:
+                    continue
+                if name == "time":
+                    fix["time"] = gpx_time(child.text.strip())
+                elif name == "ele":
+                    fix["alt"] = float(child.text)
+                elif name == "speed":
+                    fix["speed"] = float(child.text)
+                elif name == "course":
+                    fix["track"] = float(child.text)
+
+        except (TypeError, ValueError):
+            fix = None
+
+        if path:
+            path[-1].remove(elem)
+        if fix is not None and "time" in fix:
+            yield fix
+
+
+# Returns the reader of the given track file (GPX files start with a xml
+# tag, everything else is read as NMEA log).
+def track_reader(file_location):
+    with open(file_location, "rb") as fp:
+        start = fp.read(512).lstrip()
+    if start.startswith(b"<"):
+        return read_gpx
+    return read_nmea
+
+
+# Completes the fixes of a track file. A missing speed is calculated from
+# the distance to the previous fix, a missing altitude is set to 0.
+def complete_fixes(fixes):
+    last = None
+    for fix in fixes:
+        try:
+            fix_time = parse_time(fix["time"])
+        except ValueError:
+            continue
+
+        if "speed" not in fix:
+            fix["speed"] = 0.0
+            if last is not None and fix_time > last[0]:
+                fix["speed"] = (haversine(last[1], last[2],
+                                          fix["lat"], fix["lon"])
+                                / (fix_time - last[0]))
+        if "alt" not in fix:
+            fix["alt"] = 0.0
+        last = (fix_time, fix["lat"], fix["lon"])
+        yield fix, fix_time
+
+
+# Progress of the import of a track file. The positions of the file are
+# numbered in the order of the file, all positions up to last_seq are
+# acknowledged by the server. The numbering only stays the same as long as
+# the file and the settings deciding which positions are stored stay the
+# same, otherwise the import starts from the beginning.
+class ImportCheckpoint(object):
+
+    def __init__(self, file_location, checkpoint_dir, settings):
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.file_location = os.path.abspath(file_location)
+        file_stat = os.stat(self.file_location)
+        self.source = {"file": self.file_location,
+                       "size": file_stat.st_size,
+                       "mtime": int(file_stat.st_mtime)}
+        self.settings = settings
+
+        digest = hashlib.sha256(self.file_location.encode("utf-8"))
+        self.location = os.path.join(checkpoint_dir,
+                                     "%s-%s.json"
+                                     % (os.path.basename(file_location),
+                                        digest.hexdigest()[:16]))
+
+        self.last_seq = -1
+        self.done = False
+
+    # Loads the stored progress. Returns False if there is no usable
+    # progress of the file.
+    def load(self):
+        if not os.path.exists(self.location):
+            return False
+        try:
+            with open(self.location, "r") as fp:
+                data = json.load(fp)
+        except Exception:
+            logging.exception("[%s]: Can not read checkpoint %s."
+                              % (self.file_name, self.location))
+            return False
+
+        if (data.get("source") != self.source
+           or data.get("settings") != self.settings):
+            logging.warning("[%s]: File or settings changed since the "
+                            % self.file_name
+                            + "last import of %s. Starting from the "
+                            % self.file_location
+                            + "beginning.")
+            return False
+
+        self.last_seq = data["last_seq"]
+        self.done = data["done"]
+        return True
+
+    # Stores the progress atomically.
+    def save(self):
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        data = json.dumps({"source": self.source,
+                           "settings": self.settings,
+                           "last_seq": self.last_seq,
+                           "done": self.done})
+        atomic_write(self.location, data.encode("utf-8"))
+
+
+# Imports the tracks of NMEA logs and GPX files (e.g., of a device whose
+# logger crashed). The files are streamed, their fixes are checked and
+# filtered like the ones received from gpsd, and the stored positions are
+# encrypted in batches (over all cores) and sent with the chunks of the
+# submitter. The progress is checkpointed after every acknowledged chunk,
+# so an aborted import resumes where it stopped.
+class TrackImporter(object):
+
+    # Seconds between two progress messages.
+    report_interval = 5.0
+
+    def __init__(self, global_data, checkpoint_dir, check=None):
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        # The imported positions are not stored in the journal and
+        # are sent by the chunk path of the submitter only.
+        self.global_data = copy.copy(global_data)
+        self.global_data.submission_mode = "interval"
+        self.global_data.live_submitter = None
+        self.submitter = DataSubmitter(self.global_data)
+
+        self.checkpoint_dir = checkpoint_dir
+        self.check = check
+
+        # Number of positions encrypted at once.
+        self.batch_size = max(self.global_data.gps_chunk,
+                              self.global_data.crypto_batch)
+        self.inflight_chunks = self.global_data.inflight_chunks
+
+    # Returns the settings that decide which positions are stored.
+    def settings(self):
+        data = self.global_data
+        return {"device_name": data.device_name,
+                "server": data.server,
+                "gpslogging_interval": data.gpslogging_interval,
+                "sampling": data.sampling,
+                "tolerance": [data.lat_change,
+                              data.lon_change,
+                              data.alt_change],
+                "adaptive": [data.sample_min_distance,
+                             data.sample_max_distance,
+                             data.sample_heading_change,
+                             data.sample_max_interval]}
+
+    # Yields the positions of the given track file that the collector would
+    # store, numbered in the order of the file.
+    def positions(self, file_location, counters):
+
+        # The collector is not started, it only filters the fixes.
+        collector = DataCollector(self.global_data)
+        reader = track_reader(file_location)
+
+        if reader is read_gpx:
+            fp = open(file_location, "rb")
+        else:
+            fp = open(file_location, "r", errors="replace")
+
+        seq = 0
+        with fp:
+            for fix, fix_time in complete_fixes(reader(fp)):
+                counters["fixes"] += 1
+                element = collector.build_element(fix, fix_time)
+                if element is None:
+                    continue
+                if self.check is not None and not self.check(element):
+                    counters["invalid"] += 1
+                    continue
+                element["seq"] = seq
+                seq += 1
+                yield element
+
+    # Yields the batches of positions after the given sequence number.
+    def batches(self, positions, last_seq):
+        batch = list()
+        for element in positions:
+            if element["seq"] <= last_seq:
+                continue
+            batch.append(element)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    # Imports the given track file. Returns True if all positions of the
+    # file were acknowledged by the server.
+    def import_file(self, file_location, restart=False):
+
+        checkpoint = ImportCheckpoint(file_location,
+                                      self.checkpoint_dir,
+                                      self.settings())
+        if not restart and checkpoint.load():
+            if checkpoint.done:
+                logging.info("[%s]: %s was already imported."
+                             % (self.file_name, file_location))
+                return True
+            logging.info("[%s]: Resuming import of %s after position %d."
+                         % (self.file_name, file_location,
+                            checkpoint.last_seq))
+
+        counters = {"fixes": 0, "invalid": 0, "sent": 0}
+        start_time = time.monotonic()
+        next_report = start_time + self.report_interval
+        positions = self.positions(file_location, counters)
+
+        pending = collections.deque()
+        failed = False
+        for batch in self.batches(positions, checkpoint.last_seq):
+            for chunk in self.submitter.build_chunks(batch):
+
+                while len(pending) >= self.inflight_chunks:
+                    failed |= not self._finish(pending.popleft(),
+                                               checkpoint, counters)
+                if failed:
+                    break
+                pending.append((chunk,
+                                self.submitter.executor.submit(
+                                                self.submitter.send_chunk,
+                                                chunk)))
+            if failed:
+                break
+
+            if time.monotonic() >= next_report:
+                self._report(file_location, counters, start_time)
+                next_report = time.monotonic() + self.report_interval
+
+        while pending:
+            failed |= not self._finish(pending.popleft(),
+                                       checkpoint, counters)
+
+        if not failed:
+            checkpoint.done = True
+            checkpoint.save()
+        self._report(file_location, counters, start_time)
+        return not failed
+
+    # Waits for the submission of a chunk and checkpoints its positions.
+    # Chunks after a failed chunk are not checkpointed (they are sent again
+    # when the import is resumed).
+    def _finish(self, pending_chunk, checkpoint, counters):
+        chunk, future = pending_chunk
+        code = future.result()
+        if code != ErrorCodes.NO_ERROR:
+            return False
+        if chunk.first_seq != checkpoint.last_seq + 1:
+            return False
+        checkpoint.last_seq = chunk.last_seq
+        checkpoint.save()
+        counters["sent"] += len(chunk.data_points)
+        return True
+
+    def _report(self, file_location, counters, start_time):
+        duration = max(time.monotonic() - start_time, 0.001)
+        logging.info("[%s]: %s: %d fixes read (%.0f fixes/sec), "
+                     % (self.file_name, file_location, counters["fixes"],
+                        counters["fixes"] / duration)
+                     + "%d invalid, %d positions sent (%.0f points/sec)."
+                     % (counters["invalid"], counters["sent"],
+                        counters["sent"] / duration))
+
+    def close(self):
+        logging.info("[%s]: %s" % (self.file_name, self.submitter.session))
+        if self.submitter.simplifier is not None:
+            logging.info("[%s]: %s" % (self.file_name,
+                                       self.submitter.simplifier))
+        self.submitter.executor.shutdown(wait=True)
+        self.submitter.crypto.close()
+        self.submitter.session.close()
@@ -0,0 +1,577 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import threading
+import os
+import json
+import bisect
+import struct
+import zlib
+from .durability import Durability, sync_fd, atomic_replace
+from .spill import unpack_position
+
+
+# Set of acknowledged sequence numbers stored as sorted, merged
+# [first, last] intervals.
+class AckSet(object):
+
+    def __init__(self):
+        self.firsts = list()
+        self.lasts = list()
+
+    def add(self, first_seq, last_seq):
+
+        if first_seq > last_seq:
+            return
+
+        # Find all intervals that overlap or touch the new one and merge them.
+        start = bisect.bisect_left(self.lasts, first_seq - 1)
+        end = bisect.bisect_right(self.firsts, last_seq + 1)
+        if start < end:
+            first_seq = min(first_seq, self.firsts[start])
+            last_seq = max(last_seq, self.lasts[end - 1])
+        self.firsts[start:end] = [first_seq]
+        self.lasts[start:end] = [last_seq]
+
+    def contains(self, seq):
+        pos = bisect.bisect_right(self.firsts, seq) - 1
+        return pos >= 0 and seq <= self.lasts[pos]
+
+    def intervals(self):
+        return list(zip(self.firsts, self.lasts))
+
+
+# Append-only journal of gps positions. Every new position is appended as
+# one record and every acknowledged range is appended as an ack marker.
+# This way the cost of storing a position does not depend on the size of
+# the backlog. Acknowledged records are removed by compacting the journal
+# in the background.
+#
+# This journal stores one json object per line:
+# {"seq": 5, "lat": "...", "lon": "...", "alt": "...", "speed": "...",
+#  "utctime": 1517515278}
+# {"ack": [5, 104]}
+# {"seq_base": 105}
+class GpsJournal(object):
+
+    # Name of the storage format.
+    storage_format = "json"
+
+    def __init__(self, journal_file, durability=Durability.NONE,
+                 sync_stats=None):
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.journal_file = journal_file
+
+        # Durability level of the written records and the stats
+        # the measured sync durations are recorded in.
+        self.durability = durability
+        self.sync_stats = sync_stats
+
+        # Flag indicates if records were written since the last sync.
+        self.dirty = False
+
+        # Lock protects the file handle and the journal state.
+        self.lock = threading.Lock()
+        self.fp = None
+
+        # Sequence number given to the next appended position.
+        self.next_seq = 0
+
+        self.acked = AckSet()
+
+        # Number of records in the journal file and number of records
+        # that are still needed (positions not acknowledged yet).
+        self.num_records = 0
+        self.num_live = 0
+
+        # Minimal number of dead records before the journal is compacted.
+        self.compact_min_dead = 1000
+
+        # Signals the compactor that the journal could need a compaction.
+        self.compact_event = threading.Event()
+
+    # Returns the header written at the start of a new journal file.
+    def _header(self):
+        return b""
+
+    # Reads and checks the header of the journal file and returns its size.
+    def _read_header(self, fp):
+        return 0
+
+    # Encodes a record.
+    def _encode(self, record):
+        return json.dumps(record).encode("utf-8") + b"\n"
+
+    # Decodes a record. Raises an exception if the record is corrupt.
+    def _decode(self, raw):
+        record = json.loads(raw.decode("utf-8"))
+        if "seq" in record:
+            if type(record["seq"]) != int:
+                raise ValueError("Illegal sequence number.")
+        elif "ack" in record:
+            record["ack"] = [int(record["ack"][0]), int(record["ack"][1])]
+        elif "seq_base" in record:
+            record["seq_base"] = int(record["seq_base"])
+        else:
+            raise ValueError("Unknown record.")
+        return record
+
+    # Reads the records of the journal file up to the given offset (or the
+    # end of the file). Yields the raw bytes and the decoded record (None if
+    # the record is corrupt) of every complete record. Stops at an
+    # incomplete (torn) record.
+    def _read_records(self, fp, end=None):
+        offset = fp.tell()
+        while end is None or offset < end:
+            raw = fp.readline()
+            if not raw.endswith(b"\n"):
+                return
+            offset += len(raw)
+            try:
+                record = self._decode(raw)
+            except Exception:
+                record = None
+            yield raw, record
+
+    # Replays the journal file and yields the not acknowledged positions
+    # (ordered by sequence number), so they can be streamed into the
+    # backlog without holding the whole journal in memory. The first pass
+    # reads the ack markers, the second pass yields the positions. Positions
+    # rejected by the given validator are marked as acknowledged. A torn
+    # record at the end of the journal (e.g., because of a power loss) is
+    # cut off. The journal is opened for appending after all positions
+    # were yielded.
+    def replay(self, validator=None):
+
+        good_offset = 0
+        num_records = 0
+        num_live = 0
+        corrupt = list()
+
+        exists = (os.path.exists(self.journal_file)
+                  and os.path.getsize(self.journal_file) > 0)
+        if exists:
+            with open(self.journal_file, 'rb') as fp:
+                good_offset = self._read_header(fp)
+                for raw, record in self._read_records(fp):
+                    num_records += 1
+                    good_offset += len(raw)
+
+                    if record is None:
+                        logging.error("[%s]: Journal record corrupt. "
+                                      % self.file_name
+                                      + "Ignoring it.")
+                    elif "seq" in record:
+                        self.next_seq = max(self.next_seq,
+                                            record["seq"] + 1)
+                    elif "ack" in record:
+                        self.acked.add(record["ack"][0], record["ack"][1])
+                    elif "seq_base" in record:
+                        self.next_seq = max(self.next_seq,
+                                            record["seq_base"])
+
+            # Remove torn tail.
+            if good_offset != os.path.getsize(self.journal_file):
+                logging.warning("[%s]: Journal has a torn tail. "
+                                % self.file_name
+                                + "Cutting it off.")
+                with open(self.journal_file, 'r+b') as fp:
+                    fp.truncate(good_offset)
+
+        if exists:
+            with open(self.journal_file, 'rb') as fp:
+                self._read_header(fp)
+                for _, record in self._read_records(fp, good_offset):
+                    if record is None or "seq" not in record:
+                        continue
+                    seq = record["seq"]
+                    if self.acked.contains(seq):
+                        continue
+                    num_live += 1
+                    if validator is not None and not validator(record):
+                        logging.error("[%s]: Stored position corrupt. "
+                                      % self.file_name
+                                      + "Removing it.")
+                        corrupt.append(seq)
+                        continue
+                    yield record
+
+        self.num_records = num_records
+        self.num_live = num_live
+
+        self.open()
+        for seq in corrupt:
+            self.ack(seq, seq)
+
+    # Opens the journal for appending.
+    def open(self):
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.journal_file, 'ab')
+                if self.fp.tell() == 0:
+                    self.fp.write(self._header())
+                    self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+    # Assigns the next sequence number to the given gps position without
+    # writing it to the journal.
+    def assign_seq(self, element):
+        with self.lock:
+            element["seq"] = self.next_seq
+            self.next_seq += 1
+        return element["seq"]
+
+    # Writes the given records (gps positions, ack markers and sequence
+    # bases) with a single write to the journal.
+    def write_records(self, records):
+
+        data = b"".join(self._encode(record) for record in records)
+
+        with self.lock:
+            self.fp.write(data)
+            self.fp.flush()
+            self.num_records += len(records)
+            self.dirty = True
+
+            for record in records:
+                if "ack" in record:
+                    first_seq, last_seq = record["ack"]
+                    self.acked.add(first_seq, last_seq)
+                    self.num_live = max(0, self.num_live
+                                           - (last_seq - first_seq + 1))
+                elif "seq_base" in record:
+                    self.next_seq = max(self.next_seq, record["seq_base"])
+                else:
+                    self.num_live += 1
+
+            # Wake compactor if the journal contains mostly dead records.
+            if self._needs_compaction():
+                self.compact_event.set()
+
+        # Sync journal to force writing on storage.
+        if self.durability == Durability.ALWAYS:
+            self.sync()
+
+    # Returns True if the journal contains mostly dead records
+    # (must be called with the lock held).
+    def _needs_compaction(self):
+        num_dead = self.num_records - self.num_live
+        return (num_dead >= self.compact_min_dead
+                and num_dead > self.num_live)
+
+    def needs_compaction(self):
+        with self.lock:
+            return self._needs_compaction()
+
+    # Syncs records written since the last sync to storage. The sync is done
+    # on a duplicate of the file descriptor in order to not block writers
+    # while syncing.
+    def sync(self):
+        with self.lock:
+            if not self.dirty or self.fp is None:
+                return
+            self.dirty = False
+            fd = os.dup(self.fp.fileno())
+        try:
+            sync_fd(fd, self.sync_stats)
+        finally:
+            os.close(fd)
+
+    # Appends a gps position to the journal. The assigned sequence number
+    # is stored in the element and returned.
+    def append(self, element):
+        self.assign_seq(element)
+        self.write_records([element])
+        return element["seq"]
+
+    # Marks all positions from first_seq to last_seq (inclusive) as
+    # acknowledged.
+    def ack(self, first_seq, last_seq):
+        self.write_records([{"ack": [first_seq, last_seq]}])
+
+    # Rewrites the journal so that it only contains not acknowledged
+    # positions. The bulk of the journal is copied without holding the lock,
+    # only records appended in the meantime are copied while holding it.
+    def compact(self):
+
+        temp_file = self.journal_file + ".compact"
+
+        with self.lock:
+            self.fp.flush()
+            snapshot_end = self.fp.tell()
+            seq_base = self.next_seq
+            acked = AckSet()
+            for first_seq, last_seq in self.acked.intervals():
+                acked.add(first_seq, last_seq)
+
+        num_records = 0
+        with open(self.journal_file, 'rb') as src, \
+             open(temp_file, 'wb') as dst:
+
+            dst.write(self._header())
+            dst.write(self._encode({"seq_base": seq_base}))
+            num_records += 1
+
+            self._read_header(src)
+            for raw, record in self._read_records(src, snapshot_end):
+                if (record is None
+                   or "seq" not in record
+                   or acked.contains(record["seq"])):
+                    continue
+                dst.write(raw)
+                num_records += 1
+
+            with self.lock:
+
+                # Copy all records that were written during the compaction.
+                self.fp.flush()
+                src.seek(snapshot_end)
+                for raw, _ in self._read_records(src):
+                    dst.write(raw)
+                    num_records += 1
+
+                dst.flush()
+                sync_fd(dst.fileno(), self.sync_stats)
+                self.fp.close()
+                atomic_replace(temp_file, self.journal_file, self.sync_stats)
+                self.fp = open(self.journal_file, 'ab')
+                self.num_records = num_records
+                self.dirty = False
+
+        logging.debug("[%s]: Compacted journal to %d records."
+                      % (self.file_name, num_records))
+
+
+# Journal storing fixed-size binary records after a versioned header.
+# Every record carries a CRC, so a corrupt record only loses this record,
+# a torn record at the end is cut off and the Nth record can be read by
+# seeking to it.
+#
+# Header: magic (8 bytes), version (uint16), record size (uint16),
+#         4 reserved bytes.
+# Record: type (uint8), seq (int64), utctime (int64), lat, lon, alt, speed
+#         (14 bytes each, padded with zero bytes), crc32 of the record
+#         (uint32). Ack markers store the acknowledged range in the
+#         seq and utctime fields, sequence bases in the seq field.
+class BinaryGpsJournal(GpsJournal):
+
+    storage_format = "binary"
+
+    MAGIC = b"CHASRGPS"
+    VERSION = 1
+    HEADER = struct.Struct("<8sHH4x")
+    RECORD = struct.Struct("<Bqq14s14s14s14s")
+    CRC = struct.Struct("<I")
+    RECORD_SIZE = RECORD.size + CRC.size
+
+    TYPE_POSITION = 1
+    TYPE_ACK = 2
+    TYPE_SEQ_BASE = 3
+
+    def _header(self):
+        return self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD_SIZE)
+
+    def _read_header(self, fp):
+        raw = fp.read(self.HEADER.size)
+        if len(raw) < self.HEADER.size:
+            raise ValueError("Journal header truncated.")
+        magic, version, record_size = self.HEADER.unpack(raw)
+        if magic != self.MAGIC:
+            raise ValueError("Journal is not a binary gps journal.")
+        if version != self.VERSION or record_size != self.RECORD_SIZE:
+            raise ValueError("Unsupported journal version %d." % version)
+        return self.HEADER.size
+
+    def _encode(self, record):
+        if "ack" in record:
+            body = self.RECORD.pack(self.TYPE_ACK,
+                                    record["ack"][0],
+                                    record["ack"][1],
+                                    b"", b"", b"", b"")
+        elif "seq_base" in record:
+            body = self.RECORD.pack(self.TYPE_SEQ_BASE,
+                                    record["seq_base"],
+                                    0, b"", b"", b"", b"")
+        else:
+            values = list()
+            for key in ("lat", "lon", "alt", "speed"):
+                value = record[key].encode("utf-8")
+                if len(value) > 14:
+                    raise ValueError("Value of %s too long." % key)
+                values.append(value)
+            body = self.RECORD.pack(self.TYPE_POSITION,
+                                    record["seq"],
+                                    record["utctime"],
+                                    *values)
+        return body + self.CRC.pack(zlib.crc32(body))
+
+    def _decode(self, raw):
+        body = raw[:self.RECORD.size]
+        if self.CRC.unpack_from(raw, self.RECORD.size)[0] != zlib.crc32(body):
+            raise ValueError("Record checksum mismatch.")
+        fields = self.RECORD.unpack(body)
+        if fields[0] == self.TYPE_POSITION:
+            return unpack_position(fields[1:])
+        elif fields[0] == self.TYPE_ACK:
+            return {"ack": [fields[1], fields[2]]}
+        elif fields[0] == self.TYPE_SEQ_BASE:
+            return {"seq_base": fields[1]}
+        raise ValueError("Unknown record type %d." % fields[0])
+
+    def _read_records(self, fp, end=None):
+        offset = fp.tell()
+        while end is None or offset < end:
+            raw = fp.read(self.RECORD_SIZE)
+            if len(raw) < self.RECORD_SIZE:
+                return
+            offset += len(raw)
+            try:
+                record = self._decode(raw)
+            except Exception:
+                record = None
+            yield raw, record
+
+    # Reads the record with the given index (counted from the start of
+    # the journal file). Returns None if the record is corrupt.
+    def read_record(self, index):
+        with open(self.journal_file, 'rb') as fp:
+            fp.seek(self.HEADER.size + index * self.RECORD_SIZE)
+            raw = fp.read(self.RECORD_SIZE)
+        if len(raw) < self.RECORD_SIZE:
+            raise IndexError("Journal has no record %d." % index)
+        try:
+            return self._decode(raw)
+        except ValueError:
+            return None
+
+
+# Returns the journal class of the given storage format.
+def journal_class(storage_format):
+    for cls in (GpsJournal, BinaryGpsJournal):
+        if cls.storage_format == storage_format:
+            return cls
+    raise ValueError("Unknown storage format '%s'." % storage_format)
+
+
+# Returns the journal class of an existing journal file by checking its
+# header (or None if the file does not exist or is empty).
+def detect_journal_class(journal_file):
+    if (not os.path.exists(journal_file)
+       or os.path.getsize(journal_file) == 0):
+        return None
+    with open(journal_file, 'rb') as fp:
+        if fp.read(len(BinaryGpsJournal.MAGIC)) == BinaryGpsJournal.MAGIC:
+            return BinaryGpsJournal
+    return GpsJournal
+
+
+# Converts the journal src_file into a journal dst_file of the given storage
+# format. Only not acknowledged positions are converted (keeping their
+# sequence numbers). Returns the number of converted positions.
+def convert_journal(src_file, dst_file, storage_format, validator=None):
+
+    src_class = detect_journal_class(src_file)
+    if src_class is None:
+        raise ValueError("Journal %s does not exist or is empty."
+                         % src_file)
+    if os.path.exists(dst_file) and os.path.getsize(dst_file) > 0:
+        raise ValueError("Journal %s already exists." % dst_file)
+
+    temp_file = dst_file + ".tmp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    dst = journal_class(storage_format)(temp_file)
+    dst.open()
+
+    # Stream the positions in batches.
+    src = src_class(src_file)
+    num_converted = 0
+    batch = list()
+    for record in src.replay(validator):
+        batch.append(record)
+        if len(batch) >= 1000:
+            dst.write_records(batch)
+            num_converted += len(batch)
+            batch = list()
+    src.close()
+    dst.write_records(batch + [{"seq_base": src.next_seq}])
+    num_converted += len(batch)
+
+    dst.sync()
+    dst.close()
+    atomic_replace(temp_file, dst_file)
+
+    return num_converted
+
+
+# Thread compacting the journal in the background whenever it
+# mostly consists of acknowledged records.
+class JournalCompactor(threading.Thread):
+
+    def __init__(self, journals):
+
+        threading.Thread.__init__(self)
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        # Compacts a single journal or the journals of all
+        # devices (fleet mode).
+        if isinstance(journals, GpsJournal):
+            journals = [journals]
+        self.journals = journals
+
+        # All journals wake the compactor with the same event.
+        self.compact_event = threading.Event()
+        for journal in self.journals:
+            journal.compact_event = self.compact_event
+
+        # Flag indicates if thread should exit.
+        self.exit_flag = False
+
+    def run(self):
+
+        logging.info("[%s]: Starting journal compactor thread."
+                     % self.file_name)
+
+        while True:
+            self.compact_event.wait()
+            self.compact_event.clear()
+
+            # Should we exit thread?
+            if self.exit_flag:
+                logging.info("[%s]: Exiting journal compactor thread."
+                             % self.file_name)
+                return
+
+            for journal in self.journals:
+                if not journal.needs_compaction():
+                    continue
+                try:
+                    journal.compact()
+                except:
+                    logging.exception("[%s]: Can not compact journal (%s)."
+                                      % (self.file_name,
+                                         journal.journal_file))
+
+    # Sets exit flag.
+    def exit(self):
+        logging.debug("[%s]: Telling journal compactor thread to exit."
+                      % self.file_name)
+        self.exit_flag = True
+        self.compact_event.set()
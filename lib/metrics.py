@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import threading
+import os
+import bisect
+import http.server
+from .durability import atomic_write
+
+
+# Upper bounds (in seconds) of the histogram buckets. They cover lock waits
+# (microseconds) as well as requests to the server (seconds).
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Returns the labels in the Prometheus text format.
+def format_labels(names, values, extra=""):
+    labels = ["%s=\"%s\"" % (name, str(value).replace("\\", "\\\\")
+                                               .replace("\"", "\\\""))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+
+# Base of the metrics. A metric with label names has one child per
+# combination of label values (created by labels()).
+class Metric(object):
+
+    kind = "untyped"
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.children = dict()
+
+    # Returns the child of the given label values.
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self._create_child()
+                    self.children[values] = child
+        return child
+
+    def _create_child(self):
+        raise NotImplementedError()
+
+    # Returns the samples of the metric as lines in the Prometheus
+    # text format.
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        if self.label_names:
+            with self.lock:
+                children = sorted(self.children.items())
+            for values, child in children:
+                lines.extend(child._render(self.name, self.label_names,
+                                           values))
+        else:
+            lines.extend(self._render(self.name, (), ()))
+        return lines
+
+
+# Counter that only goes up (e.g., number of received fixes).
+class Counter(Metric):
+
+    kind = "counter"
+
+    def __init__(self, name, description, label_names=()):
+        Metric.__init__(self, name, description, label_names)
+        self.value = 0
+
+    def _create_child(self):
+        return Counter(self.name, self.description)
+
+    def inc(self, value=1):
+        with self.lock:
+            self.value += value
+
+    def _render(self, name, label_names, values):
+        return ["%s%s %s" % (name, format_labels(label_names, values),
+                             self.value)]
+
+
+# Gauge whose value is read from the given function when the metrics
+# are exported (e.g., the size of the backlog).
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def __init__(self, name, description, function):
+        Metric.__init__(self, name, description)
+        self.function = function
+
+    def _render(self, name, label_names, values):
+        try:
+            value = self.function()
+        except Exception:
+            logging.exception("[%s]: Can not read gauge %s."
+                              % (os.path.basename(__file__), name))
+            return list()
+        return ["%s %s" % (name, value)]
+
+
+# Histogram of durations (in seconds).
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _create_child(self):
+        return Histogram(self.name, self.description, (), self.buckets)
+
+    def observe(self, value):
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[pos] += 1
+            self.sum += value
+            self.count += 1
+
+    def _render(self, name, label_names, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+
+        lines = list()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append("%s_bucket%s %d"
+                         % (name,
+                            format_labels(label_names, values,
+                                          "le=\"%r\"" % bound),
+                            cumulative))
+        lines.append("%s_bucket%s %d"
+                     % (name,
+                        format_labels(label_names, values, "le=\"+Inf\""),
+                        count))
+        lines.append("%s_sum%s %r"
+                     % (name, format_labels(label_names, values), total))
+        lines.append("%s_count%s %d"
+                     % (name, format_labels(label_names, values), count))
+        return lines
+
+
+# Registry of all metrics of the process. Metrics are created once and
+# updated by the threads in place, so recording a value only costs a lock
+# and a few additions.
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = list()
+        self.names = dict()
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self.names:
+                return self.names[metric.name]
+            self.metrics.append(metric)
+            self.names[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, label_names=()):
+        return self._register(Counter(name, description, label_names))
+
+    def gauge(self, name, description, function):
+        return self._register(Gauge(name, description, function))
+
+    def histogram(self, name, description, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, description, label_names,
+                                        buckets))
+
+    # Returns all metrics in the Prometheus text format.
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = list()
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # Writes all metrics atomically into the given text file (for the
+    # textfile collector of node_exporter).
+    def write_textfile(self, file_location):
+        atomic_write(file_location, self.render().encode("utf-8"))
+
+
+# Registers the gauges of the backlog. The values are summed up over the
+# given devices (objects with gps_data and gps_lock).
+def register_backlog_metrics(registry, devices):
+
+    def backlog_sum(function):
+        def read():
+            total = 0
+            for device in devices:
+                device.gps_lock.acquire()
+                try:
+                    total += function(device.gps_data)
+                finally:
+                    device.gps_lock.release()
+            return total
+        return read
+
+    registry.gauge("chasr_backlog_points",
+                   "Number of gps positions not acknowledged by the server.",
+                   backlog_sum(len))
+    registry.gauge("chasr_backlog_spilled_points",
+                   "Number of gps positions of the backlog spilled to disk.",
+                   backlog_sum(lambda x: x.num_spilled))
+    registry.gauge("chasr_backlog_memory_bytes",
+                   "Bytes of memory used by the backlog.",
+                   backlog_sum(lambda x: x.memory_bytes()))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        data = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Thread that exports the metrics. Writes the text file every export
+# interval (and when exiting) and serves the metrics on the local http
+# endpoint (if a port is configured).
+class MetricsExporter(threading.Thread):
+
+    def __init__(self, global_data):
+
+        threading.Thread.__init__(self)
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.registry = global_data.metrics
+        self.textfile = global_data.metrics_textfile
+        self.interval = global_data.metrics_interval
+        self.http_address = global_data.metrics_http_address
+        self.http_port = global_data.metrics_http_port
+
+        self.http_server = None
+        self.http_thread = None
+
+        # Flag indicates if thread should exit.
+        self.exit_flag = False
+        self.exit_event = threading.Event()
+
+    def _start_http(self):
+        try:
+            self.http_server = http.server.ThreadingHTTPServer(
+                                        (self.http_address, self.http_port),
+                                        MetricsHandler)
+        except Exception:
+            logging.exception("[%s]: Can not start metrics endpoint on "
+                              % self.file_name
+                              + "%s:%d." % (self.http_address,
+                                            self.http_port))
+            return
+        self.http_server.daemon_threads = True
+        self.http_server.registry = self.registry
+        self.http_thread = threading.Thread(
+                                    target=self.http_server.serve_forever)
+        self.http_thread.daemon = True
+        self.http_thread.start()
+        logging.info("[%s]: Serving metrics on http://%s:%d/metrics."
+                     % (self.file_name, self.http_address, self.http_port))
+
+    def _write(self):
+        try:
+            self.registry.write_textfile(self.textfile)
+        except Exception:
+            logging.exception("[%s]: Can not write metrics to %s."
+                              % (self.file_name, self.textfile))
+
+    def run(self):
+
+        logging.info("[%s]: Starting metrics thread." % self.file_name)
+
+        if self.http_port > 0:
+            self._start_http()
+
+        while True:
+            if self.textfile:
+                self._write()
+
+            # Should we exit thread?
+            if self.exit_flag:
+                if self.http_server is not None:
+                    self.http_server.shutdown()
+                    self.http_server.server_close()
+                logging.info("[%s]: Exiting metrics thread."
+                             % self.file_name)
+                return
+
+            self.exit_event.wait(self.interval)
+
+    # Sets exit flag.
+    def exit(self):
+        self.exit_flag = True
+        self.exit_event.set()
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import threading
+import os
+import time
+import queue
+from .durability import Durability
+
+
+# Thread that writes all changes of the gps data (appended positions and
+# acknowledged ranges) to the journal. The collector and submitter only
+# queue the changes, so they hold the gps lock just for the in-memory
+# operations. Queued changes are written as group commits: one write
+# (and sync) for all changes that arrive within the commit window or
+# until the batch size is reached.
+#
+# In fleet mode, one thread writes the journals of all devices. The
+# devices queue their changes through a JournalWriter.
+class PersistenceWorker(threading.Thread):
+
+    def __init__(self, global_data):
+
+        threading.Thread.__init__(self)
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        # Journal the changes are written to if no other is given.
+        self.journal = global_data.journal
+        self.journals = list()
+        if self.journal is not None:
+            self.journals.append(self.journal)
+        self.durability = global_data.durability
+        self.group_commit_interval = global_data.group_commit_ms / 1000.0
+        self.commit_window = global_data.commit_window_ms / 1000.0
+        self.commit_batch_size = global_data.commit_batch_size
+
+        self.change_queue = queue.Queue()
+
+        # Measured durations of the group commits.
+        self.commit_stats = global_data.commit_stats
+
+        # Flag indicates if thread should exit.
+        self.exit_flag = False
+
+    # Returns a writer that queues the changes for the given journal.
+    def writer(self, journal):
+        self.journals.append(journal)
+        return JournalWriter(self, journal)
+
+    # Queues a collected gps position.
+    def append(self, element, journal=None):
+        self.change_queue.put((journal or self.journal, element))
+
+    # Queues the acknowledgement of the positions from first_seq
+    # to last_seq (inclusive).
+    def ack(self, first_seq, last_seq, journal=None):
+        self.change_queue.put((journal or self.journal,
+                               {"ack": [first_seq, last_seq]}))
+
+    # Returns the number of queued changes.
+    def pending(self):
+        return self.change_queue.qsize()
+
+    # Collects a batch of changes. Blocks at most timeout seconds
+    # for the first change.
+    def _get_batch(self, timeout):
+        try:
+            records = [self.change_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return list()
+
+        deadline = time.monotonic() + self.commit_window
+        while len(records) < self.commit_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    records.append(self.change_queue.get(timeout=remaining))
+                else:
+                    records.append(self.change_queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _commit(self, changes):
+        start = time.monotonic()
+
+        # Group the records by journal (keeping their order).
+        records = dict()
+        for journal, record in changes:
+            if journal not in records:
+                records[journal] = list()
+            records[journal].append(record)
+
+        for journal, journal_records in records.items():
+            try:
+                journal.write_records(journal_records)
+            except:
+                logging.exception("[%s]: Can not write into journal (%s)."
+                                  % (self.file_name, journal.journal_file))
+        self.commit_stats.record(time.monotonic() - start)
+
+    # Syncs all journals with records written since their last sync.
+    def _sync(self):
+        for journal in self.journals:
+            try:
+                journal.sync()
+            except:
+                logging.exception("[%s]: Can not sync journal (%s)."
+                                  % (self.file_name, journal.journal_file))
+
+    # Returns True if a journal has records that are not synced.
+    def _dirty(self):
+        for journal in self.journals:
+            if journal.dirty:
+                return True
+        return False
+
+    def run(self):
+
+        logging.info("[%s]: Starting persistence thread." % self.file_name)
+
+        last_sync = time.monotonic()
+        while True:
+
+            # Wait for changes, but wake up in time for a pending
+            # group commit sync.
+            timeout = 1.0
+            if self.durability == Durability.GROUP and self._dirty():
+                timeout = max(0.0, last_sync + self.group_commit_interval
+                                   - time.monotonic())
+
+            changes = self._get_batch(timeout)
+            if changes:
+                self._commit(changes)
+
+            if (self.durability == Durability.GROUP
+               and (time.monotonic() - last_sync)
+               >= self.group_commit_interval):
+                self._sync()
+                last_sync = time.monotonic()
+
+            # Should we exit thread? All queued changes
+            # are written before exiting.
+            if self.exit_flag and self.change_queue.empty():
+                self._sync()
+                logging.info("[%s]: Exiting persistence thread."
+                             % self.file_name)
+                return
+
+    # Sets exit flag.
+    def exit(self):
+        logging.debug("[%s]: Telling persistence thread to exit."
+                      % self.file_name)
+        self.exit_flag = True
+
+
+# Queues the changes of the gps data of one device for the
+# persistence thread.
+class JournalWriter(object):
+
+    def __init__(self, worker, journal):
+        self.worker = worker
+        self.journal = journal
+
+    # Queues a collected gps position.
+    def append(self, element):
+        self.worker.append(element, self.journal)
+
+    # Queues the acknowledgement of the positions from first_seq
+    # to last_seq (inclusive).
+    def ack(self, first_seq, last_seq):
+        self.worker.ack(first_seq, last_seq, self.journal)
+
+    # Returns the number of queued changes (of all devices).
+    def pending(self):
+        return self.worker.pending()
@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import threading
+import os
+import sys
+import time
+import marshal
+import traceback
+
+
+# Returns a label of the given thread for the profiles (the class of the
+# thread, e.g., DataCollector, or the name of plain threads).
+def thread_label(thread):
+    if type(thread).__module__ == "threading":
+        return thread.name
+    return type(thread).__name__
+
+
+# Returns the cpu clock of the given thread (None if not supported).
+def thread_clock(thread):
+    try:
+        return time.pthread_getcpuclockid(thread.ident)
+    except (AttributeError, OSError, TypeError):
+        return None
+
+
+# Removes the oldest files with the given prefix and suffix in the given
+# directory until only keep_files files are left.
+def remove_old_files(directory, prefix, suffix, keep_files):
+    file_names = sorted(x for x in os.listdir(directory)
+                        if x.startswith(prefix) and x.endswith(suffix))
+    for file_name in file_names[:max(0, len(file_names) - keep_files)]:
+        try:
+            os.remove(os.path.join(directory, file_name))
+        except OSError:
+            pass
+
+
+# Writes the stacks of all threads and the given statistics (objects
+# printed with str()) into the given file.
+def dump_threads(file_location, stats, metrics=None):
+    labels = dict((x.ident, thread_label(x)) for x in threading.enumerate())
+    with open(file_location, "w") as fp:
+        fp.write("# %s\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
+        for ident, frame in sys._current_frames().items():
+            fp.write("\nThread %s (%d):\n"
+                     % (labels.get(ident, "unknown"), ident))
+            fp.write("".join(traceback.format_stack(frame)))
+
+        fp.write("\n# Timers\n")
+        for stat in stats:
+            fp.write("%s\n" % stat)
+
+        if metrics is not None:
+            fp.write("\n# Metrics\n")
+            fp.write(metrics.render())
+
+
+# Sampling profiler of the threads of the process. Takes the stacks of all
+# other threads every interval and charges the cpu time the thread used
+# since the last sample to its current stack (or the interval if the cpu
+# time of threads can not be measured), so threads waiting for locks or
+# the network do not show up. Stops after max_duration seconds or when
+# told to and writes the profile as collapsed stacks (for flamegraphs) and
+# in the pstats format. New stacks are folded into the stack of their
+# thread once the collapsed stacks reach max_size bytes.
+class SamplingProfiler(threading.Thread):
+
+    def __init__(self, global_data):
+
+        threading.Thread.__init__(self)
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.profile_dir = global_data.profile_dir
+        self.interval = global_data.profile_interval_ms / 1000.0
+        self.max_duration = global_data.profile_max_duration
+        self.max_size = global_data.profile_max_size
+        self.max_depth = global_data.profile_max_depth
+        self.keep_files = global_data.profile_keep_files
+
+        # Weight (seconds) and number of samples per stack. A stack is a
+        # tuple of the thread label and its frames (oldest first).
+        self.stacks = dict()
+        self.size = 0
+        self.num_samples = 0
+        self.num_truncated = 0
+
+        # Labels and cpu clocks (and their last values) of the threads.
+        self.labels = dict()
+        self.clocks = dict()
+        self.cpu_times = dict()
+
+        # Flag indicates if thread should exit.
+        self.exit_flag = False
+        self.exit_event = threading.Event()
+
+    def _update_threads(self):
+        self.labels = dict()
+        for thread in threading.enumerate():
+            if thread is self:
+                continue
+            self.labels[thread.ident] = thread_label(thread)
+            if thread.ident not in self.clocks:
+                self.clocks[thread.ident] = thread_clock(thread)
+
+    # Returns the time charged to the given thread for this sample
+    # (0.0 if the thread did not run).
+    def _weight(self, ident):
+        clock = self.clocks.get(ident)
+        if clock is None:
+            return self.interval
+        try:
+            cpu_time = time.clock_gettime(clock)
+        except OSError:
+            return 0.0
+        last_time = self.cpu_times.get(ident)
+        self.cpu_times[ident] = cpu_time
+        if last_time is None:
+            return 0.0
+        return cpu_time - last_time
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            if ident not in self.labels:
+                self._update_threads()
+                if ident not in self.labels:
+                    continue
+
+            weight = self._weight(ident)
+            if weight <= 0.0:
+                continue
+
+            frames = list()
+            while frame is not None and len(frames) < self.max_depth:
+                code = frame.f_code
+                frames.append((code.co_filename,
+                               code.co_firstlineno,
+                               code.co_name))
+                frame = frame.f_back
+            frames.reverse()
+            stack = (self.labels[ident], tuple(frames))
+
+            entry = self.stacks.get(stack)
+            if entry is None:
+                size = sum(len(x[2]) + len(x[0]) + 10 for x in frames)
+                if self.size + size > self.max_size:
+                    self.num_truncated += 1
+                    stack = (self.labels[ident], ())
+                    entry = self.stacks.get(stack)
+                else:
+                    self.size += size
+                if entry is None:
+                    entry = [0.0, 0]
+                    self.stacks[stack] = entry
+            entry[0] += weight
+            entry[1] += 1
+        self.num_samples += 1
+
+    # Writes the stacks in the collapsed format of flamegraph.pl (one line
+    # per stack with the frames separated by semicolons and the cpu time
+    # in microseconds).
+    def _write_collapsed(self, file_location):
+        with open(file_location, "w") as fp:
+            for (label, frames), (weight, _) in sorted(self.stacks.items()):
+                value = int(round(weight * 1000000.0))
+                if value == 0:
+                    continue
+                names = [label]
+                names.extend("%s (%s:%d)" % (x[2], os.path.basename(x[0]),
+                                             x[1])
+                             for x in frames)
+                if not frames:
+                    names.append("[truncated]")
+                fp.write("%s %d\n" % (";".join(names), value))
+
+    # Writes the stacks in the format of the pstats module (readable
+    # with pstats.Stats(file_location) or tools like snakeviz). The number
+    # of calls is the number of samples a function was seen in.
+    def _write_pstats(self, file_location):
+        stats = dict()
+        for (_, frames), (weight, num) in self.stacks.items():
+            seen = set()
+            for i, func in enumerate(frames):
+                is_leaf = (i == len(frames) - 1)
+                cc, nc, tt, ct, callers = stats.get(func,
+                                                    (0, 0, 0.0, 0.0, dict()))
+                if is_leaf:
+                    tt += weight
+                if func not in seen:
+                    seen.add(func)
+                    cc += num
+                    nc += num
+                    ct += weight
+                    if i > 0:
+                        caller = frames[i - 1]
+                        c_nc, c_cc, c_tt, c_ct = callers.get(
+                                                    caller, (0, 0, 0.0, 0.0))
+                        callers[caller] = (c_nc + num,
+                                           c_cc + num,
+                                           c_tt + (weight if is_leaf
+                                                   else 0.0),
+                                           c_ct + weight)
+                stats[func] = (cc, nc, tt, ct, callers)
+
+        with open(file_location, "wb") as fp:
+            marshal.dump(stats, fp)
+
+    def _write(self, duration):
+        prefix = "chasr-profile-"
+        location = os.path.join(self.profile_dir,
+                                prefix + time.strftime("%Y%m%d-%H%M%S"))
+        try:
+            self._write_collapsed(location + ".collapsed")
+            self._write_pstats(location + ".pstats")
+        except Exception:
+            logging.exception("[%s]: Can not write profile %s."
+                              % (self.file_name, location))
+            return
+
+        remove_old_files(self.profile_dir, prefix, ".collapsed",
+                         self.keep_files)
+        remove_old_files(self.profile_dir, prefix, ".pstats",
+                         self.keep_files)
+
+        logging.info("[%s]: Profile of %.1f sec with %d samples "
+                     % (self.file_name, duration, self.num_samples)
+                     + "(%d stacks, %d truncated) written to %s.*."
+                     % (len(self.stacks), self.num_truncated, location))
+
+    def run(self):
+
+        logging.info("[%s]: Starting profiler for at most %d sec "
+                     % (self.file_name, self.max_duration)
+                     + "(interval %.0f ms)." % (self.interval * 1000.0))
+
+        start = time.monotonic()
+        self._update_threads()
+        while not self.exit_flag:
+            if time.monotonic() - start >= self.max_duration:
+                break
+            try:
+                self._sample()
+            except Exception:
+                logging.exception("[%s]: Sampling failed." % self.file_name)
+                break
+            self.exit_event.wait(self.interval)
+
+        self._write(time.monotonic() - start)
+        logging.info("[%s]: Exiting profiler." % self.file_name)
+
+    # Sets exit flag.
+    def exit(self):
+        self.exit_flag = True
+        self.exit_event.set()
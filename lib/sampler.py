@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import math
+
+
+# Mean earth radius in metres.
+EARTH_RADIUS = 6371008.8
+
+
+# Returns the distance in metres between two positions (in degrees).
+def haversine(lat1, lon1, lat2, lon2):
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = (math.sin(d_phi / 2.0) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Returns the initial bearing in degrees (0 - 360) from the first
+# to the second position.
+def bearing(lat1, lon1, lat2, lon2):
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_lambda = math.radians(lon2 - lon1)
+    y = math.sin(d_lambda) * math.cos(phi2)
+    x = (math.cos(phi1) * math.sin(phi2)
+         - math.sin(phi1) * math.cos(phi2) * math.cos(d_lambda))
+    return math.degrees(math.atan2(y, x)) % 360.0
+
+
+# Decides which gps fixes are stored depending on the speed and the heading
+# of the device. The distance a fix has to be away from the last stored
+# position grows with the speed (the distance travelled in
+# lookahead seconds, bounded by min_distance and max_distance), so fast
+# straight driving stores few positions. A heading change of at least
+# heading_change degrees stores the fix earlier, so curves keep their
+# shape. A parked device moves less than min_distance and stores nothing,
+# no matter how much the altitude jitters.
+class AdaptiveSampler(object):
+
+    # Number of seconds of travel the distance threshold corresponds to.
+    lookahead = 5.0
+
+    def __init__(self, min_distance=10.0, max_distance=200.0,
+                 heading_change=15.0, max_interval=60.0):
+
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.heading_change = heading_change
+        self.max_interval = max_interval
+
+        # Last stored position.
+        self.last_time = None
+        self.last_lat = 0.0
+        self.last_lon = 0.0
+        self.last_heading = None
+
+    # Returns the distance in metres a fix has to be away from the last
+    # stored position at the given speed (in m/s).
+    def distance_threshold(self, speed):
+        return min(self.max_distance,
+                   max(self.min_distance, speed * self.lookahead))
+
+    # Returns True if the given fix should be stored. The heading is the
+    # course over ground in degrees (None if gpsd did not report it).
+    def accept(self, fix_time, lat, lon, speed, heading=None):
+
+        if self.last_time is None:
+            self._store(fix_time, lat, lon, heading)
+            return True
+
+        distance = haversine(self.last_lat, self.last_lon, lat, lon)
+        if distance < self.min_distance:
+            return False
+
+        if heading is None:
+            heading = bearing(self.last_lat, self.last_lon, lat, lon)
+
+        accepted = False
+        if distance >= self.distance_threshold(speed):
+            accepted = True
+        elif (fix_time - self.last_time) >= self.max_interval:
+            accepted = True
+        elif self.last_heading is not None:
+            change = abs(heading - self.last_heading) % 360.0
+            if min(change, 360.0 - change) >= self.heading_change:
+                accepted = True
+
+        if accepted:
+            self._store(fix_time, lat, lon, heading)
+        return accepted
+
+    def _store(self, fix_time, lat, lon, heading):
+        self.last_time = fix_time
+        self.last_lat = lat
+        self.last_lon = lon
+        self.last_heading = heading
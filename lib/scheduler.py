@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import logging
+import threading
+import os
+import time
+import random
+from .submitter import ErrorCodes
+
+
+# Decides when the submitter starts the next submission round.
+#
+# After a successful round, the next round starts after the submission
+# interval (or earlier if the backlog grows beyond the early submission
+# threshold). Transient errors (connection errors, server errors, database
+# errors, expired sessions) delay the next round exponentially up to the
+# maximal backoff, randomized by a jitter so that many devices do not retry
+# at the same time. Authentication and ACL errors will not go away by
+# retrying, so they open a circuit breaker that suspends all submissions
+# for the breaker timeout. Afterwards, a single round probes the server.
+class SubmitScheduler(object):
+
+    def __init__(self, global_data):
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.submission_interval = max(1, global_data.submission_interval)
+        self.max_backoff = max(self.submission_interval,
+                               global_data.submit_max_backoff)
+        self.breaker_timeout = global_data.breaker_timeout
+        self.early_submit_points = global_data.early_submit_points
+
+        # Woken up by new positions, the end of a round and exiting.
+        self.wakeup_event = threading.Event()
+
+        # Number of consecutive failed rounds.
+        self.failures = 0
+
+        # Flag indicates if the circuit breaker is open.
+        self.breaker_open = False
+
+        # Start of the next submission round (monotonic time).
+        self.next_round = time.monotonic() + self.submission_interval
+
+        # Flag indicates if the backlog exceeded the early
+        # submission threshold.
+        self.early_flag = False
+
+        # Flag indicates if the waiting thread should exit.
+        self.exit_flag = False
+
+    # Returns True if the last round did not fail.
+    def healthy(self):
+        return self.failures == 0 and not self.breaker_open
+
+    # Called with the size of the backlog after a position was collected.
+    # Wakes the submitter up early if the backlog exceeds the threshold.
+    def backlog_changed(self, size):
+        if (self.early_submit_points > 0
+           and size >= self.early_submit_points
+           and not self.early_flag
+           and self.healthy()):
+            self.early_flag = True
+            self.wakeup_event.set()
+
+    # Waits until the next submission round should start. Returns False
+    # if the thread should exit instead.
+    def wait(self):
+        while True:
+            if self.exit_flag:
+                return False
+            if self.early_flag and self.healthy():
+                return True
+
+            timeout = self.next_round - time.monotonic()
+            if timeout <= 0:
+                return True
+
+            self.wakeup_event.wait(timeout)
+            self.wakeup_event.clear()
+
+    # Schedules the next round after the result of the last round. The
+    # result is the error code of the first failed chunk, None if a chunk
+    # could not be submitted at all, or NO_ERROR if all chunks
+    # were submitted.
+    def record_result(self, code):
+        self.early_flag = False
+
+        if code == ErrorCodes.NO_ERROR:
+            if self.breaker_open:
+                logging.info("[%s]: Submission succeeded. "
+                             % self.file_name
+                             + "Closing circuit breaker.")
+            self.failures = 0
+            self.breaker_open = False
+            delay = self.submission_interval
+
+        elif code in (ErrorCodes.AUTH_ERROR, ErrorCodes.ACL_ERROR):
+            self.failures += 1
+            self.breaker_open = True
+            delay = self.breaker_timeout
+            logging.error("[%s]: Server refused submission (code %d). "
+                          % (self.file_name, code)
+                          + "Opening circuit breaker for %d sec."
+                          % delay)
+
+        else:
+            self.failures += 1
+            delay = min(self.max_backoff,
+                        self.submission_interval * 2 ** self.failures)
+            delay = random.uniform(delay / 2.0, delay)
+            logging.warning("[%s]: Submission failed %d time(s). "
+                            % (self.file_name, self.failures)
+                            + "Retrying in %.1f sec." % delay)
+
+        self.next_round = time.monotonic() + delay
+
+    # Schedules the next round after a round without any gps data.
+    def record_idle(self):
+        self.early_flag = False
+        self.next_round = time.monotonic() + self.submission_interval
+
+    # Sets exit flag and wakes the waiting thread up.
+    def exit(self):
+        self.exit_flag = True
+        self.wakeup_event.set()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import math
+import threading
+from .sampler import EARTH_RADIUS
+
+
+# Returns the distance in metres of point p to the segment from a to b.
+# The points are (lat, lon) tuples in degrees, projected onto a plane
+# around a (accurate enough for the short segments of a track).
+def segment_distance(a, b, p):
+    scale = math.cos(math.radians(a[0]))
+    bx = math.radians(b[1] - a[1]) * scale * EARTH_RADIUS
+    by = math.radians(b[0] - a[0]) * EARTH_RADIUS
+    px = math.radians(p[1] - a[1]) * scale * EARTH_RADIUS
+    py = math.radians(p[0] - a[0]) * EARTH_RADIUS
+
+    length = bx * bx + by * by
+    if length == 0.0:
+        return math.hypot(px, py)
+    t = max(0.0, min(1.0, (px * bx + py * by) / length))
+    return math.hypot(px - t * bx, py - t * by)
+
+
+# Simplifies tracks of gps positions before they are encrypted and sent
+# (sliding window line simplification). Starting at an anchor position,
+# the window grows as long as all positions inside it are at most
+# tolerance metres away from the line between the anchor and the newest
+# position. Otherwise, the position before the newest one is kept and
+# becomes the new anchor. The window holds at most max_window positions,
+# so memory and time per position are bounded. The first and the last
+# position of a block are always kept.
+class TrajectorySimplifier(object):
+
+    def __init__(self, tolerance, max_window=64):
+        self.tolerance = tolerance
+        self.max_window = max_window
+
+        # Number of processed and dropped positions and the
+        # estimated number of bytes not sent.
+        self.lock = threading.Lock()
+        self.num_positions = 0
+        self.num_dropped = 0
+        self.bytes_saved = 0
+
+    # Returns the kept positions of the given block of gps positions
+    # (ordered by sequence number).
+    def simplify(self, gps_data):
+        if len(gps_data) <= 2:
+            return list(gps_data)
+
+        points = [(float(x["lat"]), float(x["lon"])) for x in gps_data]
+
+        kept = [gps_data[0]]
+        anchor = 0
+        for i in range(2, len(points)):
+
+            within = (i - anchor < self.max_window)
+            if within:
+                for j in range(anchor + 1, i):
+                    if (segment_distance(points[anchor], points[i],
+                                         points[j]) > self.tolerance):
+                        within = False
+                        break
+
+            if not within:
+                anchor = i - 1
+                kept.append(gps_data[anchor])
+
+        kept.append(gps_data[-1])
+        return kept
+
+    # Records the number of dropped positions of a block and the
+    # estimated number of bytes a sent position costs.
+    def record(self, num_positions, num_dropped, bytes_per_point):
+        with self.lock:
+            self.num_positions += num_positions
+            self.num_dropped += num_dropped
+            self.bytes_saved += int(num_dropped * bytes_per_point)
+
+    def __str__(self):
+        with self.lock:
+            ratio = 0.0
+            if self.num_positions > 0:
+                ratio = float(self.num_dropped) / self.num_positions
+            return ("simplify: positions=%d dropped=%d (%.1f%%) "
+                    % (self.num_positions, self.num_dropped, ratio * 100.0)
+                    + "bytes_saved=%d" % self.bytes_saved)
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import os
+import mmap
+import struct
+import threading
+import collections
+import contextlib
+
+
+# Fixed-size record of a gps position:
+# sequence number, utc time, lat, lon, alt, speed (strings of at most
+# 14 characters, padded with zero bytes).
+POSITION_RECORD = struct.Struct("<qq14s14s14s14s")
+
+
+# Packs a gps position into a fixed-size record.
+def pack_position(element):
+    return POSITION_RECORD.pack(element["seq"],
+                                element["utctime"],
+                                element["lat"].encode("utf-8"),
+                                element["lon"].encode("utf-8"),
+                                element["alt"].encode("utf-8"),
+                                element["speed"].encode("utf-8"))
+
+
+# Converts an unpacked fixed-size record back into a gps position.
+def unpack_position(record):
+    seq, utctime, lat, lon, alt, speed = record
+    return {"lat": lat.rstrip(b"\0").decode("utf-8"),
+            "lon": lon.rstrip(b"\0").decode("utf-8"),
+            "alt": alt.rstrip(b"\0").decode("utf-8"),
+            "speed": speed.rstrip(b"\0").decode("utf-8"),
+            "utctime": utctime,
+            "seq": seq}
+
+
+# Memory maps of the segment files that are open at the same time. The
+# segments of all backlogs (e.g., of the devices of a fleet) share them,
+# so the number of open file descriptors does not grow with the number of
+# spilled positions. A segment is mapped when it is read and the least
+# recently read segment is unmapped once max_open maps are open.
+class SpillMaps(object):
+
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.maps = collections.OrderedDict()
+
+    # Returns the map of the given segment while holding the lock, so the
+    # map can not be closed while it is read.
+    @contextlib.contextmanager
+    def mapped(self, segment):
+        with self.lock:
+            mm = self.maps.get(segment)
+            if mm is None:
+                while len(self.maps) >= self.max_open:
+                    _, old_mm = self.maps.popitem(last=False)
+                    old_mm.close()
+                with open(segment.path, 'rb') as fp:
+                    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment] = mm
+            else:
+                self.maps.move_to_end(segment)
+            yield mm
+
+    # Closes the map of the given segment (if it is open).
+    def close(self, segment):
+        with self.lock:
+            mm = self.maps.pop(segment, None)
+            if mm is not None:
+                mm.close()
+
+
+spill_maps = SpillMaps()
+
+
+# Segment file of gps positions that were moved out of memory. The file
+# consists of fixed-size records and is memory-mapped while it is read, so
+# reading a chunk only pages in the records of this chunk.
+class SpillSegment(object):
+
+    def __init__(self, path, elements, maps=spill_maps):
+
+        self.path = path
+        self.maps = maps
+
+        with open(self.path, 'wb') as fp:
+            fp.write(b"".join(pack_position(x) for x in elements))
+
+        self.num_records = len(elements)
+        self.first_seq = elements[0]["seq"]
+        self.last_seq = elements[-1]["seq"]
+
+        # Index of the oldest not acknowledged record.
+        self.head = 0
+
+    def __len__(self):
+        return self.num_records - self.head
+
+    @staticmethod
+    def _seq_at(mm, index):
+        return struct.unpack_from("<q", mm, index * POSITION_RECORD.size)[0]
+
+    # Returns the index of the first record with a sequence number
+    # larger than the given one.
+    def _index_after(self, mm, seq):
+        low = self.head
+        high = self.num_records
+        while low < high:
+            mid = (low + high) // 2
+            if self._seq_at(mm, mid) <= seq:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    @staticmethod
+    def _read(mm, start, end):
+        size = POSITION_RECORD.size
+        with memoryview(mm) as view:
+            with view[start*size:end*size] as records:
+                return [unpack_position(x)
+                        for x in POSITION_RECORD.iter_unpack(records)]
+
+    # Returns at most num gps positions with a sequence number larger than
+    # the given one (or the oldest positions if seq is None).
+    def read_after(self, seq, num):
+        with self.maps.mapped(self) as mm:
+            if seq is None:
+                start = self.head
+            else:
+                start = self._index_after(mm, seq)
+            end = min(start + num, self.num_records)
+            if start >= end:
+                return list()
+            return self._read(mm, start, end)
+
+    # Returns at most num gps positions with a sequence number smaller or
+    # equal to the given one (the newest of them, ordered by sequence
+    # number).
+    def read_before(self, seq, num):
+        with self.maps.mapped(self) as mm:
+            end = self._index_after(mm, seq)
+            start = max(self.head, end - num)
+            if start >= end:
+                return list()
+            return self._read(mm, start, end)
+
+    # Returns the sequence numbers of the not acknowledged records from
+    # first_seq to last_seq (inclusive).
+    def seqs_in_range(self, first_seq, last_seq):
+        with self.maps.mapped(self) as mm:
+            start = self._index_after(mm, first_seq - 1)
+            end = self._index_after(mm, last_seq)
+            return [self._seq_at(mm, i) for i in range(start, end)]
+
+    # Returns the sequence number of the oldest not acknowledged record.
+    def head_seq(self):
+        with self.maps.mapped(self) as mm:
+            return self._seq_at(mm, self.head)
+
+    # Marks all records up to (and including) the given sequence
+    # number as acknowledged.
+    def ack(self, seq):
+        with self.maps.mapped(self) as mm:
+            self.head = self._index_after(mm, seq)
+
+    # Closes and deletes the segment file.
+    def remove(self):
+        self.maps.close(self)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
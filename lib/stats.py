@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import threading
+import time
+import collections
+
+
+# Collects the durations of an operation (e.g., a file sync). The durations
+# are also recorded in the given histogram of the metrics (if any).
+class TimingStats(object):
+
+    def __init__(self, name, histogram=None):
+        self.name = name
+        self.histogram = histogram
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    # Records the duration (in seconds) of one operation.
+    def record(self, duration):
+        with self.lock:
+            self.count += 1
+            self.total += duration
+            self.last = duration
+            if duration > self.max:
+                self.max = duration
+        if self.histogram is not None:
+            self.histogram.observe(duration)
+
+    def mean(self):
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            return self.total / self.count
+
+    def __str__(self):
+        return ("%s: count=%d mean=%.3fms max=%.3fms last=%.3fms"
+                % (self.name, self.count, self.mean() * 1000.0,
+                   self.max * 1000.0, self.last * 1000.0))
+
+
+# Collects the latest durations of an operation and computes their
+# percentiles (e.g., the time from a gps fix to its acknowledgement).
+class LatencyStats(object):
+
+    def __init__(self, name, max_samples=10000):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.samples = collections.deque(maxlen=max_samples)
+
+    # Records the duration (in seconds) of one operation.
+    def record(self, duration):
+        with self.lock:
+            self.count += 1
+            self.samples.append(duration)
+
+    # Returns the given percentile (0-100) of the recorded durations.
+    def percentile(self, percent):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        pos = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[pos]
+
+    def __str__(self):
+        return ("%s: count=%d p50=%.1fms p95=%.1fms p99=%.1fms"
+                % (self.name, self.count,
+                   self.percentile(50) * 1000.0,
+                   self.percentile(95) * 1000.0,
+                   self.percentile(99) * 1000.0))
+
+
+# Lock that measures how long threads wait for it and how long it is held.
+class TimedLock(object):
+
+    def __init__(self, name, wait_histogram=None, hold_histogram=None):
+        self.lock = threading.Lock()
+        self.wait_stats = TimingStats(name + "_wait", wait_histogram)
+        self.hold_stats = TimingStats(name + "_hold", hold_histogram)
+        self.acquired_time = 0.0
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_time = time.perf_counter()
+        self.wait_stats.record(self.acquired_time - start)
+        return True
+
+    def release(self):
+        self.hold_stats.record(time.perf_counter() - self.acquired_time)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __str__(self):
+        return ("%s: wait mean=%.1fus max=%.1fus hold mean=%.1fus max=%.1fus"
+                % (self.wait_stats.name[:-5],
+                   self.wait_stats.mean() * 1000000.0,
+                   self.wait_stats.max * 1000000.0,
+                   self.hold_stats.mean() * 1000000.0,
+                   self.hold_stats.max * 1000000.0))
@@ -7,17 +7,17 @@
 # 
 # Licensed under the GNU Affero General Public License, version 3.
 
-import requests
 import logging
 import threading
 import os
 import time
-import binascii
-import json
-import ctypes
-import hashlib
-from Crypto.Cipher import AES
-from Crypto.Hash import HMAC, SHA256
+import collections
+import queue
+import concurrent.futures
+from .crypto import CryptoEngine, derive_key, encrypt_data, get_auth_tag
+from .connection import SubmitSession
+from .simplify import TrajectorySimplifier
+from .encoding import ChunkEncoder, Compression
 
 
 class ErrorCodes:
@@ -29,6 +29,309 @@ class ErrorCodes:
     ACL_ERROR = 5
 
 
+# Outcome of a submission as label of the request metrics.
+def outcome_name(code):
+    if code is None:
+        return "failed"
+    for name, value in vars(ErrorCodes).items():
+        if value == code and not name.startswith("_"):
+            return name.lower()
+    return "unknown"
+
+
+# Chunk of gps positions prepared for the submission to the server. The
+# chunk acknowledges all positions from first_seq to last_seq, which
+# includes the positions dropped by the trajectory simplification. The
+# data points are kept in order to encode the payload again if the server
+# does not accept its encoding.
+class SubmitChunk(object):
+
+    def __init__(self, gps_data, payload, first_seq=None, last_seq=None,
+                 data_points=None):
+        self.gps_data = gps_data
+        self.payload = payload
+        self.data_points = data_points
+        self.first_seq = first_seq
+        self.last_seq = last_seq
+        if self.first_seq is None:
+            self.first_seq = gps_data[0]["seq"]
+        if self.last_seq is None:
+            self.last_seq = gps_data[-1]["seq"]
+
+
+# Thread that builds (and encrypts) the chunks of a submission round ahead
+# of the network stage. Built chunks are put into a bounded queue, the end
+# of a round is marked with None.
+#
+# With the drain order "oldest", chunks are built oldest first. With the
+# drain order "newest", a round has two lanes: the recent lane with the
+# newest recent_points positions (newest chunk first) and the history lane
+# with all older positions (oldest chunk first). The history lane gets
+# history_share of the chunks while the recent lane has chunks left.
+class ChunkBuilder(threading.Thread):
+
+    def __init__(self, submitter):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.submitter = submitter
+        self.gps_data = submitter.gps_data
+        self.gps_lock = submitter.gps_lock
+        self.gps_chunk = submitter.gps_chunk
+
+        # Number of gps positions encrypted at once.
+        self.batch_size = max(self.gps_chunk,
+                              submitter.global_data.crypto_batch)
+        self.chunk_queue = submitter.chunk_queue
+
+        self.drain_order = submitter.global_data.drain_order
+        self.recent_points = submitter.global_data.recent_points
+        self.history_share = submitter.global_data.history_share
+
+        # Last sequence number of the current submission round.
+        self.round_last_seq = None
+        self.round_event = threading.Event()
+
+        # Flag indicates if the current round should be aborted.
+        self.abort_flag = False
+
+        # Flag indicates if thread should exit.
+        self.exit_flag = False
+
+    # Starts building the chunks of all gps positions up to
+    # the given sequence number.
+    def start_round(self, last_seq):
+        self.round_last_seq = last_seq
+        self.abort_flag = False
+        self.round_event.set()
+
+    # Stops building chunks for the current round.
+    def abort_round(self):
+        self.abort_flag = True
+
+    # Yields the chunks of all gps positions up to the given sequence
+    # number (oldest first).
+    def _history_chunks(self, last_seq):
+        cursor = None
+        while True:
+
+            self.gps_lock.acquire()
+            local_gps_data = self.gps_data.peek_after(cursor,
+                                                      self.batch_size)
+            self.gps_lock.release()
+
+            local_gps_data = [x for x in local_gps_data
+                              if x["seq"] <= last_seq]
+            if not local_gps_data:
+                return
+
+            for chunk in self.submitter.build_chunks(local_gps_data):
+                yield chunk
+            cursor = local_gps_data[-1]["seq"]
+
+    # Yields the chunks of the given gps positions (newest first).
+    def _recent_chunks(self, recent_gps_data):
+        for end in range(len(recent_gps_data), 0, -self.batch_size):
+            local_gps_data = recent_gps_data[max(0, end - self.batch_size):end]
+            for chunk in reversed(self.submitter.build_chunks(local_gps_data)):
+                yield chunk
+
+    def run(self):
+
+        while True:
+            self.round_event.wait()
+            self.round_event.clear()
+
+            # Should we exit thread?
+            if self.exit_flag:
+                return
+
+            # Lanes of the round: recent lane and history lane
+            # (None if a lane has no chunks left).
+            lanes = [None, self._history_chunks(self.round_last_seq)]
+            if self.drain_order == "newest" and self.recent_points > 0:
+                self.gps_lock.acquire()
+                recent_gps_data = self.gps_data.peek_before(
+                                                    self.round_last_seq,
+                                                    self.recent_points)
+                self.gps_lock.release()
+                if recent_gps_data:
+                    lanes[0] = self._recent_chunks(recent_gps_data)
+                    lanes[1] = self._history_chunks(
+                                            recent_gps_data[0]["seq"] - 1)
+
+            num_chunks = [0, 0]
+            while not self.abort_flag and not self.exit_flag:
+
+                if lanes[0] is None and lanes[1] is None:
+                    break
+                elif lanes[0] is None:
+                    lane = 1
+                elif lanes[1] is None:
+                    lane = 0
+                elif (num_chunks[1] + 1
+                      <= self.history_share * (sum(num_chunks) + 1)):
+                    lane = 1
+                else:
+                    lane = 0
+
+                try:
+                    chunk = next(lanes[lane])
+                except StopIteration:
+                    lanes[lane] = None
+                    continue
+                except:
+                    logging.exception("[%s]: Failed to build chunks."
+                                      % self.file_name)
+                    break
+
+                num_chunks[lane] += 1
+                self.chunk_queue.put(chunk)
+
+            # Mark end of round.
+            self.chunk_queue.put(None)
+
+    # Sets exit flag.
+    def exit(self):
+        self.exit_flag = True
+        self.round_event.set()
+
+
+# Thread that submits new gps positions right after they were collected
+# (live mode). Positions arriving within the live window are coalesced into
+# one request. The backlog of older positions is drained by the submission
+# rounds of the submitter, which yield to this thread.
+class LiveSubmitter(threading.Thread):
+
+    def __init__(self, submitter):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Used for logging.
+        self.file_name = os.path.basename(__file__)
+
+        self.submitter = submitter
+        self.scheduler = submitter.scheduler
+        self.live_window = submitter.global_data.live_window_ms / 1000.0
+
+        # Time from collecting a gps position until the server
+        # acknowledged it.
+        self.fix_latency = submitter.global_data.fix_latency
+
+        # Lock protects the pending positions and the claimed
+        # sequence numbers.
+        self.lock = threading.Lock()
+        self.pending = list()
+
+        # Sequence numbers of the positions that are pending or sent
+        # by this thread (they are not sent by the submission rounds).
+        self.claimed = set()
+
+        # Collection time of the positions not acknowledged yet
+        # (at most max_tracked positions are tracked).
+        self.fix_times = dict()
+        self.max_tracked = 10000
+
+        # Set if new positions are pending.
+        self.live_event = threading.Event()
+
+        # Set if no positions are pending or being sent.
+        self.idle_event = threading.Event()
+        self.idle_event.set()
+
+        # Flag indicates if thread should exit.
+        self.exit_flag = False
+        self.exit_event = threading.Event()
+
+    # Queues a collected gps position for the live submission.
+    def push(self, element):
+        with self.lock:
+            self.pending.append(element)
+            self.claimed.add(element["seq"])
+            self.fix_times[element["seq"]] = time.monotonic()
+            if len(self.fix_times) > self.max_tracked:
+                del self.fix_times[next(iter(self.fix_times))]
+            self.idle_event.clear()
+        self.live_event.set()
+
+    # Returns the oldest sequence number claimed by this thread
+    # (or None if no position is claimed).
+    def oldest_claim(self):
+        with self.lock:
+            if not self.claimed:
+                return None
+            return min(self.claimed)
+
+    # Records the latency of the acknowledged positions of the given chunk.
+    def acked(self, chunk):
+        now = time.monotonic()
+        with self.lock:
+            for element in chunk.gps_data:
+                fix_time = self.fix_times.pop(element["seq"], None)
+                if fix_time is not None:
+                    self.fix_latency.record(now - fix_time)
+
+    # Releases the claim of the given positions, they are submitted
+    # by the submission rounds afterwards.
+    def _release(self, elements):
+        with self.lock:
+            for element in elements:
+                self.claimed.discard(element["seq"])
+            if not self.pending:
+                self.idle_event.set()
+
+    def _submit(self, elements):
+
+        # Let the submission rounds back off after failed submissions.
+        if not self.scheduler.healthy():
+            return
+
+        try:
+            chunks = self.submitter.build_chunks(elements, simplify=False)
+        except:
+            logging.exception("[%s]: Failed to build live chunks."
+                              % self.file_name)
+            return
+
+        for chunk in chunks:
+            code = self.submitter.send_chunk(chunk)
+            if code != ErrorCodes.NO_ERROR:
+                self.scheduler.record_result(code)
+                return
+            self.submitter.ack_chunk(chunk)
+
+    def run(self):
+
+        while True:
+            self.live_event.wait()
+
+            # Wait for further positions arriving within the live window.
+            self.exit_event.wait(self.live_window)
+            self.live_event.clear()
+
+            # Should we exit thread?
+            if self.exit_flag:
+                return
+
+            with self.lock:
+                elements = self.pending
+                self.pending = list()
+
+            self._submit(elements)
+            self._release(elements)
+
+    # Sets exit flag.
+    def exit(self):
+        self.exit_flag = True
+        self.exit_event.set()
+        self.live_event.set()
+
+
 class DataSubmitter(threading.Thread):
 
     def __init__(self, global_data):
@@ -41,6 +344,47 @@ class DataSubmitter(threading.Thread):
         logging.debug("[%s]: Initializing submitter thread."
                       % self.file_name)
 
+        # Submit new positions right after they were collected. The live
+        # thread needs its own connection besides the submission rounds.
+        self.live_mode = (global_data.submission_mode == "live")
+        pool_size = global_data.pool_size
+        if self.live_mode:
+            pool_size = max(pool_size, global_data.inflight_chunks + 1)
+
+        self._init_common(global_data, pool_size)
+
+        self.device_name = self.global_data.device_name
+
+        # Gps data.
+        self.gps_data = self.global_data.gps_data
+        self.gps_lock = self.global_data.gps_lock
+
+        # Thread writing the gps data into the journal.
+        self.persistence = self.global_data.persistence
+
+        # Chunks are built ahead of the network stage into a bounded queue.
+        self.chunk_queue = queue.Queue(self.global_data.pipeline_depth)
+        self.builder = ChunkBuilder(self)
+
+        # Thread submitting new positions in live mode. The collector
+        # hands new positions to it.
+        if self.live_mode:
+            self.live = LiveSubmitter(self)
+            self.global_data.live_submitter = self.live
+
+        # Create a encryption key from the secret.
+        self.key = derive_key(self.global_data.secret)
+
+        # Batch crypto engine used to encrypt the gps data.
+        self.crypto = CryptoEngine(self.key,
+                                   self.device_name,
+                                   self.global_data.crypto_processes)
+
+    # Sets up the state that is shared with the fleet submitter: the
+    # submission settings, the http session, the network stage, the
+    # encoder, the simplifier and the metrics.
+    def _init_common(self, global_data, pool_size):
+
         self.global_data = global_data
 
         # Data needed for online submission.
@@ -48,307 +392,451 @@ class DataSubmitter(threading.Thread):
         self.username = self.global_data.username
         self.password = self.global_data.password
         self.server = self.global_data.server
-        self.device_name = self.global_data.device_name
         self.verify_cert = self.global_data.verify_cert
-
-        # Gps data.
-        self.gps_data = self.global_data.gps_data
-        self.gps_lock = self.global_data.gps_lock
         self.gps_chunk = self.global_data.gps_chunk
 
-        # Data needed for storing gps data in file.
-        self.tempfile = self.global_data.tempfile
-        self.sync_always = self.global_data.sync_always
-        if self.sync_always:
-            self.libc = ctypes.CDLL("libc.so.6")
-        else:
-            self.libc = None
+        # Persistent http session used for all submissions.
+        self.session = SubmitSession(self.server,
+                                     self.verify_cert,
+                                     self.global_data.connect_timeout,
+                                     self.global_data.read_timeout,
+                                     pool_size)
+
+        # Decides when the next submission round starts.
+        self.scheduler = self.global_data.scheduler
+
+        # Up to inflight_chunks chunks are sent simultaneously.
+        self.inflight_chunks = self.global_data.inflight_chunks
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                                        max_workers=self.inflight_chunks)
+
+        # Encoder of the requests. Falls back to the legacy request format
+        # if the server does not accept the configured one.
+        self.encoder = ChunkEncoder(
+                            self.global_data.compact_encoding,
+                            self.global_data.compression,
+                            self.global_data.encoding_reprobe_interval)
+
+        # Simplification of the tracks before they are encrypted (None if
+        # all positions are sent). Live positions are not simplified.
+        self.simplifier = None
+        if self.global_data.simplify_tolerance > 0:
+            self.simplifier = TrajectorySimplifier(
+                                    self.global_data.simplify_tolerance)
+
+        # Thread submitting new positions in live mode (only used by
+        # the single device submitter).
+        self.live = None
 
         # Flag indicates if thread should exit.
         self.exit_flag = False
 
-        # Create a encryption key from the secret.
-        sha256 = hashlib.sha256()
-        sha256.update(self.global_data.secret.encode("utf-8"))
-        self.key = sha256.digest()
+        self._create_metrics()
+
+    # Creates the metrics of the encryption and of the requests.
+    def _create_metrics(self):
+        metrics = self.global_data.metrics
+        self.encrypt_histogram = metrics.histogram(
+                                    "chasr_encrypt_seconds",
+                                    "Duration of encrypting a batch of "
+                                    + "gps positions.")
+        self.encrypted_counter = metrics.counter(
+                                    "chasr_encrypted_points_total",
+                                    "Number of encrypted gps positions.")
+        self.request_histogram = metrics.histogram(
+                                    "chasr_http_request_seconds",
+                                    "Duration of submitting a chunk to the "
+                                    + "server by outcome.",
+                                    ["outcome"])
+        self.submitted_counter = metrics.counter(
+                                    "chasr_submitted_points_total",
+                                    "Number of gps positions acknowledged "
+                                    + "by the server.")
+
+    # Encrypts the given gps positions and records the duration.
+    def build_data_points(self, crypto, positions):
+        start = time.perf_counter()
+        data_points = crypto.build_data_points(positions)
+        self.encrypt_histogram.observe(time.perf_counter() - start)
+        self.encrypted_counter.inc(len(positions))
+        return data_points
 
     # Encrypt gps data.
     def encrypt_data(self, iv: bytes, data: str):
-
-        # Pad data in PKCS#7.
-        padded_data = data.encode("utf-8")
-        padding = 16 - (len(padded_data) % 16)
-        for i in range(padding):
-            padded_data += chr(padding).encode("utf-8")
-
-        cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return cipher.encrypt(padded_data)
+        return encrypt_data(self.key, iv, data)
 
     # Create auth tag for data.
     def get_auth_tag(self, device_name, utctime, lat, lon, alt, speed):
-
-        hmac = HMAC.new(self.key, digestmod=SHA256)
-
-        # Convert to bytes if string.
-        if type(device_name) == str:
-            device_name = device_name.encode("utf-8")
-        if type(lat) == str:
-            lat = lat.encode("utf-8")
-        if type(lon) == str:
-            lon = lon.encode("utf-8")
-        if type(alt) == str:
-            alt = alt.encode("utf-8")
-        if type(speed) == str:
-            speed = speed.encode("utf-8")
-        utctime = str(utctime).encode("utf-8")
-
-        hmac.update(device_name)
-        hmac.update(utctime)
-        hmac.update(lat)
-        hmac.update(lon)
-        hmac.update(alt)
-        hmac.update(speed)
-        return hmac.hexdigest()
-
-    def run(self):
-
-        logging.info("[%s]: Starting submitter thread with %s sec interval."
-                     % (self.file_name, self.submission_interval))
-
+        return get_auth_tag(self.key, device_name, utctime, lat, lon, alt,
+                            speed)
+
+    # Sanity check of an encrypted data point.
+    def check_data_point(self, data_point):
+        for key in ["iv", "lat", "lon", "alt", "speed"]:
+            if len(data_point[key]) != 32:
+                logging.error("[%s] Length error during "
+                              % self.file_name
+                              + "encryption. "
+                              + "Skipping gps position.")
+                return False
+        if len(data_point["authtag"]) != 64:
+            logging.error("[%s] Length error during "
+                          % self.file_name
+                          + "auth tag creation. "
+                          + "Skipping gps position.")
+            return False
+        return True
+
+    # Builds the chunks of the given gps positions that are sent
+    # to the server.
+    def build_chunks(self, local_gps_data, simplify=True):
+
+        # Drop positions that do not change the shape of the track.
+        send_positions = local_gps_data
+        if simplify and self.simplifier is not None:
+            send_positions = self.simplifier.simplify(local_gps_data)
+
+        # Prepare data to be sent.
+        data_points = self.build_data_points(self.crypto, send_positions)
+
+        chunks = list()
+        num_bytes = 0
+        first_seq = local_gps_data[0]["seq"]
+        for pos in range(0, len(send_positions), self.gps_chunk):
+
+            send_gps_data = [x for x in data_points[pos:pos+self.gps_chunk]
+                             if self.check_data_point(x)]
+
+            # Prepare POST data.
+            payload = self.encoder.encode_payload(self.username,
+                                                  self.password,
+                                                  send_gps_data)
+
+            num_bytes += len(payload["gps_data"])
+
+            # The last chunk also acknowledges the dropped
+            # positions at the end.
+            if pos + self.gps_chunk >= len(send_positions):
+                last_seq = local_gps_data[-1]["seq"]
+            else:
+                last_seq = send_positions[pos+self.gps_chunk-1]["seq"]
+
+            chunks.append(SubmitChunk(
+                                send_positions[pos:pos+self.gps_chunk],
+                                payload,
+                                first_seq,
+                                last_seq,
+                                send_gps_data))
+            first_seq = last_seq + 1
+
+        if send_positions is not local_gps_data:
+            self.simplifier.record(len(local_gps_data),
+                                   len(local_gps_data) - len(send_positions),
+                                   float(num_bytes) / len(send_positions))
+
+        return chunks
+
+    # Sends the given chunk to the server. Returns the result code
+    # of the server or None if the submission failed.
+    def send_chunk(self, chunk):
+        self.encoder.reprobe()
+        start = time.perf_counter()
+        code = self._send_chunk(chunk)
+        self.request_histogram.labels(outcome_name(code)).observe(
+                                            time.perf_counter() - start)
+        return code
+
+    def _send_chunk(self, chunk):
+
+        # Encode chunk again if the server rejected its encoding.
+        if not self.encoder.is_current(chunk.payload):
+            chunk.payload = self.encoder.encode_payload(self.username,
+                                                        self.password,
+                                                        chunk.data_points)
+        state = self.encoder.state()
+        negotiating = (state != (False, Compression.NONE))
+
+        # Submit data.
+        r = None
+        try:
+            body, headers = self.encoder.encode_body(chunk.payload)
+            r = self.session.post(body, headers, len(chunk.data_points))
+        except:
+            logging.exception("[%s] Failed to send POST request."
+                              % self.file_name)
+            return None
+
+        # Send chunk again in a more compatible format if the server
+        # does not understand the request.
+        if (negotiating
+           and r.status_code in [400, 415]
+           and self.encoder.fallback(state)):
+            return self._send_chunk(chunk)
+
+        # Abort submission if we have a server error.
+        if r.status_code != 200:
+            logging.error("[%s]: Unable to submit data. "
+                          % self.file_name
+                          + "Server status code: %d."
+                          % r.status_code)
+            return None
+
+        # Parse response.
+        try:
+            request_result = r.json()
+        except:
+            if negotiating and self.encoder.fallback(state):
+                return self._send_chunk(chunk)
+            logging.exception("[%s] Failed to decode json response."
+                              % self.file_name)
+            logging.debug("[%s] Json response: %s"
+                          % (self.file_name, r.text))
+            return None
+
+        # A server that does not understand the request format does not
+        # find the credentials or the gps data in it. The chunk is sent once
+        # more in the legacy format to tell this apart from a wrong password
+        # or an illegal data point. The configured format is only given up
+        # if the server accepts the chunk in the legacy format.
+        if (negotiating
+           and request_result["code"] in [ErrorCodes.AUTH_ERROR,
+                                          ErrorCodes.ILLEGAL_MSG_ERROR]
+           and self._send_legacy(chunk)):
+            self.encoder.fallback_legacy(state)
+            return ErrorCodes.NO_ERROR
+
+        if request_result["code"] == ErrorCodes.NO_ERROR:
+            return ErrorCodes.NO_ERROR
+
+        # Server has a database error.
+        elif request_result["code"] == ErrorCodes.DATABASE_ERROR:
+            logging.error("[%s] Failed to submit gps data. "
+                          % self.file_name
+                          + "Server has a database error.")
+            if "msg" in request_result.keys():
+                logging.error("[%s] Server message: %s"
+                              % (self.file_name,
+                                request_result["msg"]))
+            return request_result["code"]
+
+        # Authentication error.
+        elif request_result["code"] == ErrorCodes.AUTH_ERROR:
+            logging.error("[%s] Failed to submit gps data. "
+                          % self.file_name
+                          + "Authentication failed.")
+            if "msg" in request_result.keys():
+                logging.error("[%s] Server message: %s"
+                              % (self.file_name,
+                                request_result["msg"]))
+            return request_result["code"]
+
+        # Illegal message error.
+        elif request_result["code"] == ErrorCodes.ILLEGAL_MSG_ERROR:
+            logging.error("[%s] Failed to submit gps data. "
+                          % self.file_name
+                          + "Message illegal.")
+            if "msg" in request_result.keys():
+                logging.error("[%s] Server message: %s"
+                              % (self.file_name,
+                                request_result["msg"]))
+            return request_result["code"]
+
+        # Session expired error.
+        elif request_result["code"] == ErrorCodes.SESSION_EXPIRED:
+            logging.error("[%s] Failed to submit gps data. "
+                          % self.file_name
+                          + "Session expired.")
+            if "msg" in request_result.keys():
+                logging.error("[%s] Server message: %s"
+                              % (self.file_name,
+                                request_result["msg"]))
+            return request_result["code"]
+
+        # Request not allowed (e.g., no device slots left).
+        elif request_result["code"] == ErrorCodes.ACL_ERROR:
+            logging.error("[%s] Failed to submit gps data. "
+                          % self.file_name
+                          + "ACL error.")
+            if "msg" in request_result.keys():
+                logging.error("[%s] Server message: %s"
+                              % (self.file_name,
+                                request_result["msg"]))
+            return request_result["code"]
+
+        # Unknown error.
+        else:
+            logging.error("[%s] Failed to submit gps data. "
+                          % self.file_name
+                          + "Unknown error: %d."
+                          % request_result["code"])
+            if "msg" in request_result.keys():
+                logging.error("[%s] Server message: %s"
+                              % (self.file_name,
+                                request_result["msg"]))
+            return request_result["code"]
+
+    # Sends the given chunk in the legacy format. Returns True if the
+    # server accepted it.
+    def _send_legacy(self, chunk):
+        try:
+            body, headers = self.encoder.encode_legacy(self.username,
+                                                       self.password,
+                                                       chunk.data_points)
+            r = self.session.post(body, headers, len(chunk.data_points))
+            return (r.status_code == 200
+                    and r.json()["code"] == ErrorCodes.NO_ERROR)
+        except:
+            logging.exception("[%s] Failed to send POST request in the "
+                              % self.file_name
+                              + "legacy format.")
+            return False
+
+    # Removes the submitted gps positions of the given chunk from
+    # the global gps data and marks them as acknowledged in the journal.
+    def ack_chunk(self, chunk):
+        logging.debug("[%s]: Acquire lock." % self.file_name)
+        self.gps_lock.acquire()
+
+        # Remove all gps positions we submitted.
+        self.gps_data.ack_range(chunk.first_seq, chunk.last_seq)
+        self.submitted_counter.inc(chunk.last_seq - chunk.first_seq + 1)
+
+        # Queue marking the submitted gps positions as acknowledged
+        # in the journal on storage.
+        self.persistence.ack(chunk.first_seq, chunk.last_seq)
+
+        logging.debug("[%s]: Release lock." % self.file_name)
+        self.gps_lock.release()
+
+        if self.live is not None:
+            self.live.acked(chunk)
+
+    # Returns the sequence number of the newest gps position the next
+    # submission round submits (or None if there is nothing to submit).
+    # Positions claimed by the live thread are left out.
+    def round_last_seq(self):
+        self.gps_lock.acquire()
+        oldest = self.gps_data.peek(1)
+        last_seq = self.gps_data.last_seq()
+
+        # The collector claims new positions for the live thread while
+        # holding the lock, so every position up to last_seq that is sent
+        # live is claimed at this point.
+        oldest_claim = None
+        if self.live is not None:
+            oldest_claim = self.live.oldest_claim()
+        self.gps_lock.release()
+        if not oldest:
+            return None
+
+        if oldest_claim is not None:
+            last_seq = min(last_seq, oldest_claim - 1)
+        if last_seq < oldest[0]["seq"]:
+            return None
+        return last_seq
+
+    # Submits all gps data that is currently stored. Chunks are built by
+    # the chunk builder thread ahead of the network stage. Up to
+    # inflight_chunks chunks are sent simultaneously, but they are
+    # acknowledged strictly in the order of their sequence numbers. In live
+    # mode, chunks are only sent while the live thread is idle and
+    # positions claimed by it are left out.
+    # Returns the result code of the first failed chunk (None if it could
+    # not be submitted at all) or NO_ERROR if all chunks were submitted.
+    def submit_gps_data(self):
+
+        # Only submit the gps data that exists at the start of the
+        # submission.
+        last_seq = self.round_last_seq()
+        if last_seq is None:
+            return ErrorCodes.NO_ERROR
+
+        self.builder.start_round(last_seq)
+
+        pending = collections.deque()
+        failed = False
+        result = ErrorCodes.NO_ERROR
+        builder_done = False
         while True:
-            # Wait submission_interval number of seconds.
-            for i in range(self.submission_interval):
-                time.sleep(1)
 
-                # Should we exit thread?
-                if self.exit_flag:
-                    logging.info("[%s]: Exiting submitter thread."
-                                 % self.file_name)
-                    return
+            # Fill the network stage with chunks.
+            while not failed and not builder_done \
+                    and len(pending) < self.inflight_chunks:
+                chunk = self.chunk_queue.get()
+                if chunk is None:
+                    builder_done = True
+                    break
 
-            # Check if we have any gps data to submit.
-            if len(self.gps_data) == 0:
-                continue
+                # Live positions have priority.
+                if self.live is not None:
+                    self.live.idle_event.wait()
+                pending.append((chunk,
+                                self.executor.submit(self.send_chunk, chunk)))
 
-            # Submit gps data in chunks in order to prevent the connection
-            # from blocking.
-            iterations = int((len(self.gps_data) / self.gps_chunk) + 1)
-            for _ in range(iterations):
+            if not pending:
+                break
 
-                # Copy first X elements of global gps data.
-                logging.debug("[%s]: Acquire lock." % self.file_name)
-                self.gps_lock.acquire()
-                local_gps_data = list(self.gps_data[:self.gps_chunk])
-                logging.debug("[%s]: Release lock." % self.file_name)
-                self.gps_lock.release()
+            chunk, future = pending.popleft()
+            code = future.result()
+            if failed:
+                continue
 
-                # Prepare data to be sent.
-                send_gps_data = list()
-                for data in local_gps_data:
-
-                    # Get IV for encryption.
-                    iv = os.urandom(16)
-
-                    data_point = dict()
-                    data_point["iv"] = binascii.hexlify(iv).decode("utf-8")
-                    data_point["device_name"] = self.device_name
-                    data_point["utctime"] = data["utctime"]
-
-                    # Create auth tag for data.
-                    auth_tag = self.get_auth_tag(self.device_name,
-                                                 data["utctime"],
-                                                 data["lat"],
-                                                 data["lon"],
-                                                 data["alt"],
-                                                 data["speed"])
-                    data_point["authtag"] = auth_tag
-
-                    # Encrypt gps data.
-                    enc_lat = self.encrypt_data(iv, data["lat"])
-                    enc_lon = self.encrypt_data(iv, data["lon"])
-                    enc_alt = self.encrypt_data(iv, data["alt"])
-                    enc_speed = self.encrypt_data(iv, data["speed"])
-                    data_point["lat"] = binascii.hexlify(enc_lat).decode(
-                                                                       "utf-8")
-                    data_point["lon"] = binascii.hexlify(enc_lon).decode(
-                                                                       "utf-8")
-                    data_point["alt"] = binascii.hexlify(enc_alt).decode(
-                                                                       "utf-8")
-                    data_point["speed"] = binascii.hexlify(enc_speed).decode(
-                                                                       "utf-8")
-
-                    # Sanity check.
-                    skip = False
-                    for key in ["iv", "lat", "lon", "alt", "speed"]:
-                        if len(data_point[key]) != 32:
-                            logging.error("[%s] Length error during "
-                                          % self.file_name
-                                          + "encryption. "
-                                          + "Skipping gps position.")
-                            skip = True
-                            break
-                    if len(data_point["authtag"]) != 64:
-                        logging.error("[%s] Length error during "
-                                      % self.file_name
-                                      + "auth tag creation. "
-                                      + "Skipping gps position.")
-                        skip = True
-                        break
-                    if skip:
-                        continue
-
-                    send_gps_data.append(data_point)
-
-                # Prepare POST data.
-                payload = {"user": self.username,
-                           "password": self.password,
-                           "gps_data": json.dumps(send_gps_data)}
-
-                # Submit data.
-                r = None
-                try:
-                    r = requests.post(self.server,
-                                      verify=self.verify_cert,
-                                      data=payload)
-                except:
-                    logging.exception("[%s] Failed to send POST request."
-                                      % self.file_name)
-                    break
+            if code == ErrorCodes.NO_ERROR:
+                self.ack_chunk(chunk)
+            else:
+                failed = True
+                result = code
+                self.builder.abort_round()
 
-                # Abort submission if we have a server error.
-                if r.status_code != 200:
-                    logging.error("[%s]: Unable to submit data. "
-                                  % self.file_name
-                                  + "Server status code: %d."
-                                  % r.status_code)
-                    break
+        # Wait until the chunk builder finished the round.
+        while not builder_done:
+            if self.chunk_queue.get() is None:
+                builder_done = True
 
-                # Parse response.
-                try:
-                    request_result = r.json()
-                except:
-                    logging.exception("[%s] Failed to decode json response."
-                                      % self.file_name)
-                    logging.debug("[%s] Json response: %s"
-                                  % (self.file_name, r.text))
-                    break
+        return result
 
-                # When submission was successful, remove submitted data from
-                # global gps data and write it to storage.
-                if request_result["code"] == ErrorCodes.NO_ERROR:
-                    logging.debug("[%s]: Acquire lock." % self.file_name)
-                    self.gps_lock.acquire()
-
-                    # Remove all gps positions we submitted.
-                    for loc_data in local_gps_data:
-                        for glob_data in self.gps_data:
-
-                            has_time = (loc_data["utctime"]
-                                       == glob_data["utctime"])
-                            has_lat = (loc_data["lat"]
-                                      == glob_data["lat"])
-                            has_long = (loc_data["lon"]
-                                       == glob_data["lon"])
-                            has_alt = (loc_data["alt"]
-                                      == glob_data["alt"])
-                            has_speed = (loc_data["speed"]
-                                      == glob_data["speed"])
-
-                            if (has_time
-                               and has_lat
-                               and has_long
-                               and has_alt
-                               and has_speed):
-
-                               self.gps_data.remove(glob_data)
-                               break
-
-                    # Wirte data to storage.
-                    try:
-                        with open(self.tempfile, 'w') as fp:
-                            fp.write(json.dumps(self.gps_data))
-
-                        # Sync filesystem to force writing on storage
-                        if self.sync_always:
-                            self.libc.sync()
-                    except:
-                        logging.exception("[%s]: Can not write into "
-                                          % self.file_name
-                                          + "tempfile (%s)."
-                                          % self.tempfile)
-
-                    logging.debug("[%s]: Release lock." % self.file_name)
-                    self.gps_lock.release()
-
-                # Server has a database error.
-                elif request_result["code"] == ErrorCodes.DATABASE_ERROR:
-                    logging.error("[%s] Failed to submit gps data. "
-                                  % self.file_name
-                                  + "Server has a database error.")
-                    if "msg" in request_result.keys():
-                        logging.error("[%s] Server message: %s"
-                                      % (self.file_name,
-                                        request_result["msg"]))
-                    break
+    def run(self):
 
-                # Authentication error.
-                elif request_result["code"] == ErrorCodes.AUTH_ERROR:
-                    logging.error("[%s] Failed to submit gps data. "
-                                  % self.file_name
-                                  + "Authentication failed.")
-                    if "msg" in request_result.keys():
-                        logging.error("[%s] Server message: %s"
-                                      % (self.file_name,
-                                        request_result["msg"]))
-                    break
+        logging.info("[%s]: Starting submitter thread with %s sec interval."
+                     % (self.file_name, self.submission_interval))
 
-                # Illegal message error.
-                elif request_result["code"] == ErrorCodes.ILLEGAL_MSG_ERROR:
-                    logging.error("[%s] Failed to submit gps data. "
-                                  % self.file_name
-                                  + "Message illegal.")
-                    if "msg" in request_result.keys():
-                        logging.error("[%s] Server message: %s"
-                                      % (self.file_name,
-                                        request_result["msg"]))
-                    break
+        self.builder.start()
+        if self.live is not None:
+            self.live.start()
 
-                # Session expired error.
-                elif request_result["code"] == ErrorCodes.SESSION_EXPIRED:
-                    logging.error("[%s] Failed to submit gps data. "
-                                  % self.file_name
-                                  + "Session expired.")
-                    if "msg" in request_result.keys():
-                        logging.error("[%s] Server message: %s"
-                                      % (self.file_name,
-                                        request_result["msg"]))
-                    break
+        while True:
+            # Wait until the scheduler starts the next submission round
+            # or tells the thread to exit.
+            if not self.scheduler.wait():
+                logging.info("[%s]: Exiting submitter thread."
+                             % self.file_name)
+                logging.info("[%s]: %s" % (self.file_name, self.session))
+                if self.simplifier is not None:
+                    logging.info("[%s]: %s" % (self.file_name,
+                                               self.simplifier))
+                if self.live is not None:
+                    logging.info("[%s]: %s"
+                                 % (self.file_name,
+                                    self.global_data.fix_latency))
+                    self.live.exit()
+                self.builder.exit()
+                self.executor.shutdown(wait=False)
+                self.crypto.close()
+                self.session.close()
+                return
 
-                # Request not allowed (e.g., no device slots left).
-                elif request_result["code"] == ErrorCodes.ACL_ERROR:
-                    logging.error("[%s] Failed to submit gps data. "
-                                  % self.file_name
-                                  + "ACL error.")
-                    if "msg" in request_result.keys():
-                        logging.error("[%s] Server message: %s"
-                                      % (self.file_name,
-                                        request_result["msg"]))
-                    break
+            # Check if we have any gps data to submit.
+            if self.round_last_seq() is None:
+                self.scheduler.record_idle()
+                continue
 
-                # Unknown error.
-                else:
-                    logging.error("[%s] Failed to submit gps data. "
-                                  % self.file_name
-                                  + "Unknown error: %d."
-                                  % request_result["code"])
-                    if "msg" in request_result.keys():
-                        logging.error("[%s] Server message: %s"
-                                      % (self.file_name,
-                                        request_result["msg"]))
-                    break
+            # Submit gps data in chunks in order to prevent the connection
+            # from blocking.
+            self.scheduler.record_result(self.submit_gps_data())
 
     # Sets exit flag.
     def exit(self):
         logging.debug("[%s]: Telling submitter thread to exit."
                       % self.file_name)
-        self.exit_flag = True
\ No newline at end of file
+        self.exit_flag = True
+        self.scheduler.exit()
\ No newline at end of file
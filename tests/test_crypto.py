@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import binascii
+import os
+import sys
+import unittest
+from unittest import mock
+from Crypto.Cipher import AES
+from Crypto.Hash import HMAC, SHA256
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib import CryptoEngine
+from lib.crypto import derive_key, encrypt_data, get_auth_tag
+
+
+DEVICE_NAME = "test_device"
+
+
+# Returns the gps position with the given index. Every seventh position has
+# values that do not fit into a single AES block.
+def make_position(index):
+    if index % 7 == 6:
+        return {"lat": "-33.86000000000001%d" % index,
+                "lon": "151.2000000000000%d" % index,
+                "alt": "-2.5",
+                "speed": "0.0",
+                "utctime": 1517515200 + index}
+    return {"lat": "%.6f" % (52.5 + index * 0.0001),
+            "lon": "%.6f" % (-13.4 - index * 0.0001),
+            "alt": "%.1f" % (34.0 - index * 0.5),
+            "speed": "%.1f" % (index % 30),
+            "utctime": 1517515200 + index}
+
+
+# Returns the IV with the given number.
+def make_iv(number):
+    return number.to_bytes(8, "big") + b"\xa5" * 8
+
+
+# Builds the data point for a gps position field by field (the way data
+# points were built before the batch crypto engine).
+def old_data_point(key, iv, data):
+
+    data_point = dict()
+    data_point["iv"] = binascii.hexlify(iv).decode("utf-8")
+    data_point["device_name"] = DEVICE_NAME
+    data_point["utctime"] = data["utctime"]
+
+    hmac = HMAC.new(key, digestmod=SHA256)
+    hmac.update(DEVICE_NAME.encode("utf-8"))
+    hmac.update(str(data["utctime"]).encode("utf-8"))
+    for key_name in ["lat", "lon", "alt", "speed"]:
+        hmac.update(data[key_name].encode("utf-8"))
+    data_point["authtag"] = hmac.hexdigest()
+
+    for key_name in ["lat", "lon", "alt", "speed"]:
+        padded_data = data[key_name].encode("utf-8")
+        padding = 16 - (len(padded_data) % 16)
+        for i in range(padding):
+            padded_data += chr(padding).encode("utf-8")
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        data_point[key_name] = binascii.hexlify(
+                                    cipher.encrypt(padded_data)).decode("utf-8")
+
+    return data_point
+
+
+class TestCryptoEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.key = derive_key("test_secret")
+
+    # Compares the given data points with the data points built field by
+    # field from their IVs.
+    def _check_data_points(self, gps_data, data_points):
+        self.assertEqual(len(data_points), len(gps_data))
+        for data, data_point in zip(gps_data, data_points):
+            iv = binascii.unhexlify(data_point["iv"])
+            expected = old_data_point(self.key, iv, data)
+            for key_name in ["iv", "device_name", "utctime", "authtag",
+                             "lat", "lon", "alt", "speed"]:
+                self.assertEqual(data_point[key_name], expected[key_name],
+                                 "%s of position %d differs"
+                                 % (key_name, data["utctime"]))
+
+            # The helper functions produce the same output.
+            self.assertEqual(
+                data_point["lat"],
+                binascii.hexlify(encrypt_data(self.key, iv,
+                                              data["lat"])).decode("utf-8"))
+            self.assertEqual(data_point["authtag"],
+                             get_auth_tag(self.key, DEVICE_NAME,
+                                          data["utctime"], data["lat"],
+                                          data["lon"], data["alt"],
+                                          data["speed"]))
+
+    def test_small_batch(self):
+        engine = CryptoEngine(self.key, DEVICE_NAME, 2, min_batch=100)
+        gps_data = [make_position(i) for i in range(50)]
+
+        ivs = iter(make_iv(i) for i in range(len(gps_data)))
+        with mock.patch("lib.crypto.os.urandom",
+                        side_effect=lambda size: next(ivs)):
+            data_points = engine.build_data_points(gps_data)
+
+        self.assertIsNone(engine.pool)
+        self.assertEqual([x["iv"] for x in data_points],
+                         [binascii.hexlify(make_iv(i)).decode("utf-8")
+                          for i in range(len(gps_data))])
+        self._check_data_points(gps_data, data_points)
+
+    # The IVs can not be pinned in the worker processes, so the output of
+    # every position is compared with the output of the field by field
+    # encryption using the IV of the position.
+    def test_pool_batch(self):
+        engine = CryptoEngine(self.key, DEVICE_NAME, 2, min_batch=100)
+        self.addCleanup(engine.close)
+        gps_data = [make_position(i) for i in range(250)]
+
+        data_points = engine.build_data_points(gps_data)
+
+        self.assertIsNotNone(engine.pool)
+        self.assertEqual(engine.num_processes, 2)
+        self.assertEqual(len(set(x["iv"] for x in data_points)),
+                         len(gps_data))
+        self._check_data_points(gps_data, data_points)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chasr
+from lib import GlobalData
+from lib import TrackImporter
+
+
+# Track around Sydney (southern and eastern hemisphere) ending below sea
+# level.
+GPX_TRACK = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+<trk><trkseg>
+<trkpt lat="-33.8600" lon="151.2000"><ele>5.0</ele>
+<time>2018-02-01T20:00:00Z</time></trkpt>
+<trkpt lat="-33.8610" lon="151.2010"><ele>-2.5</ele>
+<time>2018-02-01T20:00:10Z</time></trkpt>
+<trkpt lat="-33.8620" lon="151.2020"><ele>-5.0</ele>
+<time>2018-02-01T20:00:20Z</time></trkpt>
+</trkseg></trk>
+</gpx>
+"""
+
+
+# Returns the NMEA sentence with its checksum.
+def nmea_line(sentence):
+    checksum = 0
+    for char in sentence:
+        checksum ^= ord(char)
+    return "$%s*%02X\n" % (sentence, checksum)
+
+
+# Track in New York (northern and western hemisphere) and in Buenos Aires
+# (southern and western hemisphere).
+NMEA_TRACK = "".join([
+    nmea_line("GPRMC,200000,A,4042.768,N,07400.360,W,10.0,90.0,010218,,"),
+    nmea_line("GPGGA,200000,4042.768,N,07400.360,W,1,08,0.9,-3.5,M,,M,,"),
+    nmea_line("GPRMC,200010,A,3436.222,S,05822.890,W,10.0,90.0,010218,,"),
+    nmea_line("GPGGA,200010,3436.222,S,05822.890,W,1,08,0.9,25.0,M,,M,,"),
+])
+
+
+class TestImportPositions(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="chasr-test-")
+
+        global_data = GlobalData()
+        global_data.server = "http://127.0.0.1:1/"
+        global_data.username = "user"
+        global_data.password = "password"
+        global_data.secret = "test"
+        global_data.device_name = "test"
+        global_data.gpslogging_interval = 0
+        global_data.crypto_processes = 1
+        self.importer = TrackImporter(global_data, self.work_dir,
+                                      chasr.check_gps)
+
+    def tearDown(self):
+        self.importer.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def positions(self, file_name, data):
+        location = os.path.join(self.work_dir, file_name)
+        with open(location, "w") as fp:
+            fp.write(data)
+        counters = collections.Counter()
+        positions = list(self.importer.positions(location, counters))
+        self.assertEqual(counters["invalid"], 0)
+        return positions
+
+    def test_gpx_negative_coordinates(self):
+        positions = self.positions("track.gpx", GPX_TRACK)
+        self.assertEqual(len(positions), 3)
+        self.assertEqual([float(x["lat"]) for x in positions],
+                         [-33.86, -33.861, -33.862])
+        self.assertEqual([float(x["alt"]) for x in positions],
+                         [5.0, -2.5, -5.0])
+
+    def test_nmea_negative_coordinates(self):
+        positions = self.positions("track.nmea", NMEA_TRACK)
+        self.assertEqual(len(positions), 2)
+        self.assertAlmostEqual(float(positions[0]["lon"]), -74.006, 3)
+        self.assertAlmostEqual(float(positions[0]["alt"]), -3.5, 3)
+        self.assertAlmostEqual(float(positions[1]["lat"]), -34.6037, 3)
+        self.assertAlmostEqual(float(positions[1]["lon"]), -58.3815, 3)
+
+
+class TestCheckGps(unittest.TestCase):
+
+    def check(self, **values):
+        data = {"lat": "52.1", "lon": "13.1", "alt": "30.0",
+                "speed": "1.0", "utctime": 1517515278}
+        data.update(values)
+        return chasr.check_gps(data)
+
+    def test_signed_values(self):
+        self.assertTrue(self.check(lat="-33.86", lon="-58.38", alt="-5.0"))
+        self.assertTrue(self.check(lat="-1234567890123"))
+        self.assertFalse(self.check(lat="-12345678901234"))
+        self.assertFalse(self.check(lat="-"))
+        self.assertFalse(self.check(lat="--1"))
+        self.assertFalse(self.check(lat="1-2"))
+        self.assertFalse(self.check(speed="-1.0"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chasr
+from lib import GpsJournal
+from lib import BinaryGpsJournal
+from lib import GpsBacklog
+from lib import convert_journal
+
+
+# Returns the gps position with the given index (values differ per index).
+def make_position(index):
+    return {"lat": "%.6f" % (52.5 + index * 0.0001),
+            "lon": "%.6f" % (-13.4 - index * 0.0001),
+            "alt": "%.1f" % (34.0 - index * 0.5),
+            "speed": "%.1f" % (index % 30),
+            "utctime": 1517515200 + index}
+
+
+# Returns the sequence numbers of the given gps positions.
+def seqs_of(elements):
+    return [x["seq"] for x in elements]
+
+
+class TestGpsJournal(unittest.TestCase):
+
+    journal_class = GpsJournal
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="chasr-test-")
+        self.journal_file = os.path.join(self.work_dir, "gps.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    # Returns the replayed positions of the journal file and the journal
+    # (opened for appending).
+    def _replay(self, journal_file=None, journal_class=None):
+        if journal_file is None:
+            journal_file = self.journal_file
+        if journal_class is None:
+            journal_class = self.journal_class
+        journal = journal_class(journal_file)
+        positions = list(journal.replay(chasr.check_gps))
+        self.addCleanup(journal.close)
+        return positions, journal
+
+    # Writes the given number of positions into a new journal and returns it.
+    def _write_positions(self, num):
+        positions, journal = self._replay()
+        self.assertEqual(positions, [])
+        for i in range(num):
+            journal.append(make_position(i))
+        return journal
+
+    def test_replay_round_trip(self):
+        journal = self._write_positions(10)
+        journal.ack(0, 2)
+        journal.ack(5, 6)
+        journal.write_records([{"seq_base": 50}])
+        journal.close()
+
+        positions, replayed = self._replay()
+        self.assertEqual(seqs_of(positions), [3, 4, 7, 8, 9])
+        for element in positions:
+            expected = make_position(element["seq"])
+            expected["seq"] = element["seq"]
+            self.assertEqual(element, expected)
+
+        # New positions continue after the sequence base.
+        self.assertEqual(replayed.next_seq, 50)
+        self.assertEqual(replayed.append(make_position(50)), 50)
+
+    def test_compaction_keeps_unacked(self):
+        journal = self._write_positions(2000)
+        journal.ack(0, 1499)
+        journal.ack(1600, 1699)
+        self.assertTrue(journal.needs_compaction())
+        size = os.path.getsize(self.journal_file)
+
+        journal.compact()
+        self.assertFalse(journal.needs_compaction())
+        self.assertLess(os.path.getsize(self.journal_file), size)
+
+        # Appending still works after the compaction.
+        self.assertEqual(journal.append(make_position(2000)), 2000)
+        journal.close()
+
+        positions, replayed = self._replay()
+        expected = list(range(1500, 1600)) + list(range(1700, 2001))
+        self.assertEqual(seqs_of(positions), expected)
+        self.assertEqual(replayed.next_seq, 2001)
+
+    def test_truncated_last_record(self):
+        journal = self._write_positions(5)
+        journal.close()
+        size = os.path.getsize(self.journal_file)
+        with open(self.journal_file, 'r+b') as fp:
+            fp.truncate(size - 3)
+
+        positions, replayed = self._replay()
+        self.assertEqual(seqs_of(positions), [0, 1, 2, 3])
+
+        # The torn record is cut off, so new records are readable again.
+        self.assertEqual(replayed.append(make_position(4)), 4)
+        replayed.close()
+        positions, _ = self._replay()
+        self.assertEqual(seqs_of(positions), [0, 1, 2, 3, 4])
+
+    def test_convert_keeps_positions(self):
+        journal = self._write_positions(2500)
+        journal.ack(10, 19)
+        journal.ack(2400, 2499)
+        journal.write_records([{"seq_base": 3000}])
+        journal.close()
+        original, _ = self._replay()
+
+        formats = {GpsJournal: "json", BinaryGpsJournal: "binary"}
+        other_class = (BinaryGpsJournal
+                       if self.journal_class == GpsJournal
+                       else GpsJournal)
+        converted_file = os.path.join(self.work_dir, "converted.journal")
+        back_file = os.path.join(self.work_dir, "back.journal")
+
+        num = convert_journal(self.journal_file, converted_file,
+                              formats[other_class], chasr.check_gps)
+        self.assertEqual(num, len(original))
+        converted, converted_journal = self._replay(converted_file,
+                                                    other_class)
+        self.assertEqual(converted, original)
+        self.assertEqual(converted_journal.next_seq, 3000)
+        converted_journal.close()
+
+        num = convert_journal(converted_file, back_file,
+                              formats[self.journal_class], chasr.check_gps)
+        self.assertEqual(num, len(original))
+        back, back_journal = self._replay(back_file)
+        self.assertEqual(back, original)
+        self.assertEqual(back_journal.next_seq, 3000)
+
+
+class TestBinaryGpsJournal(TestGpsJournal):
+
+    journal_class = BinaryGpsJournal
+
+
+class TestGpsBacklog(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="chasr-test-")
+        self.backlog = GpsBacklog(max_memory_points=8,
+                                  spill_dir=os.path.join(self.work_dir,
+                                                         "spill"),
+                                  segment_size=4)
+        for i in range(20):
+            element = make_position(i)
+            element["seq"] = i
+            self.backlog.append(element)
+
+    def tearDown(self):
+        self.backlog.ack(self.backlog.last_seq())
+        shutil.rmtree(self.work_dir)
+
+    def test_ack_range_out_of_order_spilled(self):
+        backlog = self.backlog
+        self.assertEqual(backlog.num_spilled, 12)
+
+        # Acknowledge ranges within and across spilled segments before
+        # the oldest positions.
+        backlog.ack_range(5, 6)
+        backlog.ack_range(7, 9)
+        backlog.ack_range(14, 15)
+        self.assertEqual(len(backlog), 13)
+        self.assertEqual(backlog.first_seq(), 0)
+        self.assertEqual(seqs_of(backlog.peek(8)),
+                         [0, 1, 2, 3, 4, 10, 11, 12])
+        self.assertEqual(seqs_of(backlog.peek_before(16, 4)),
+                         [11, 12, 13, 16])
+
+        # Acknowledging the oldest positions also removes the positions
+        # acknowledged out of order that follow them.
+        backlog.ack_range(0, 4)
+        self.assertEqual(backlog.first_seq(), 10)
+        self.assertEqual(len(backlog), 8)
+        self.assertEqual(seqs_of(backlog),
+                         [10, 11, 12, 13, 16, 17, 18, 19])
+
+        backlog.ack_range(10, 13)
+        self.assertEqual(backlog.first_seq(), 16)
+        self.assertEqual(backlog.num_spilled, 0)
+        self.assertEqual(seqs_of(backlog.peek(10)), [16, 17, 18, 19])
+        self.assertEqual(len(backlog), 4)
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, "spill")),
+                         [])
+
+
+if __name__ == '__main__':
+    unittest.main()
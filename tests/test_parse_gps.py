@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+# written by sqall
+# twitter: https://twitter.com/sqall01
+# blog: https://h4des.org/blog
+# github: https://github.com/sqall01
+#
+# Licensed under the GNU Affero General Public License, version 3.
+
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chasr
+
+
+def create_positions(num):
+    return [{"lat": "52.%06d" % i,
+             "lon": "13.%06d" % i,
+             "alt": "30.0",
+             "speed": "10.0",
+             "utctime": 1517515278 + i} for i in range(num)]
+
+
+class TestParseGps(unittest.TestCase):
+
+    def parse(self, data, read_size=65536):
+        return list(chasr.parse_gps(io.StringIO(data), read_size))
+
+    def test_complete(self):
+        positions = create_positions(1000)
+        self.assertEqual(self.parse(json.dumps(positions), 512), positions)
+
+    def test_truncated_tail(self):
+        positions = create_positions(1000)
+        data = json.dumps(positions)
+        data = data[:data.rfind("{") + 20]
+        self.assertEqual(self.parse(data, 512), positions[:-1])
+
+    # A syntax error in the middle of the file only loses the corrupt
+    # position, the positions after it are recovered.
+    def test_corrupt_mid_file(self):
+        positions = create_positions(20000)
+        entries = [json.dumps(x) for x in positions]
+        entries[10] = entries[10].replace(":", "", 1)
+        entries[15000] = entries[15000][:30] + "\x00garbage"
+        data = "[" + ", ".join(entries) + "]"
+
+        recovered = self.parse(data, 4096)
+        expected = [x for i, x in enumerate(positions) if i not in (10, 15000)]
+        self.assertEqual(recovered, expected)
+
+    def test_corrupt_and_truncated(self):
+        positions = create_positions(100)
+        entries = [json.dumps(x) for x in positions]
+        entries[1] = "{corrupt"
+        data = "[" + ", ".join(entries)
+        data = data[:data.rfind("{") + 5]
+        expected = [x for i, x in enumerate(positions[:-1]) if i != 1]
+        self.assertEqual(self.parse(data, 256), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()